@@ -0,0 +1,39 @@
+#!/usr/bin/python3
+
+# Measures how long a command which writes a burst of output takes to exit when its async_buffer_funcs
+# are slow, with the callbacks called on the reader thread and through a ShellCallbackDispatcher with
+# each overflow policy. The command only exits once the pipe has been drained, so a slow callback on
+# the reader thread holds it up.
+#
+# Usage: PYTHONPATH=src python3 benchmarks/bench_callback_dispatch.py [lines]
+
+import sys
+import time
+from ShellUtilities import Shell
+
+
+def slow_callback(line):
+    time.sleep(0.0005)
+
+
+# Writes the lines in one burst and then prints when it exits
+COMMAND = "import sys, time; sys.stdout.write(('x' * 100 + '\\n') * {0}); sys.stdout.flush(); print(time.time())"
+
+
+def benchmark(name, lines, **kwargs):
+    start = time.time()
+    shell_command_results = Shell.execute_shell_command(["python3", "-c", COMMAND.format(lines)], blocking=False, async_buffer_funcs={"stdout": [slow_callback]}, output_retention="lines", output_retention_limit=1, **kwargs)
+    shell_command_results.wait()
+    elapsed = time.time() - start
+    exited = float(shell_command_results.Stdout) - start
+    stats = shell_command_results.callback_stats() if kwargs else {}
+    print(f"{name:<30} child exited after {exited:6.3f}s, completed after {elapsed:6.3f}s {stats}")
+
+
+if __name__ == "__main__":
+    lines = int(sys.argv[1]) if len(sys.argv) > 1 else 2000
+    benchmark("reader thread", lines)
+    benchmark("dispatcher (block)", lines, callback_queue_size=lines)
+    benchmark("dispatcher (drop_oldest)", lines, callback_queue_size=100, callback_overflow="drop_oldest")
+    benchmark("dispatcher (drop_newest)", lines, callback_queue_size=100, callback_overflow="drop_newest")
+    benchmark("dispatcher (batches of 100)", lines, callback_queue_size=lines, callback_batch_size=100)
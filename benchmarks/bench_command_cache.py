@@ -0,0 +1,27 @@
+#!/usr/bin/python3
+
+# Compares running a read-only command every time it is needed against running it through a
+# ShellCommandCache, and prints the cache counters.
+#
+# Usage: PYTHONPATH=src python3 benchmarks/bench_command_cache.py [iterations]
+
+import sys
+import time
+from ShellUtilities import Shell
+from ShellUtilities.ShellCommandCache import ShellCommandCache
+
+
+def benchmark(name, iterations, execute):
+    start = time.perf_counter()
+    for i in range(iterations):
+        execute("uname -r")
+    elapsed = time.perf_counter() - start
+    print(f"{name:<20} {iterations / elapsed:12.1f} commands/s")
+
+
+if __name__ == "__main__":
+    iterations = int(sys.argv[1]) if len(sys.argv) > 1 else 1000
+    benchmark("uncached", iterations, Shell.execute_shell_command)
+    shell_command_cache = ShellCommandCache()
+    benchmark("ShellCommandCache", iterations, shell_command_cache.execute_shell_command)
+    print(shell_command_cache.stats())
@@ -0,0 +1,27 @@
+#!/usr/bin/python3
+
+# Measures the throughput (commands per second) of Shell.execute_shell_commands() as the number
+# of workers is scaled relative to the number of cores on the machine.
+#
+# Usage: PYTHONPATH=src python3 benchmarks/bench_execute_shell_commands.py [command_count]
+
+import os
+import sys
+import time
+from ShellUtilities import Shell
+
+
+def benchmark(command_count, max_workers):
+    commands = [f"echo {i}" for i in range(command_count)]
+    start = time.perf_counter()
+    for shell_command_result in Shell.execute_shell_commands(commands, max_workers=max_workers):
+        pass
+    return command_count / (time.perf_counter() - start)
+
+
+if __name__ == "__main__":
+    command_count = int(sys.argv[1]) if len(sys.argv) > 1 else 500
+    core_count = os.cpu_count() or 1
+    print(f"cores: {core_count}, commands: {command_count}")
+    for max_workers in sorted({1, 2, core_count // 2 or 1, core_count, core_count * 2, core_count * 4}):
+        print(f"max_workers={max_workers:<4} {benchmark(command_count, max_workers):10.1f} commands/s")
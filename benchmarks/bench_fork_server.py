@@ -0,0 +1,41 @@
+#!/usr/bin/python3
+
+# Compares the spawn-to-exit latency of a trivial command created with subprocess.Popen against one
+# created by a ShellForkServer as the memory used by this process grows. The fork server is started
+# before any memory is allocated.
+#
+# Usage: PYTHONPATH=src python3 benchmarks/bench_fork_server.py [iterations] [max_megabytes]
+
+import statistics
+import sys
+import time
+from ShellUtilities import Shell
+from ShellUtilities.ShellForkServer import ShellForkServer
+
+
+def benchmark(name, iterations, **kwargs):
+    latencies = []
+    for i in range(iterations):
+        start = time.perf_counter()
+        Shell.execute_shell_command(["date", "+%s"], **kwargs)
+        latencies.append(time.perf_counter() - start)
+    latencies.sort()
+    p50 = statistics.median(latencies) * 1000
+    p99 = latencies[int(len(latencies) * 0.99) - 1] * 1000
+    print(f"{name:<30} p50={p50:7.3f}ms p99={p99:7.3f}ms")
+
+
+if __name__ == "__main__":
+    iterations = int(sys.argv[1]) if len(sys.argv) > 1 else 200
+    max_megabytes = int(sys.argv[2]) if len(sys.argv) > 2 else 2048
+    with ShellForkServer() as fork_server:
+        allocations = []
+        megabytes = 0
+        while True:
+            benchmark(f"Popen ({megabytes}MB)", iterations)
+            benchmark(f"ShellForkServer ({megabytes}MB)", iterations, spawner=fork_server)
+            if megabytes >= max_megabytes:
+                break
+            # Touch every page so that it is actually mapped
+            allocations.append(bytearray(b"\1" * (max_megabytes // 2 * 1024 * 1024)))
+            megabytes += max_megabytes // 2
@@ -0,0 +1,42 @@
+#!/usr/bin/python3
+
+# Measures the overhead execute_shell_command() adds on top of a bare subprocess.Popen() when
+# logging is disabled, for a command with a large environment and one with a lot of output.
+#
+# Usage: PYTHONPATH=src python3 benchmarks/bench_logging_overhead.py [iterations]
+
+import logging
+import os
+import statistics
+import subprocess
+import sys
+import time
+from ShellUtilities import Shell
+
+
+def bare_popen(argv, env):
+    process = subprocess.Popen(argv, env=env, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+    process.communicate()
+
+
+def benchmark(name, iterations, func):
+    latencies = []
+    for i in range(iterations):
+        start = time.perf_counter()
+        func()
+        latencies.append(time.perf_counter() - start)
+    p50 = statistics.median(latencies) * 1000
+    print(f"{name:<45} p50={p50:8.3f}ms")
+    return p50
+
+
+if __name__ == "__main__":
+    iterations = int(sys.argv[1]) if len(sys.argv) > 1 else 200
+    logging.basicConfig(level=logging.WARNING)
+    env = dict(os.environ)
+    env.update({"VARIABLE_{0}".format(i): "x" * 100 for i in range(2000)})
+
+    for name, argv in [("large env", ["true"]), ("200k lines of output", ["seq", "1", "200000"])]:
+        bare = benchmark(f"Popen: {name}", iterations, lambda: bare_popen(argv, env))
+        shell = benchmark(f"execute_shell_command: {name}", iterations, lambda: Shell.execute_shell_command(argv, env=env))
+        print(f"{'overhead':<45} {shell - bare:+12.3f}ms")
@@ -0,0 +1,34 @@
+#!/usr/bin/python3
+
+# Measures the time and peak memory used to capture the output of a non-blocking command as the
+# number of lines it prints grows. Both should scale linearly; the per-line columns should stay
+# roughly constant as the line count doubles.
+#
+# Usage: PYTHONPATH=src python3 benchmarks/bench_output_accumulation.py [max_line_count]
+
+import sys
+import time
+import tracemalloc
+from ShellUtilities import Shell
+
+
+def benchmark(line_count):
+    tracemalloc.start()
+    start = time.perf_counter()
+    shell_command_results = Shell.execute_shell_command(f"seq 1 {line_count}", blocking=False)
+    shell_command_results.wait()
+    stdout = shell_command_results.Stdout
+    elapsed = time.perf_counter() - start
+    current, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    assert len(shell_command_results.stdout_lines) == line_count
+    return elapsed, peak
+
+
+if __name__ == "__main__":
+    max_line_count = int(sys.argv[1]) if len(sys.argv) > 1 else 1600000
+    line_count = max_line_count // 16
+    while line_count <= max_line_count:
+        elapsed, peak = benchmark(line_count)
+        print(f"lines={line_count:<9} time={elapsed:8.3f}s {elapsed / line_count * 1e6:8.3f}us/line peak={peak / 2**20:8.1f}MiB {peak / line_count:8.1f}B/line")
+        line_count *= 2
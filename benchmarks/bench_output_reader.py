@@ -0,0 +1,57 @@
+#!/usr/bin/python3
+
+# Compares the rate (lines per second) at which the output of a non-blocking command is captured by
+# the chunked reader against the previous implementation, which read one line at a time with
+# readline() and took the lock for every line.
+#
+# Usage: PYTHONPATH=src python3 benchmarks/bench_output_reader.py [line_count]
+
+import subprocess
+import sys
+import threading
+import time
+from ShellUtilities import Shell
+
+
+def readline_reader(command):
+    # A copy of the original per-line reader
+    process = subprocess.Popen(command, stdout=subprocess.PIPE, stderr=subprocess.PIPE, shell=True)
+    lock = threading.Lock()
+    lines = []
+
+    def handle_output_line(buffer):
+        for line in iter(buffer.readline, b''):
+            line = line.decode().rstrip("\n")
+            with lock:
+                lines.append(line)
+
+    threads = [threading.Thread(target=handle_output_line, args=(buffer,)) for buffer in [process.stdout, process.stderr]]
+    for thread in threads:
+        thread.start()
+    process.wait()
+    for thread in threads:
+        thread.join()
+    process.stdout.close()
+    process.stderr.close()
+    return len(lines)
+
+
+def chunked_reader(command, use_reactor=False):
+    shell_command_results = Shell.execute_shell_command(command, blocking=False, use_reactor=use_reactor)
+    shell_command_results.wait()
+    return len(shell_command_results.stdout_lines)
+
+
+def benchmark(name, func, line_count):
+    command = f"seq 1 {line_count}"
+    start = time.perf_counter()
+    assert func(command) == line_count
+    elapsed = time.perf_counter() - start
+    print(f"{name:<24} {line_count / elapsed:12.0f} lines/s")
+
+
+if __name__ == "__main__":
+    line_count = int(sys.argv[1]) if len(sys.argv) > 1 else 2000000
+    benchmark("readline (previous)", readline_reader, line_count)
+    benchmark("chunked (threads)", chunked_reader, line_count)
+    benchmark("chunked (reactor)", lambda command: chunked_reader(command, use_reactor=True), line_count)
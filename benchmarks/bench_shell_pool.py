@@ -0,0 +1,28 @@
+#!/usr/bin/python3
+
+# Compares the throughput of small probe commands when each one starts a new shell against running
+# them in the warm sessions of a ShellPool.
+#
+# Usage: PYTHONPATH=src python3 benchmarks/bench_shell_pool.py [command_count] [pool_size]
+
+import concurrent.futures
+import sys
+import time
+from ShellUtilities import Shell
+from ShellUtilities.ShellSession import ShellPool
+
+
+def benchmark(name, command_count, workers, execute):
+    start = time.perf_counter()
+    with concurrent.futures.ThreadPoolExecutor(max_workers=workers) as executor:
+        list(executor.map(lambda i: execute("test -f /etc/passwd"), range(command_count)))
+    elapsed = time.perf_counter() - start
+    print(f"{name:<28} {command_count / elapsed:9.1f} commands/s")
+
+
+if __name__ == "__main__":
+    command_count = int(sys.argv[1]) if len(sys.argv) > 1 else 2000
+    pool_size = int(sys.argv[2]) if len(sys.argv) > 2 else 4
+    benchmark("spawn per command", command_count, pool_size, Shell.execute_shell_command)
+    with ShellPool(size=pool_size) as shell_pool:
+        benchmark(f"ShellPool(size={pool_size})", command_count, pool_size, shell_pool.execute_shell_command)
@@ -0,0 +1,32 @@
+#!/usr/bin/python3
+
+# Compares the spawn-to-exit latency of a trivial command when it is run through the shell against
+# when it is executed directly from an argv list. Note that the command must not be a shell builtin
+# (such as true or echo) otherwise the shell does not need to create a second process.
+#
+# Usage: PYTHONPATH=src python3 benchmarks/bench_spawn_latency.py [iterations]
+
+import os
+import statistics
+import sys
+import time
+from ShellUtilities import Shell
+
+
+def benchmark(name, iterations, command, **kwargs):
+    latencies = []
+    for i in range(iterations):
+        start = time.perf_counter()
+        Shell.execute_shell_command(command, **kwargs)
+        latencies.append(time.perf_counter() - start)
+    latencies.sort()
+    p50 = statistics.median(latencies) * 1000
+    p99 = latencies[int(len(latencies) * 0.99) - 1] * 1000
+    print(f"{name:<26} p50={p50:7.3f}ms p99={p99:7.3f}ms")
+
+
+if __name__ == "__main__":
+    iterations = int(sys.argv[1]) if len(sys.argv) > 1 else 500
+    benchmark("shell: 'date +%s'", iterations, "date +%s")
+    benchmark("argv: ['date', '+%s']", iterations, ["date", "+%s"])
+    benchmark("argv with cwd", iterations, ["date", "+%s"], cwd=os.getcwd())
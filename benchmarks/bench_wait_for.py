@@ -0,0 +1,41 @@
+#!/usr/bin/python3
+
+# Compares how long it takes to notice that a command has become ready (by writing a line after a
+# burst of output) when polling its stdout_lines in a sleep loop against using wait_for().
+#
+# Usage: PYTHONPATH=src python3 benchmarks/bench_wait_for.py [lines]
+
+import sys
+import time
+from ShellUtilities import Shell
+
+
+# Writes the lines and then prints when it became ready
+COMMAND = "import sys, time; sys.stdout.write('starting\\n' * {0}); print('ready', time.time(), flush=True); time.sleep(1)"
+
+
+def poll(shell_command_results):
+    while True:
+        for line in list(shell_command_results.stdout_lines):
+            if line.startswith("ready"):
+                return line
+        time.sleep(0.05)
+
+
+def wait_for(shell_command_results):
+    return shell_command_results.wait_for("^ready.*").group(0)
+
+
+def benchmark(name, lines, func):
+    shell_command_results = Shell.execute_shell_command(["python3", "-c", COMMAND.format(lines)], blocking=False)
+    line = func(shell_command_results)
+    latency = time.time() - float(line.split()[1])
+    print(f"{name:<10} noticed {latency * 1000:8.2f}ms after the command became ready")
+    shell_command_results.process.kill()
+    shell_command_results.wait(raise_on_error=False)
+
+
+if __name__ == "__main__":
+    lines = int(sys.argv[1]) if len(sys.argv) > 1 else 100000
+    benchmark("polling", lines, poll)
+    benchmark("wait_for", lines, wait_for)
@@ -1,114 +1,604 @@
 import subprocess
 import logging
 import time
-from ShellUtilities.ShellCommandException import ShellCommandException
-from ShellUtilities.ShellCommandResults import ShellCommandResults, AsynchronousShellCommandResults
+from ShellUtilities.ShellCommandException import ShellCommandException, ShellCommandTimeoutException, ShellCommandBatchException
+from ShellUtilities.ShellCommandResults import ShellCommandResults, BufferedShellCommandResults, AsynchronousShellCommandResults, wait_any, wait_all
+from ShellUtilities.ShellOutputReactor import get_default_reactor, pump_process_output
+from ShellUtilities.ShellOutputBuffer import create_shell_output_buffer, FileShellOutputBuffer
+from ShellUtilities.ShellOutputReader import ShellOutputLineSplitter, READ_SIZE
+from ShellUtilities.ShellCommandMetrics import ShellCommandMetrics, reap_process, wait_for_exit, publish_metrics
+from ShellUtilities.ShellCallbackDispatcher import validate_dispatch_options
+from ShellUtilities.ShellInputWriter import ShellInputWriter
 import os
 import threading
+import signal
+import random
 import queue
 import asyncio
 import json
+import inspect
+import shlex
+import concurrent.futures
 
 
-logger = logging.getLogger(__name__).parent
+logger = logging.getLogger(__name__)
 
 
-def __execute_shell_command(command, env, cwd, executable=None):
-    # Create the process and wait for the exit
-    process = __execute_shell_command_async(command, env, cwd, executable)
-    (stdout, stderr) = process.communicate()
+def __kill_process_group(process):
+    # The process was started in a new session so this also kills anything the shell started
+    try:
+        os.killpg(process.pid, signal.SIGKILL)
+    except ProcessLookupError:
+        pass
+
+
+def __run_process(process, stdout_handler, stderr_handler, binary, encoding, errors, timeout, metrics, input_writer=None):
+    # Service the pipes of the process on this thread until they are closed and then reap it. If the
+    # timeout expires the process is killed and the rest of its output is read. Returns True if the
+    # timeout expired. The input (if any) is written on another thread at the same time.
+    end_time = time.monotonic() + timeout if timeout is not None else None
+    with process:
+        timed_out = pump_process_output(process, stdout_handler, stderr_handler, binary, encoding, errors, timeout, lambda: __kill_process_group(process), metrics)
+        # The process may have closed its pipes without exiting
+        if end_time is not None and not timed_out:
+            try:
+                wait_for_exit(process, max(0, end_time - time.monotonic()))
+            except subprocess.TimeoutExpired:
+                timed_out = True
+                __kill_process_group(process)
+        reap_process(process, metrics)
+        # The stdin must not be closed (when leaving the with statement) while it is being written to
+        if input_writer:
+            input_writer.join()
+    return timed_out
+
+
+def __execute_shell_command(command, env, cwd, executable=None, encoding="utf-8", errors="strict", shell=True, spawner=None, timeout=None, metrics=None, input_writer=None):
+    # Create the process and wait for the exit. If the timeout expires the process is killed and
+    # whatever output it had produced is returned. The output is collected as raw chunks (this was
+    # measured to be as fast as process.communicate()) and decoded at the end.
+    stdout_chunks = []
+    stderr_chunks = []
+    process = __execute_shell_command_async(command, env, cwd, executable, shell, spawner, timeout is not None, metrics, input_writer=input_writer)
+    timed_out = __run_process(process, stdout_chunks.extend, stderr_chunks.extend, True, encoding, errors, timeout, metrics, input_writer)
     exitcode = process.returncode
 
     # The stderr and stdout are byte objects... lets change them to strings
-    stdout = stdout.decode()
-    stderr = stderr.decode()
+    stdout = b"".join(stdout_chunks).decode(encoding, errors)
+    stderr = b"".join(stderr_chunks).decode(encoding, errors)
 
     # Sanitize the variables and remove trailing newline characters
     stdout = stdout.rstrip("\n")
     stderr = stderr.rstrip("\n")
 
-    return exitcode, stdout, stderr
+    return exitcode, stdout, stderr, timed_out
+
+
+def __execute_shell_command_buffered(command, env, cwd, executable, output_retention, output_retention_limit, binary=False, encoding="utf-8", errors="strict", shell=True, spawner=None, timeout=None, metrics=None, stdout_buffer=None, stderr_buffer=None, input_writer=None):
+    # Rather than collecting all of the output at once, the pipes are read line by line (or chunk
+    # by chunk in binary mode) on this thread so that the output retention policy can be applied as
+    # it arrives. The streams which are redirected to files already have their buffers.
+    if stdout_buffer is None:
+        stdout_buffer = create_shell_output_buffer(output_retention, output_retention_limit, binary, encoding, errors)
+    if stderr_buffer is None:
+        stderr_buffer = create_shell_output_buffer(output_retention, output_retention_limit, binary, encoding, errors)
+    process = __execute_shell_command_async(command, env, cwd, executable, shell, spawner, timeout is not None, metrics, __get_redirect_fd(stdout_buffer), __get_redirect_fd(stderr_buffer), input_writer)
+    timed_out = __run_process(process, stdout_buffer.extend, stderr_buffer.extend, binary, encoding, errors, timeout, metrics, input_writer)
+    __finish_redirect_buffers(stdout_buffer, stderr_buffer)
+    return BufferedShellCommandResults(command, stdout_buffer, stderr_buffer, process.returncode, binary, metrics), timed_out
+
+
+def __create_redirect_buffer(target, stream, blocking, async_buffer_funcs, line_queue_size, encoding, errors):
+    # The buffer for a stream which is redirected to a file, or None if it is not. The process writes
+    # to the file directly unless the lines of a non-blocking command have to be handed to callbacks
+    # (or queued for iteration), in which case they are still read through a pipe and the buffer
+    # writes them to the file.
+    if target is None:
+        return None
+    direct = blocking or not (async_buffer_funcs.get(stream) or line_queue_size)
+    return FileShellOutputBuffer(target, direct, encoding, errors)
+
+
+def __get_redirect_fd(buffer):
+    # The fd the process should write the stream to, or None if it should be piped
+    if isinstance(buffer, FileShellOutputBuffer) and buffer.direct:
+        return buffer.fd
+    return None
+
+
+def __finish_redirect_buffers(*buffers):
+    for buffer in buffers:
+        if isinstance(buffer, FileShellOutputBuffer):
+            buffer.finish()
 
 
-def __execute_shell_command_async(command, env, cwd, executable=None):
+def __get_process_arguments(command, env, cwd, executable=None, shell=True, stdout=None, stderr=None, stdin=None):
 
-    args = [command]
+    # Returns the argv to execute directly (or None if the command is to be run by the shell) along
+    # with the keyword arguments used to create the process.
+    #
+    # A command given as a list (or a string when shell is False) is executed directly rather than
+    # through /bin/sh, which saves creating a second process and parsing the command. On python 3.10+
+    # subprocess creates the child with vfork() in this configuration. (Forcing posix_spawn() by
+    # resolving the program up front and not closing the file descriptors was measured to be slower.)
+    #
+    # The stdout and stderr are piped unless the fd of a file is given for them. The stdin is
+    # inherited unless it is given.
+
+    argv = None
     kwargs = {
-        "stdout": subprocess.PIPE,
-        "stderr": subprocess.PIPE,
-        "shell": True,
+        "stdout": subprocess.PIPE if stdout is None else stdout,
+        "stderr": subprocess.PIPE if stderr is None else stderr,
         "close_fds": 'posix',
     }
+    if stdin is not None:
+        kwargs["stdin"] = stdin
+    if isinstance(command, (list, tuple)) or not shell:
+        argv = list(command) if isinstance(command, (list, tuple)) else shlex.split(command)
     if executable:
-        logging.debug(f"Executable set to: {executable}")
+        logger.debug("Executable set to: %s", executable)
         kwargs["executable"] = executable
     if env:
-        logging.debug(f"Environment set to: " + os.linesep + json.dumps(env, indent = 4))
+        # Formatting a large environment is expensive so only do it if it will be logged
+        if logger.isEnabledFor(logging.DEBUG):
+            logger.debug("Environment set to: %s%s", os.linesep, json.dumps(env, indent = 4))
         kwargs["env"] = env
     if cwd:
-        logging.debug(f"CWD set to: {cwd}")
+        logger.debug("CWD set to: %s", cwd)
         kwargs["cwd"] = cwd
 
-    # Create the process
-    process = subprocess.Popen(*args, **kwargs)
+    return argv, kwargs
+
+
+def __execute_shell_command_async(command, env, cwd, executable=None, shell=True, spawner=None, new_session=False, metrics=None, stdout=None, stderr=None, input_writer=None):
+
+    # The input is written to a pipe once the process has been created
+    stdin = subprocess.PIPE if input_writer else None
+    argv, kwargs = __get_process_arguments(command, env, cwd, executable, shell, stdout, stderr, stdin)
 
-    logging.debug("Process opened.")
+    # Processes which may have to be killed are put in their own process group so that anything
+    # they start can be killed along with them
+    if new_session:
+        kwargs["start_new_session"] = True
+
+    # Create the process, either directly or through the spawner (e.g. a ShellForkServer)
+    popen = spawner.popen if spawner else subprocess.Popen
+    if metrics:
+        metrics.start_time = time.monotonic()
+    if argv is None:
+        process = popen(command, shell=True, **kwargs)
+    else:
+        process = popen(argv, **kwargs)
+    if metrics:
+        metrics.record_spawn()
+    if input_writer:
+        input_writer.start(process.stdin)
+
+    logger.debug("Process opened.")
     return process
 
 
-def execute_shell_command(command, max_retries=1, retry_delay=1, env=None, cwd=None, blocking=True, executable=None, async_buffer_funcs={}):
+def __validate_output_echo(output_echo, output_echo_limit):
+    if output_echo not in ["all", "none", "head", "tail"]:
+        raise Exception("Unknown output echo policy '{0}'.".format(output_echo))
+    if output_echo in ["head", "tail"] and (not isinstance(output_echo_limit, int) or output_echo_limit < 1):
+        raise Exception("The '{0}' output echo policy requires a positive output_echo_limit.".format(output_echo))
+
+
+def __validate_retry_options(retry_backoff, retry_jitter):
+    # The delay before a retry never shrinks and the jitter can at most remove all of it
+    if retry_backoff < 1:
+        raise Exception("The retry_backoff must be at least 1.")
+    if not 0 <= retry_jitter <= 1:
+        raise Exception("The retry_jitter must be between 0 and 1.")
+
+
+def __get_echo_lines(output_string, output_echo, output_echo_limit):
+    # The lines of the output which are logged according to the output echo policy. Only as much of
+    # the output as is needed is split.
+    if output_echo == "none":
+        return []
+    if output_echo == "head":
+        return output_string.split("\n", output_echo_limit)[:output_echo_limit]
+    if output_echo == "tail":
+        return output_string.rsplit("\n", output_echo_limit)[-output_echo_limit:]
+    return output_string.split("\n")
+
+
+def __log_successful_command(stdout_string, stderr_string, output_echo="all", output_echo_limit=None):
+    # The output is only split into lines if they will actually be logged
+    logger.debug("Command STDOUT:")
+    if logger.isEnabledFor(logging.DEBUG):
+        for line in __get_echo_lines(stdout_string, output_echo, output_echo_limit):
+            if line:
+                logger.debug(line)
+    logger.debug("Command STDERR:")
+    if logger.isEnabledFor(logging.ERROR):
+        for line in __get_echo_lines(stderr_string, output_echo, output_echo_limit):
+            if line:
+                logger.error(line)
+
+
+def __log_failed_command(max_retries, stdout_string, stderr_string, exitcode, output_echo="all", output_echo_limit=None):
+    if not logger.isEnabledFor(logging.ERROR):
+        return
+    logger.error("Maximum retries (%s) exceeded for shell command. An error will be generated.", max_retries)
+    logger.error("Stdout:")
+    for line in __get_echo_lines(stdout_string, output_echo, output_echo_limit):
+        logger.error(line)
+    logger.error("Stderr:")
+    for line in __get_echo_lines(stderr_string, output_echo, output_echo_limit):
+        logger.error(line)
+    logger.error("Exit code: %s", exitcode)
+
+
+def execute_shell_command(command, max_retries=1, retry_delay=1, env=None, cwd=None, blocking=True, executable=None, async_buffer_funcs={}, use_reactor=False, output_retention="all", output_retention_limit=None, line_queue_size=None, binary=False, encoding="utf-8", errors="strict", shell=True, spawner=None, timeout=None, deadline=None, retry_backoff=1, max_retry_delay=None, retry_jitter=0, retry_predicate=None, output_echo="all", output_echo_limit=None, stdout=None, stderr=None, callback_queue_size=None, callback_overflow="block", callback_batch_size=None, callback_batch_interval=None, input=None):
+
+    # The command is normally run by the shell. If it is given as a list of arguments (or shell is
+    # False) the program is executed directly instead, which avoids having to start the shell.
+    #
+    # The output is decoded using the encoding and errors (see bytes.decode()). In binary mode the raw
+    # output is retained instead and is available through the StdoutBytes and StderrBytes of the
+    # results; the Stdout and Stderr are only decoded if they are accessed.
+    #
+    # The output_retention determines how much of the output of the command is kept (see
+    # create_shell_output_buffer() for the policies). By default all of it is kept in memory.
+    #
+    # The line_queue_size enables iteration over the output of a non-blocking command through the
+    # iter_lines(), iter_stdout() and iter_stderr() functions of the results. At most this many lines
+    # are queued for each stream before reading from it is paused.
+    #
+    # The spawner is used to create the process in place of subprocess.Popen. Passing a
+    # ShellForkServer makes the cost of creating it independent of the memory used by this process.
+    #
+    # Each attempt of a blocking command may run for at most timeout seconds and all of the attempts
+    # (along with the delays between them) must complete within deadline seconds. When either expires
+    # the process group of the command is killed and a ShellCommandTimeoutException containing the
+    # output produced so far is raised (or the command is retried).
+    #
+    # The delay before each retry is multiplied by the retry_backoff, up to the max_retry_delay, and
+    # then reduced by a random fraction of up to retry_jitter (between 0 and 1) of it. The retry_backoff
+    # must be at least 1. When a retry_predicate is given, it is called with the ShellCommandException
+    # of a failed attempt and the command is only retried if it returns True.
+    #
+    # The output_echo determines how much of the output is logged once the command completes: "all"
+    # of it, "none" of it, or the "head" or "tail" of it (output_echo_limit lines of each stream). The
+    # stdout is logged at the DEBUG level; the stderr, and all of the output of failed commands, is
+    # logged at the ERROR level. Nothing is formatted unless the level is enabled.
+    #
+    # The stdout and stderr may be redirected to a file path, an open file or a file descriptor which
+    # the process writes to directly, so the output does not pass through python. The output is then
+    # read back from the file lazily (through a memory map) when the Stdout, Stderr or lines of the
+    # results are accessed, and only the tail of it is logged or attached to exceptions. The output
+    # retention policy does not apply to redirected streams. If async_buffer_funcs (or line
+    # iteration) are used for a redirected stream of a non-blocking command, it is still read through
+    # a pipe and the lines are written to the file as they are handled.
+    #
+    # The async_buffer_funcs of a non-blocking command are normally called on the thread which reads
+    # its output. When a callback_queue_size is given they are called on a separate dispatcher thread
+    # instead, so that slow callbacks do not stop the output from being read. At most that many lines
+    # are queued for them; the callback_overflow policy ("block", "drop_oldest" or "drop_newest")
+    # decides what happens once the queue is full. With a callback_batch_size and/or
+    # callback_batch_interval (in seconds) the callbacks are passed lists of lines. See
+    # ShellCallbackDispatcher and the callback_stats() of the results.
+    #
+    # The input is written to the stdin of the command while its output is read. It may be a string,
+    # a bytes-like object (e.g. an mmap), a file, or an iterator or async iterator of chunks (see
+    # ShellInputWriter). Files and iterators can only be read once, so a retried attempt only gets
+    # whatever input is left.
 
     try:
 
         if cwd and not os.path.isdir(cwd):
             raise Exception("The working directory '{0}' does not exist.".format(cwd))
 
-        logging.debug("Running shell command:")
-        logging.debug(command)
+        # Validate the retention policy before running anything
+        create_shell_output_buffer(output_retention, output_retention_limit, binary, encoding, errors)
+
+        if blocking and line_queue_size:
+            raise Exception("Line iteration is only supported for non-blocking commands.")
+
+        if callback_queue_size is not None:
+            if blocking:
+                raise Exception("Callback dispatch is only supported for non-blocking commands.")
+            validate_dispatch_options(callback_queue_size, callback_overflow, callback_batch_size, callback_batch_interval)
+        elif callback_batch_size is not None or callback_batch_interval is not None:
+            raise Exception("Batching callbacks requires a callback_queue_size.")
+
+        if input is not None and spawner is not None:
+            raise Exception("Input is not supported for commands created by a spawner (e.g. a ShellForkServer).")
+        # This must be checked before the target of the redirect is opened (and truncated)
+        if (stdout is not None or stderr is not None) and spawner is not None:
+            raise Exception("Redirecting the output is not supported for commands created by a spawner (e.g. a ShellForkServer).")
+
+        if not blocking and (timeout is not None or deadline is not None):
+            raise Exception("Timeouts are only supported for blocking commands; use the wait() function of the results instead.")
+
+        __validate_output_echo(output_echo, output_echo_limit)
+        __validate_retry_options(retry_backoff, retry_jitter)
+
+        logger.debug("Running shell command:")
+        logger.debug("%s", command)
+
+        deadline_time = time.monotonic() + deadline if deadline is not None else None
+        delay = retry_delay if max_retry_delay is None else min(retry_delay, max_retry_delay)
 
         for i in range(0, max_retries):
 
+            # The attempt may not run past the deadline
+            attempt_timeout = timeout
+            if deadline_time is not None:
+                remaining = max(0, deadline_time - time.monotonic())
+                attempt_timeout = remaining if timeout is None else min(timeout, remaining)
+
+            # Each attempt records its own metrics
+            metrics = ShellCommandMetrics(command)
+
+            input_writer = ShellInputWriter(input, encoding) if input is not None else None
+
+            # Each attempt writes its own output to the redirected streams (a path is truncated)
+            stdout_buffer = __create_redirect_buffer(stdout, "stdout", blocking, async_buffer_funcs, line_queue_size, encoding, errors)
+            stderr_buffer = __create_redirect_buffer(stderr, "stderr", blocking, async_buffer_funcs, line_queue_size, encoding, errors)
+
             # Run the shell command
-            if blocking:
-                exitcode, stdout_string, stderr_string = __execute_shell_command(command, env, cwd, executable)
+            if not blocking:
+                process = __execute_shell_command_async(command, env, cwd, executable, shell, spawner, metrics=metrics, stdout=__get_redirect_fd(stdout_buffer), stderr=__get_redirect_fd(stderr_buffer), input_writer=input_writer)
+                reactor = get_default_reactor() if use_reactor else None
+                return AsynchronousShellCommandResults(command, process, async_buffer_funcs, reactor, output_retention, output_retention_limit, line_queue_size, binary, encoding, errors, metrics, stdout_buffer, stderr_buffer, callback_queue_size, callback_overflow, callback_batch_size, callback_batch_interval, input_writer)
+            elif output_retention == "all" and not binary and stdout is None and stderr is None:
+                exitcode, stdout_string, stderr_string, timed_out = __execute_shell_command(command, env, cwd, executable, encoding, errors, shell, spawner, attempt_timeout, metrics, input_writer)
+                shell_command_results = ShellCommandResults(command, stdout_string, stderr_string, exitcode, metrics)
             else:
-                process = __execute_shell_command_async(command, env, cwd, executable)
-                return AsynchronousShellCommandResults(command, process, async_buffer_funcs)
+                shell_command_results, timed_out = __execute_shell_command_buffered(command, env, cwd, executable, output_retention, output_retention_limit, binary, encoding, errors, shell, spawner, attempt_timeout, metrics, stdout_buffer, stderr_buffer, input_writer)
+                exitcode = shell_command_results.ExitCode
+                # Only the tail of the output is logged or attached to exceptions
+                stdout_string = shell_command_results.stdout_buffer.diagnostic_text().rstrip("\n")
+                stderr_string = shell_command_results.stderr_buffer.diagnostic_text().rstrip("\n")
+
+            metrics.record_completion(exitcode)
+            publish_metrics(metrics)
 
             # If successful, return the results
-            if exitcode == 0:
-                logging.debug("Command STDOUT:")
-                for line in stdout_string.split("\n"):
-                    if line:
-                        logging.debug(line)
-                logging.debug("Command STDERR:")
-                for line in stderr_string.split("\n"):
-                    if line:
-                        logging.error(line)
-                return ShellCommandResults(command, stdout_string, stderr_string, exitcode)
+            if exitcode == 0 and not timed_out:
+                __log_successful_command(stdout_string, stderr_string, output_echo, output_echo_limit)
+                return shell_command_results
+
+            # The exception only contains the tail of the output, so the files behind it can be closed
+            shell_command_results.close()
+
+            if timed_out:
+                logger.debug("The shell command timed out after %.3f seconds.", attempt_timeout)
+                shell_command_exception = ShellCommandTimeoutException(command, stdout_string, stderr_string, exitcode, attempt_timeout, metrics)
+            else:
+                shell_command_exception = ShellCommandException(command, stdout_string, stderr_string, exitcode, metrics)
 
             # If an error occured we need to determine if this is the last retry attempt
             last_retry = i == max_retries - 1
 
             # If it is not the last retry we must determine whether or not we can ignore the error
             # To do this we must see if our retry conditions have been satisfied
+            if not last_retry and retry_predicate and not retry_predicate(shell_command_exception):
+                logger.debug("The retry predicate rejected the failure. No more retries will be attempted.")
+                last_retry = True
+
+            if not last_retry:
+                sleep_time = delay
+                if retry_jitter:
+                    sleep_time -= random.uniform(0, retry_jitter * sleep_time)
+                delay = delay * retry_backoff
+                if max_retry_delay is not None:
+                    delay = min(delay, max_retry_delay)
+                # There is no point in retrying if the deadline will have passed by then
+                if deadline_time is not None and time.monotonic() + sleep_time >= deadline_time:
+                    last_retry = True
+
+            if not last_retry:
+                logger.debug("Retrying...(%s)", i)
+                time.sleep(sleep_time)
+                continue
+            else:
+                __log_failed_command(max_retries, stdout_string, stderr_string, exitcode, output_echo, output_echo_limit)
+                raise shell_command_exception
+
+    except Exception as ex:
+        raise Exception("An error occurred while executing the shell command.") from ex
+
+
+def execute_shell_commands(commands, max_workers=None, fail_fast=False, **kwargs):
+
+    # Execute a batch of shell commands with at most max_workers of them running at once. The
+    # commands may either be strings or dicts containing a "command" along with an optional "env"
+    # and "cwd" which override those supplied for the whole batch. Any other keyword arguments are
+    # passed through to execute_shell_command().
+    #
+    # This is a generator which yields the ShellCommandResults in the order the commands complete.
+    # Once all of the commands have run, a ShellCommandBatchException is raised if any of them
+    # failed. When fail_fast is set, the commands which have not yet started are cancelled and the
+    # exception is raised as soon as the first failure is seen.
+
+    if kwargs.get("blocking") is False:
+        raise Exception("Batches of shell commands can only be executed in blocking mode.")
+
+    if max_workers is None:
+        max_workers = os.cpu_count() or 1
+
+    def run_command(command):
+        command_kwargs = dict(kwargs)
+        if isinstance(command, dict):
+            command_kwargs.update({key: value for key, value in command.items() if key != "command"})
+            command = command["command"]
+        try:
+            return execute_shell_command(command, **command_kwargs)
+        except Exception as ex:
+            # Unwrap the generic exception raised by execute_shell_command() so that the caller
+            # gets the ShellCommandException describing the failure
+            if isinstance(ex.__cause__, ShellCommandException):
+                raise ex.__cause__
+            raise
+
+    exceptions = []
+    executor = concurrent.futures.ThreadPoolExecutor(max_workers=max_workers)
+    try:
+        futures = [executor.submit(run_command, command) for command in commands]
+        logger.debug("Running batch of %s shell commands with %s workers.", len(futures), max_workers)
+        for future in concurrent.futures.as_completed(futures):
+            exception = future.exception()
+            if exception is None:
+                yield future.result()
+                continue
+            exceptions.append(exception)
+            if fail_fast:
+                logger.error("A shell command in the batch failed. The remaining commands will be cancelled.")
+                break
+    finally:
+        # Cancel anything which has not started yet; this also covers the consumer abandoning the generator
+        executor.shutdown(wait=True, cancel_futures=True)
+
+    if exceptions:
+        raise ShellCommandBatchException(exceptions)
+
+
+async def __invoke_async_buffer_funcs(funcs, line):
+    # The callbacks may either be plain functions or coroutine functions; the
+    # latter are awaited so that they run on the same event loop as the command
+    for func in funcs:
+        result = func(line)
+        if inspect.isawaitable(result):
+            await result
+
+
+async def __read_stream_async(stream, funcs, binary=False, encoding="utf-8", errors="strict", metrics=None, stream_name=None):
+    # Read the stream in large chunks rather than with StreamReader.readline() which
+    # raises once a single line exceeds the reader's limit. The lines are only split
+    # out of the chunks when there is somebody listening for them. In binary mode the
+    # listeners are given the chunks themselves.
+    chunks = []
+    lines = []
+    splitter = ShellOutputLineSplitter(lines.extend, binary, encoding, errors)
+    while True:
+        chunk = await stream.read(READ_SIZE)
+        if chunk:
+            chunks.append(chunk)
+            if metrics:
+                metrics.record_output(stream_name, chunk, len(chunk))
+        if funcs:
+            if chunk:
+                splitter.feed(chunk)
+            else:
+                splitter.close()
+            for line in lines:
+                await __invoke_async_buffer_funcs(funcs, line)
+            lines.clear()
+        if not chunk:
+            break
+    return b"".join(chunks)
+
+
+async def __execute_shell_command_coroutine(command, env, cwd, executable=None, async_buffer_funcs={}, binary=False, encoding="utf-8", errors="strict", shell=True, input=None):
+
+    input_writer = ShellInputWriter(input, encoding) if input is not None else None
+    argv, kwargs = __get_process_arguments(command, env, cwd, executable, shell, stdin=subprocess.PIPE if input_writer else None)
+    # The coroutine may be cancelled at any point, so the process is always put in its own process
+    # group so that anything it starts can be killed along with it
+    kwargs["start_new_session"] = True
+
+    # The child is reaped by the event loop so the resources it used are not available
+    metrics = ShellCommandMetrics(command)
+
+    # Create the process; the pipes are serviced by the event loop rather than by threads
+    if argv is None:
+        process = await asyncio.create_subprocess_shell(command, **kwargs)
+    else:
+        process = await asyncio.create_subprocess_exec(*argv, **kwargs)
+    metrics.record_spawn()
+    logger.debug("Process opened.")
+
+    # Drain both pipes (and write the input) concurrently so that neither of them can fill up and
+    # deadlock the child
+    tasks = [
+        asyncio.ensure_future(__read_stream_async(process.stdout, async_buffer_funcs.get("stdout", []), binary, encoding, errors, metrics, "stdout")),
+        asyncio.ensure_future(__read_stream_async(process.stderr, async_buffer_funcs.get("stderr", []), binary, encoding, errors, metrics, "stderr"))
+    ]
+    if input_writer:
+        tasks.append(asyncio.ensure_future(input_writer.write_async(process.stdin)))
+    try:
+        stdout, stderr, *rest = await asyncio.gather(*tasks)
+        exitcode = await process.wait()
+    except BaseException:
+        # The coroutine was cancelled (e.g. by asyncio.wait_for() timing out) or a callback raised, so
+        # the process and anything it started are killed rather than being left running after we have
+        # stopped reading from them
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        __kill_process_group(process)
+        await process.wait()
+        raise
+    if input_writer and input_writer.exception:
+        raise input_writer.exception
+    metrics.record_completion(exitcode)
+    publish_metrics(metrics)
+
+    # Mirror the blocking implementation so the results are identical
+    if binary:
+        stdout_buffer = create_shell_output_buffer(binary=True, encoding=encoding, errors=errors)
+        stderr_buffer = create_shell_output_buffer(binary=True, encoding=encoding, errors=errors)
+        stdout_buffer.append(stdout)
+        stderr_buffer.append(stderr)
+        return BufferedShellCommandResults(command, stdout_buffer, stderr_buffer, exitcode, binary, metrics)
+    stdout = stdout.decode(encoding, errors).rstrip("\n")
+    stderr = stderr.decode(encoding, errors).rstrip("\n")
+
+    return ShellCommandResults(command, stdout, stderr, exitcode, metrics)
+
+
+async def execute_shell_command_async(command, max_retries=1, retry_delay=1, env=None, cwd=None, executable=None, async_buffer_funcs={}, binary=False, encoding="utf-8", errors="strict", shell=True, output_echo="all", output_echo_limit=None, input=None):
+
+    # This is the asyncio equivalent of execute_shell_command(). It must be awaited from within an
+    # event loop and will not start any threads to service the pipes of the child process. As a
+    # result, a large number of commands can be run concurrently using asyncio.gather() etc.
+    #
+    # The async_buffer_funcs will be invoked for each line written to the stdout and stderr of the
+    # process. They may be regular functions or coroutine functions. The input is written to the stdin
+    # of the process as it is with execute_shell_command().
+
+    try:
+
+        if cwd and not os.path.isdir(cwd):
+            raise Exception("The working directory '{0}' does not exist.".format(cwd))
+
+        __validate_output_echo(output_echo, output_echo_limit)
+
+        logger.debug("Running shell command:")
+        logger.debug("%s", command)
+
+        for i in range(0, max_retries):
+
+            # Run the shell command
+            shell_command_results = await __execute_shell_command_coroutine(command, env, cwd, executable, async_buffer_funcs, binary, encoding, errors, shell, input)
+            exitcode = shell_command_results.ExitCode
+            if binary:
+                stdout_string = shell_command_results.stdout_buffer.diagnostic_text().rstrip("\n")
+                stderr_string = shell_command_results.stderr_buffer.diagnostic_text().rstrip("\n")
+            else:
+                stdout_string = shell_command_results.Stdout
+                stderr_string = shell_command_results.Stderr
+
+            # If successful, return the results
+            if exitcode == 0:
+                __log_successful_command(stdout_string, stderr_string, output_echo, output_echo_limit)
+                return shell_command_results
+
+            # If an error occured we need to determine if this is the last retry attempt
+            last_retry = i == max_retries - 1
+
             if not last_retry:
-                logging.debug("Retrying...(%s)" % i)
-                time.sleep(retry_delay)
+                logger.debug("Retrying...(%s)", i)
+                await asyncio.sleep(retry_delay)
                 continue
             else:
-                err_msg = "Maximum retries (%s) exceeded for shell command."
-                err_msg += " An error will be generated."
-                logging.error(err_msg % max_retries)
-                logging.error("Stdout:")
-                for line in stdout_string.split("\n"):
-                    logging.error(line)
-                logging.error("Stderr:")
-                for line in stderr_string.split("\n"):
-                    logging.error(line)
-                logging.error("Exit code: {0}".format(exitcode))
-
-                raise ShellCommandException(command, stdout_string, stderr_string, exitcode)
+                __log_failed_command(max_retries, stdout_string, stderr_string, exitcode, output_echo, output_echo_limit)
+                raise ShellCommandException(command, stdout_string, stderr_string, exitcode, shell_command_results.Metrics)
 
     except Exception as ex:
         raise Exception("An error occurred while executing the shell command.") from ex
@@ -0,0 +1,172 @@
+import collections
+import threading
+import logging
+import time
+
+
+logger = logging.getLogger(__name__)
+
+
+OVERFLOW_POLICIES = ["block", "drop_oldest", "drop_newest"]
+
+
+def validate_dispatch_options(queue_size, overflow="block", batch_size=None, batch_interval=None):
+    if overflow not in OVERFLOW_POLICIES:
+        raise Exception("Unknown callback overflow policy '{0}'.".format(overflow))
+    if not isinstance(queue_size, int) or queue_size < 1:
+        raise Exception("The callback queue size must be a positive integer.")
+    if batch_size is not None and (not isinstance(batch_size, int) or batch_size < 1):
+        raise Exception("The callback batch size must be a positive integer.")
+    if batch_interval is not None and batch_interval <= 0:
+        raise Exception("The callback batch interval must be positive.")
+
+
+class ShellCallbackDispatcher():
+
+    # Delivers the lines read from the streams of a non-blocking command to its async_buffer_funcs on
+    # a thread of its own, so that a slow callback does not stop the pipes from being drained. The
+    # lines are handed over through a queue which holds at most queue_size lines. When it is full the
+    # overflow policy decides what happens to the next lines:
+    #   block       - wait for the callbacks to catch up (the default). On the reactor thread, which
+    #                 must never block, the stream is paused instead (see pause and resume).
+    #   drop_oldest - discard the oldest line in the queue
+    #   drop_newest - discard the line which was just read
+    #
+    # The callbacks are normally called with each line. When a batch_size and/or batch_interval (in
+    # seconds) is given they are instead called with a list of lines once that many lines have been
+    # read from the stream or that long has passed since the first line of the batch was read.
+    #
+    # The lines which were dropped, or which had to wait for room in the queue, are counted (see
+    # stats()).
+
+    def __init__(self, async_buffer_funcs, queue_size, overflow="block", batch_size=None, batch_interval=None, pause=None, resume=None):
+        validate_dispatch_options(queue_size, overflow, batch_size, batch_interval)
+        self.async_buffer_funcs = async_buffer_funcs
+        self.queue_size = queue_size
+        self.overflow = overflow
+        self.batch_size = batch_size
+        self.batch_interval = batch_interval
+        self.batching = batch_size is not None or batch_interval is not None
+        self.pause = pause
+        self.resume = resume
+        self.condition = threading.Condition()
+        self.queue = collections.deque()
+        self.paused_streams = set()
+        self.closed = False
+        self.close_callback = None
+        # The lines of each stream which are waiting to be delivered as a batch, and when the first
+        # of them was read
+        self.batches = {"stdout": [], "stderr": []}
+        self.batch_start_times = {}
+        self.dispatched = 0
+        self.dropped = 0
+        self.delayed = 0
+        self.batch_count = 0
+        self.thread = threading.Thread(target=self._run, name="ShellCallbackDispatcher", daemon=True)
+        self.thread.start()
+
+    def stats(self):
+        with self.condition:
+            return {
+                "queued": len(self.queue),
+                "dispatched": self.dispatched,
+                "dropped": self.dropped,
+                "delayed": self.delayed,
+                "batches": self.batch_count
+            }
+
+    def put(self, stream, lines, block=True):
+        # Queue lines read from the stream. When block is False (on the reactor thread) the block
+        # policy pauses the stream rather than waiting; the queue may overshoot by the rest of the
+        # lines which were just read.
+        if not self.async_buffer_funcs.get(stream):
+            return
+        with self.condition:
+            for line in lines:
+                if len(self.queue) >= self.queue_size:
+                    if self.overflow == "drop_newest":
+                        self.dropped += 1
+                        continue
+                    if self.overflow == "drop_oldest":
+                        self.queue.popleft()
+                        self.dropped += 1
+                    elif block:
+                        self.delayed += 1
+                        while len(self.queue) >= self.queue_size:
+                            self.condition.notify_all()
+                            self.condition.wait()
+                    else:
+                        self.delayed += 1
+                        if stream not in self.paused_streams:
+                            self.paused_streams.add(stream)
+                            self.pause(stream)
+                self.queue.append((stream, line))
+            self.condition.notify_all()
+
+    def close(self, callback):
+        # Called once all of the output has been read. The callback is called on the dispatcher thread
+        # once all of the queued lines (and any partial batches) have been delivered.
+        with self.condition:
+            self.closed = True
+            self.close_callback = callback
+            self.condition.notify_all()
+
+    def _get_wait_time(self):
+        # How long until the oldest batch is due, or None if there are no batches waiting
+        if self.batch_interval is None or not self.batch_start_times:
+            return None
+        return max(0, min(self.batch_start_times.values()) + self.batch_interval - time.monotonic())
+
+    def _run(self):
+        while True:
+            with self.condition:
+                while not self.queue and not self.closed:
+                    wait_time = self._get_wait_time()
+                    if wait_time == 0:
+                        break
+                    self.condition.wait(wait_time)
+                # Lines are only taken from the queue as they are about to be delivered, so that it
+                # bounds everything which has not been delivered yet
+                take = self.batch_size or (len(self.queue) if self.batching else 1)
+                items = [self.queue.popleft() for i in range(min(take, len(self.queue)))]
+                finished = self.closed and not self.queue
+                if len(self.queue) < self.queue_size:
+                    for stream in list(self.paused_streams):
+                        self.paused_streams.remove(stream)
+                        self.resume(stream)
+                self.condition.notify_all()
+
+            for stream, line in items:
+                if not self.batching:
+                    self._deliver(stream, line)
+                    continue
+                if not self.batches[stream]:
+                    self.batch_start_times[stream] = time.monotonic()
+                self.batches[stream].append(line)
+                if self.batch_size is not None and len(self.batches[stream]) >= self.batch_size:
+                    self._deliver_batch(stream)
+            for stream in list(self.batch_start_times.keys()):
+                if finished or (self.batch_interval is not None and time.monotonic() - self.batch_start_times[stream] >= self.batch_interval):
+                    self._deliver_batch(stream)
+
+            if finished:
+                self.close_callback()
+                return
+
+    def _deliver_batch(self, stream):
+        lines = self.batches[stream]
+        self.batches[stream] = []
+        del self.batch_start_times[stream]
+        self._deliver(stream, lines)
+
+    def _deliver(self, stream, data):
+        for func in self.async_buffer_funcs[stream]:
+            # A broken callback must not stop the others from being called
+            try:
+                func(data)
+            except Exception:
+                logger.exception("An error occurred in a shell command callback.")
+        with self.condition:
+            self.dispatched += len(data) if self.batching else 1
+            if self.batching:
+                self.batch_count += 1
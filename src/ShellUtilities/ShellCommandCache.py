@@ -0,0 +1,202 @@
+import collections
+import concurrent.futures
+import threading
+import tempfile
+import hashlib
+import logging
+import json
+import time
+import os
+from ShellUtilities import Shell
+from ShellUtilities.ShellCommandResults import ShellCommandResults
+
+
+logger = logging.getLogger(__name__)
+
+
+class ShellCommandCache():
+
+    # Memoizes the results of idempotent commands (uname -r, nproc, git rev-parse HEAD, etc.) so that
+    # they only have to be run once. Commands are cached on the command along with its env, cwd,
+    # executable and any other arguments passed to execute_shell_command(). Only successful results
+    # are cached; failures are raised as usual and the command is run again next time.
+    #
+    # The results are kept in memory in least recently used order. At most max_entries results are
+    # kept and, when max_bytes is given, the output of all of them is limited to that many characters.
+    # Results older than ttl seconds are discarded. When a path is given the results are also stored
+    # in that directory, one file per command, so that they survive restarts and can be shared between
+    # processes.
+    #
+    # If a command is already being run for another thread, the caller waits for that result rather
+    # than running the command a second time.
+
+    def __init__(self, max_entries=1024, max_bytes=None, ttl=None, path=None):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self.path = path
+        if path:
+            os.makedirs(path, exist_ok=True)
+        self.lock = threading.Lock()
+        # The key of each command mapped to an (expiry time, results) tuple
+        self.entries = collections.OrderedDict()
+        self.entry_bytes = 0
+        # The commands which are currently being run mapped to a future for their results
+        self.pending = {}
+        self.hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+        self.coalesced = 0
+        self.evictions = 0
+
+    def stats(self):
+        with self.lock:
+            return {
+                "hits": self.hits,
+                "disk_hits": self.disk_hits,
+                "misses": self.misses,
+                "coalesced": self.coalesced,
+                "evictions": self.evictions,
+                "entries": len(self.entries),
+                "bytes": self.entry_bytes
+            }
+
+    def _get_key(self, command, env, cwd, executable, kwargs):
+        key = json.dumps([command, env, cwd, executable, kwargs], sort_keys=True, default=repr)
+        return hashlib.sha256(key.encode()).hexdigest()
+
+    def _get_file_path(self, key):
+        return os.path.join(self.path, key + ".json")
+
+    def _get_size(self, shell_command_results):
+        return len(shell_command_results.Stdout) + len(shell_command_results.Stderr)
+
+    def _add_entry(self, key, expiry_time, shell_command_results):
+        # Must be called with the lock held
+        self._remove_entry(key)
+        self.entries[key] = (expiry_time, shell_command_results)
+        self.entry_bytes += self._get_size(shell_command_results)
+        while self.entries and (len(self.entries) > self.max_entries or (self.max_bytes is not None and self.entry_bytes > self.max_bytes)):
+            self._remove_entry(next(iter(self.entries)))
+            self.evictions += 1
+
+    def _remove_entry(self, key):
+        # Must be called with the lock held
+        entry = self.entries.pop(key, None)
+        if entry:
+            self.entry_bytes -= self._get_size(entry[1])
+
+    def _get_entry(self, key):
+        # Must be called with the lock held. Returns the cached results or None.
+        entry = self.entries.get(key)
+        if entry is None:
+            return None
+        expiry_time, shell_command_results = entry
+        if expiry_time is not None and expiry_time <= time.time():
+            self._remove_entry(key)
+            return None
+        self.entries.move_to_end(key)
+        return shell_command_results
+
+    def _load(self, key):
+        # Returns the expiry time and results stored on disk for the key, or None if there are none
+        try:
+            with open(self._get_file_path(key)) as file:
+                data = json.load(file)
+        except (OSError, ValueError):
+            return None
+        if data["expiry_time"] is not None and data["expiry_time"] <= time.time():
+            return None
+        return data["expiry_time"], ShellCommandResults(data["command"], data["stdout"], data["stderr"], data["exitcode"])
+
+    def _store(self, key, expiry_time, shell_command_results):
+        data = {
+            "command": shell_command_results.Command,
+            "stdout": shell_command_results.Stdout,
+            "stderr": shell_command_results.Stderr,
+            "exitcode": shell_command_results.ExitCode,
+            "expiry_time": expiry_time
+        }
+        # Write to a temporary file and rename it so that readers never see a partial file
+        try:
+            with tempfile.NamedTemporaryFile("w", dir=self.path, suffix=".tmp", delete=False) as file:
+                json.dump(data, file)
+            os.replace(file.name, self._get_file_path(key))
+        except OSError:
+            logger.exception("Unable to store the results of the shell command in the cache.")
+
+    def execute_shell_command(self, command, env=None, cwd=None, executable=None, **kwargs):
+
+        # Returns the cached results of the command, running it with Shell.execute_shell_command() if
+        # there are none. Any other keyword arguments are passed through to execute_shell_command().
+
+        if kwargs.get("blocking") is False or kwargs.get("binary"):
+            raise Exception("Only the results of blocking commands with text output can be cached.")
+
+        key = self._get_key(command, env, cwd, executable, kwargs)
+
+        with self.lock:
+            shell_command_results = self._get_entry(key)
+            if shell_command_results is not None:
+                self.hits += 1
+                return shell_command_results
+            future = self.pending.get(key)
+            leader = future is None
+            if leader:
+                future = concurrent.futures.Future()
+                self.pending[key] = future
+            else:
+                self.coalesced += 1
+
+        if not leader:
+            return future.result()
+
+        try:
+            entry = self._load(key) if self.path else None
+            if entry is not None:
+                with self.lock:
+                    self.disk_hits += 1
+                expiry_time, shell_command_results = entry
+            else:
+                with self.lock:
+                    self.misses += 1
+                shell_command_results = Shell.execute_shell_command(command, env=env, cwd=cwd, executable=executable, **kwargs)
+                # Only keep the output; the buffers of the results may hold on to much more than that
+                shell_command_results = ShellCommandResults(shell_command_results.Command, shell_command_results.Stdout, shell_command_results.Stderr, shell_command_results.ExitCode)
+                expiry_time = time.time() + self.ttl if self.ttl is not None else None
+                if self.path:
+                    self._store(key, expiry_time, shell_command_results)
+            with self.lock:
+                self._add_entry(key, expiry_time, shell_command_results)
+                del self.pending[key]
+            future.set_result(shell_command_results)
+            return shell_command_results
+        except Exception as ex:
+            with self.lock:
+                del self.pending[key]
+            future.set_exception(ex)
+            raise
+
+    def invalidate(self, command, env=None, cwd=None, executable=None, **kwargs):
+        # Discard the results of a command. The arguments must match those it was run with.
+        key = self._get_key(command, env, cwd, executable, kwargs)
+        with self.lock:
+            self._remove_entry(key)
+            if self.path:
+                try:
+                    os.remove(self._get_file_path(key))
+                except FileNotFoundError:
+                    pass
+
+    def clear(self):
+        # Discard all of the cached results
+        with self.lock:
+            self.entries.clear()
+            self.entry_bytes = 0
+            if self.path:
+                for file_name in os.listdir(self.path):
+                    if file_name.endswith(".json"):
+                        try:
+                            os.remove(os.path.join(self.path, file_name))
+                        except FileNotFoundError:
+                            pass
@@ -1,16 +1,36 @@
 class ShellCommandException(Exception):
 
-    def __init__(self, command, stdout, stderr, exitcode):
+    def __init__(self, command, stdout, stderr, exitcode, metrics=None):
         self.Command = command
         self.Stdout = stdout
         self.Stderr = stderr
         self.ExitCode = exitcode
+        # The ShellCommandMetrics of the failed command, where they were recorded
+        self.Metrics = metrics
 
         msg = stderr
         if not stderr:
             msg = stdout
         super(ShellCommandException, self).__init__(msg)
         
+class ShellCommandTimeoutException(ShellCommandException):
+
+    def __init__(self, command, stdout, stderr, exitcode, timeout, metrics=None):
+        # Raised when a command is killed for running longer than it was allowed to. The stdout and
+        # stderr contain whatever output it produced before it was killed.
+        self.Timeout = timeout
+        super().__init__(command, stdout, stderr, exitcode, metrics)
+
+    def __str__(self):
+        return "The shell command timed out after {0:.3f} seconds.".format(self.Timeout)
+
+class ShellPipelineException(ShellCommandException):
+
+    def __init__(self, command, stdout, stderr, exitcode, stages):
+        # Raised when a stage of a pipeline fails. The results of every stage are in Stages.
+        self.Stages = stages
+        super().__init__(command, stdout, stderr, exitcode)
+
 class AsynchronousShellCommandException(ShellCommandException):
     
     def __init__(self, async_command_results):
@@ -24,9 +44,26 @@ class AsynchronousShellCommandException(ShellCommandException):
         self.stdout_thread = async_command_results.stdout_thread
         self.stderr_thread = async_command_results.stderr_thread
         
+        # Depending on the output retention policy this may only be the tail of the output
+        with self.stdout_lock:
+            stdout = async_command_results.stdout_buffer.diagnostic_text()
+        with self.stderr_lock:
+            stderr = async_command_results.stderr_buffer.diagnostic_text()
+
         super().__init__(
             async_command_results.Command,
-            async_command_results.Stdout,
-            async_command_results.Stderr,
-            async_command_results.ExitCode
-        )
\ No newline at end of file
+            stdout,
+            stderr,
+            async_command_results.ExitCode,
+            async_command_results.Metrics
+        )
+
+class ShellCommandBatchException(Exception):
+
+    def __init__(self, exceptions):
+        # The individual exceptions raised by the commands in the batch. Where the failure was
+        # the result of a non-zero exit code these will be ShellCommandExceptions.
+        self.Exceptions = exceptions
+
+        msg = "{0} shell command(s) in the batch failed.".format(len(exceptions))
+        super(ShellCommandBatchException, self).__init__(msg)
@@ -0,0 +1,170 @@
+import subprocess
+import threading
+import logging
+import time
+import sys
+import os
+
+
+logger = logging.getLogger(__name__)
+
+
+class ShellCommandMetrics():
+
+    # The resources used by a single run of a command. All of the times are in seconds and are
+    # measured from just before the process was created:
+    #   SpawnLatency       - how long it took to create the process
+    #   TimeToFirstOutput  - when the first output was read from either stream (None if there was none)
+    #   WallTime           - when the process had exited and all of its output had been read
+    #   UserTime/SystemTime/MaxRss - the CPU time and peak resident set size (in bytes) of the process
+    #                        and any children it waited for, from wait4(). These are None where they
+    #                        are not available (e.g. for commands run with asyncio). On linux the
+    #                        MaxRss includes the peak resident set size of the parent from before the
+    #                        exec, so it is never less than the memory used by the python process
+    #                        which created the command (or by the ShellForkServer, which stays small).
+    #   Stdout/StderrByteCount, Stdout/StderrLineCount - the amount of output written to each stream
+    #
+    # The metrics are attached to the results (and exceptions) of a command and passed to any sinks
+    # registered with add_metrics_sink() once the command completes (see publish_metrics()).
+
+    def __init__(self, command):
+        self.Command = command
+        self.ExitCode = None
+        self.SpawnLatency = None
+        self.TimeToFirstOutput = None
+        self.WallTime = None
+        self.UserTime = None
+        self.SystemTime = None
+        self.MaxRss = None
+        self.StdoutByteCount = 0
+        self.StderrByteCount = 0
+        self.StdoutLineCount = 0
+        self.StderrLineCount = 0
+        self.start_time = time.monotonic()
+        # Whether the last chunk read from each stream ended part way through a line
+        self.partial_lines = {"stdout": False, "stderr": False}
+
+    def record_spawn(self):
+        self.SpawnLatency = time.monotonic() - self.start_time
+
+    def record_output(self, stream, buffer, byte_count):
+        # Called with the buffer each chunk of output was read into (the chunk is at the start of it).
+        # The stdout and stderr may be read on different threads, but each stream only updates its
+        # own counters.
+        if self.TimeToFirstOutput is None:
+            self.TimeToFirstOutput = time.monotonic() - self.start_time
+        line_count = buffer.count(b"\n", 0, byte_count)
+        self.partial_lines[stream] = buffer[byte_count - 1] != 10
+        if stream == "stdout":
+            self.StdoutByteCount += byte_count
+            self.StdoutLineCount += line_count
+        else:
+            self.StderrByteCount += byte_count
+            self.StderrLineCount += line_count
+
+    def record_rusage(self, rusage):
+        self.UserTime = rusage.ru_utime
+        self.SystemTime = rusage.ru_stime
+        # The maximum resident set size is reported in kilobytes on linux and bytes on macOS
+        self.MaxRss = rusage.ru_maxrss if sys.platform == "darwin" else rusage.ru_maxrss * 1024
+
+    def record_completion(self, exitcode):
+        self.ExitCode = exitcode
+        self.WallTime = time.monotonic() - self.start_time
+        # A final line which is not terminated by a newline still counts
+        if self.partial_lines["stdout"]:
+            self.StdoutLineCount += 1
+        if self.partial_lines["stderr"]:
+            self.StderrLineCount += 1
+
+
+def reap_process(process, metrics=None, block=True):
+
+    # Wait for the process to exit and reap it with wait4() so that the resources it used can be
+    # recorded in the metrics. Returns the exit code, or None if block is False and the process is
+    # still running.
+
+    if process.returncode is not None:
+        return process.returncode
+
+    # Processes created by a ShellForkServer are not our children; it reports their usage instead
+    if not isinstance(process, subprocess.Popen):
+        returncode = process.wait() if block else process.poll()
+        if returncode is not None and metrics and getattr(process, "rusage", None):
+            metrics.record_rusage(process.rusage)
+        return returncode
+
+    # Hold the lock subprocess uses to reap the process, so that a poll() or wait() on another thread
+    # can not reap it at the same time (it would get ECHILD and report an exit code of 0). If another
+    # thread holds it, that thread is reaping the process.
+    if not process._waitpid_lock.acquire(block):
+        return None
+    try:
+        if process.returncode is not None:
+            return process.returncode
+        try:
+            pid, status, rusage = os.wait4(process.pid, 0 if block else os.WNOHANG)
+        except ChildProcessError:
+            pid = None
+        if pid == 0:
+            return None
+        if pid is not None:
+            process.returncode = os.waitstatus_to_exitcode(status)
+            if metrics:
+                metrics.record_rusage(rusage)
+            return process.returncode
+    finally:
+        process._waitpid_lock.release()
+    # Something other than subprocess has already reaped it
+    return process.wait() if block else process.poll()
+
+
+def wait_for_exit(process, timeout):
+
+    # Wait up to timeout seconds for the process to exit without reaping it (so that reap_process()
+    # can still get its resource usage). Like subprocess.Popen.wait() this polls with an increasing
+    # delay. Raises subprocess.TimeoutExpired if the process is still running.
+
+    if not isinstance(process, subprocess.Popen):
+        process.wait(timeout)
+        return
+    end_time = time.monotonic() + timeout
+    delay = 0.0005
+    while True:
+        try:
+            if os.waitid(os.P_PID, process.pid, os.WEXITED | os.WNOWAIT | os.WNOHANG) is not None:
+                return
+        except ChildProcessError:
+            return
+        remaining = end_time - time.monotonic()
+        if remaining <= 0:
+            raise subprocess.TimeoutExpired(process.args, timeout)
+        delay = min(delay * 2, remaining, 0.05)
+        time.sleep(delay)
+
+
+_metrics_sinks = []
+_metrics_sinks_lock = threading.Lock()
+
+
+def add_metrics_sink(func):
+    # Register a function which is called with the ShellCommandMetrics of every command (and of every
+    # attempt of a retried command) once it completes. It may be called from any thread.
+    with _metrics_sinks_lock:
+        _metrics_sinks.append(func)
+
+
+def remove_metrics_sink(func):
+    with _metrics_sinks_lock:
+        _metrics_sinks.remove(func)
+
+
+def publish_metrics(metrics):
+    with _metrics_sinks_lock:
+        metrics_sinks = list(_metrics_sinks)
+    for func in metrics_sinks:
+        # A broken sink must not break the command
+        try:
+            func(metrics)
+        except Exception:
+            logger.exception("An error occurred in a shell command metrics sink.")
@@ -1,65 +1,487 @@
 import threading
-import os
 import time
-from ShellUtilities.ShellCommandException import AsynchronousShellCommandException
+import logging
+import collections
+import itertools
+import re
+from ShellUtilities.ShellCommandException import AsynchronousShellCommandException, ShellCommandBatchException
+from ShellUtilities.ShellOutputBuffer import create_shell_output_buffer, FileShellOutputBuffer
+from ShellUtilities.ShellOutputReader import ShellOutputLineSplitter, read_until_eof
+from ShellUtilities.ShellCommandMetrics import reap_process, publish_metrics
+from ShellUtilities.ShellCallbackDispatcher import ShellCallbackDispatcher
+
+
+logger = logging.getLogger(__name__)
+
+
+def _close_buffers(*buffers):
+    # Only the buffers which keep the output in a file have anything to release
+    for buffer in buffers:
+        if hasattr(buffer, "close"):
+            buffer.close()
+
+
+def _raw_output(buffer, binary):
+    if not binary:
+        raise Exception("The raw output of a command is only retained in binary mode.")
+    if hasattr(buffer, "bytes"):
+        return buffer.bytes()
+    return b""
+
+
+class _PatternWaiter():
+
+    # A caller of wait_for() waiting for a line of one of the streams to match the pattern
+
+    def __init__(self, pattern, streams, retain_output=True):
+        self.pattern = pattern
+        self.streams = streams
+        self.retain_output = retain_output
+        self.event = threading.Event()
+        self.match = None
+
 
 class ShellCommandResults():
 
-    def __init__(self, command, stdout, stderr, exitcode):
+    def __init__(self, command, stdout, stderr, exitcode, metrics=None):
         self.Command = command
         self.Stdout = stdout
         self.Stderr = stderr
         self.ExitCode = exitcode
+        # The ShellCommandMetrics of the command, where they were recorded
+        self.Metrics = metrics
+
+    def close(self):
+        # Release the files (and file descriptors) behind the output of the command, if there are
+        # any. The output which was not kept in memory can not be accessed afterwards. The results
+        # can also be used as a context manager which closes them on exit.
+        pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+class BufferedShellCommandResults(ShellCommandResults):
+
+    # The results of a blocking command whose output was retained according to an output retention
+    # policy. The Stdout and Stderr are only built from the buffers when they are accessed.
+
+    def __init__(self, command, stdout_buffer, stderr_buffer, exitcode, binary=False, metrics=None):
+        self.Command = command
+        self.Metrics = metrics
+        self.stdout_buffer = stdout_buffer
+        self.stderr_buffer = stderr_buffer
+        self.stdout_lines = stdout_buffer.lines
+        self.stderr_lines = stderr_buffer.lines
+        self.ExitCode = exitcode
+        self.binary = binary
+
+    @property
+    def Stdout(self):
+        if self.binary:
+            return self.stdout_buffer.text(final=True).rstrip("\n")
+        return self.stdout_buffer.text().rstrip("\n")
+
+    @property
+    def Stderr(self):
+        if self.binary:
+            return self.stderr_buffer.text(final=True).rstrip("\n")
+        return self.stderr_buffer.text().rstrip("\n")
+
+    # The raw output is only available in binary mode. Use memoryview() to slice it without copying.
+    @property
+    def StdoutBytes(self):
+        return _raw_output(self.stdout_buffer, self.binary)
+
+    @property
+    def StderrBytes(self):
+        return _raw_output(self.stderr_buffer, self.binary)
+
+    def close(self):
+        _close_buffers(self.stdout_buffer, self.stderr_buffer)
+
 
 class AsynchronousShellCommandResults(ShellCommandResults):
 
-    def __init__(self, command, process, async_buffer_funcs):
+    def __init__(self, command, process, async_buffer_funcs, reactor=None, output_retention="all", output_retention_limit=None, line_queue_size=None, binary=False, encoding="utf-8", errors="strict", metrics=None, stdout_buffer=None, stderr_buffer=None, callback_queue_size=None, callback_overflow="block", callback_batch_size=None, callback_batch_interval=None, input_writer=None):
         # Create vars for handling process output
         self.process = process
-        self.stdout_lines = []
-        self.stderr_lines = []
-        self.stdout_lock = threading.Lock()
-        self.stderr_lock = threading.Lock()
+        self.Metrics = metrics
+        # In binary mode the raw chunks are retained and passed to the async_buffer_funcs rather
+        # than lines. The text is only decoded when Stdout or Stderr are accessed.
+        self.binary = binary
+        self.encoding = encoding
+        self.errors = errors
+        # The buffers of streams which are redirected to files are supplied (see FileShellOutputBuffer)
+        if stdout_buffer is None:
+            stdout_buffer = create_shell_output_buffer(output_retention, output_retention_limit, binary, encoding, errors)
+        if stderr_buffer is None:
+            stderr_buffer = create_shell_output_buffer(output_retention, output_retention_limit, binary, encoding, errors)
+        self.stdout_buffer = stdout_buffer
+        self.stderr_buffer = stderr_buffer
+        self.stdout_lines = self.stdout_buffer.lines
+        self.stderr_lines = self.stderr_buffer.lines
+        self.stdout_lock = threading.RLock()
+        self.stderr_lock = threading.RLock()
         self.pid = process.pid
         self.stdout_thread = None
         self.stderr_thread = None
         self.async_buffer_funcs = async_buffer_funcs
+        # Writes the input of the command (if any) to its stdin
+        self.input_writer = input_writer
+        # When a callback queue size is supplied the async_buffer_funcs are called on a dispatcher
+        # thread rather than on the thread which reads the output (see ShellCallbackDispatcher)
+        self.callback_dispatcher = None
+        if callback_queue_size is not None:
+            self.callback_dispatcher = ShellCallbackDispatcher(async_buffer_funcs, callback_queue_size, callback_overflow, callback_batch_size, callback_batch_interval, self._pause_stream, self._resume_callback_stream)
+        # When a reactor is supplied the pipes are serviced by its shared thread rather than by
+        # a pair of threads dedicated to this process
+        self.reactor = reactor
+        self.reactor_registration = None
+        # Set once the process has exited and all of its output has been handled
+        self.output_complete = threading.Event()
+        self.done_callbacks = []
+        # Only the streams which are piped (rather than redirected to a file) are read
+        self.stream_filenos = {stream: file.fileno() for stream, file in [("stdout", process.stdout), ("stderr", process.stderr)] if file is not None}
+        # When a line queue size is supplied the lines are also queued up to be consumed through
+        # iter_lines() etc. The queues are bounded; once one is full the stream stops being read
+        # until the consumer catches up.
+        self.line_queue_size = line_queue_size
+        self.line_condition = threading.Condition()
+        self.line_queues = {"stdout": collections.deque(), "stderr": collections.deque()} if line_queue_size else {}
+        self.line_sequence = itertools.count()
+        self.paused_streams = set()
+        # The callers of wait_for() which are waiting for a line to match their pattern, and the
+        # streams whose output is still being retained (see stop_output_retention())
+        self.pattern_lock = threading.Lock()
+        self.pattern_waiters = []
+        self.pattern_waiters_closed = False
+        self.retained_streams = {"stdout", "stderr"}
         
-        # Call the parent constructor
-        stdout = ""
-        stderr = ""
-        exitcode = -1
-        super().__init__(command, stderr, stdout, exitcode)
+        # The Stdout and Stderr are built lazily from the buffers (see the properties below)
+        # so the parent constructor is not used to initialize them
+        self.Command = command
+        self.ExitCode = -1
         
         # Start handling the asynchronous output
         self.handle_asynchronous_output(self.process)
     
-    # This function will be automatgically wired up to fire whenever a line is read from the stdout buffer
-    # of the process that is created.
-    def _handle_stdout_line(self, line):
+    @property
+    def Stdout(self):
+        with self.stdout_lock:
+            if self.binary:
+                return self.stdout_buffer.text(final=self.output_complete.is_set())
+            return self.stdout_buffer.text()
+
+    @property
+    def Stderr(self):
+        with self.stderr_lock:
+            if self.binary:
+                return self.stderr_buffer.text(final=self.output_complete.is_set())
+            return self.stderr_buffer.text()
+
+    @property
+    def StdoutBytes(self):
+        with self.stdout_lock:
+            return _raw_output(self.stdout_buffer, self.binary)
+
+    @property
+    def StderrBytes(self):
+        with self.stderr_lock:
+            return _raw_output(self.stderr_buffer, self.binary)
+
+    # These functions will be automatgically wired up to fire whenever a batch of lines is read from the
+    # stdout or stderr buffer of the process that is created. The lock is only taken once per batch.
+    def _handle_stdout_lines(self, lines):
         try:
             self.stdout_lock.acquire()
-            # Append to the default output array
-            self.stdout_lines.append(line)
-            # Append to the default string
-            self.Stdout += line + os.linesep
+            # Append to the default output buffer
+            if "stdout" in self.retained_streams or isinstance(self.stdout_buffer, FileShellOutputBuffer):
+                self.stdout_buffer.extend(lines)
             # Call any attached methods
-            if "stdout" in self.async_buffer_funcs.keys():
-                for func in self.async_buffer_funcs["stdout"]:
-                    func(line)
+            if "stdout" in self.async_buffer_funcs.keys() and not self.callback_dispatcher:
+                self._call_async_buffer_funcs("stdout", lines)
+            if self.pattern_waiters:
+                self._match_lines("stdout", lines)
         finally:
             self.stdout_lock.release()
-            
-    def _handle_stderr_line(self, line):
+        # These may block so they must be done without holding the lock
+        if self.callback_dispatcher:
+            self.callback_dispatcher.put("stdout", lines, block=self.reactor is None)
+        if self.line_queues:
+            self._enqueue_lines("stdout", lines)
+
+    def _call_async_buffer_funcs(self, stream, lines):
+        # A broken callback must not stop the others from being called or the output from being read
+        for func in self.async_buffer_funcs[stream]:
+            for line in lines:
+                try:
+                    func(line)
+                except Exception:
+                    logger.exception("An error occurred in a shell command callback.")
+
+    def _handle_stderr_lines(self, lines):
         try:
             self.stderr_lock.acquire()
-            self.stderr_lines.append(line)
-            self.Stderr += line + os.linesep
-            if "stderr" in self.async_buffer_funcs.keys():
-                for func in self.async_buffer_funcs["stderr"]:
-                    func(line)
+            if "stderr" in self.retained_streams or isinstance(self.stderr_buffer, FileShellOutputBuffer):
+                self.stderr_buffer.extend(lines)
+            if "stderr" in self.async_buffer_funcs.keys() and not self.callback_dispatcher:
+                self._call_async_buffer_funcs("stderr", lines)
+            if self.pattern_waiters:
+                self._match_lines("stderr", lines)
         finally:
             self.stderr_lock.release()
+        if self.callback_dispatcher:
+            self.callback_dispatcher.put("stderr", lines, block=self.reactor is None)
+        if self.line_queues:
+            self._enqueue_lines("stderr", lines)
+
+    def _match_lines(self, stream, lines):
+        # Called with the lock of the stream held, so each line is only matched once
+        with self.pattern_lock:
+            for waiter in list(self.pattern_waiters):
+                if stream not in waiter.streams:
+                    continue
+                for line in lines:
+                    match = waiter.pattern.search(line)
+                    if match:
+                        waiter.match = match
+                        # Stop retaining the output straight away rather than once the waiter wakes up
+                        if not waiter.retain_output:
+                            self.retained_streams.clear()
+                        waiter.event.set()
+                        self.pattern_waiters.remove(waiter)
+                        break
+
+    def wait_for(self, pattern, stream="stdout", timeout=None, retain_output=True):
+
+        # Waits until a line written to the stream ("stdout", "stderr" or "any") matches the regular
+        # expression (a string or a compiled pattern) and returns the re.Match. This is intended for
+        # waiting for a server or daemon to become ready. The lines which have already been retained are
+        # searched first; after that each line is only matched once, as it is read. Returns None if the
+        # timeout (in seconds) expires first and raises an exception if the command completes without
+        # a match.
+        #
+        # When retain_output is False, the output stops being retained once the pattern has matched
+        # (see stop_output_retention()) so that a long running command does not keep growing. The rest
+        # of the batch of lines containing the match is still retained.
+
+        if self.binary:
+            raise Exception("Output can only be matched in text mode.")
+        if stream not in ["stdout", "stderr", "any"]:
+            raise Exception("Unknown stream '{0}'.".format(stream))
+        streams = ["stdout", "stderr"] if stream == "any" else [stream]
+        if not any(stream in self.stream_filenos for stream in streams):
+            raise Exception("Output which is redirected to a file can not be matched.")
+        waiter = _PatternWaiter(re.compile(pattern), streams, retain_output)
+
+        # Hold the locks (always in the same order) so that no lines are handled while the retained
+        # ones are searched
+        with self.stdout_lock, self.stderr_lock:
+            for stream in streams:
+                for line in (self.stdout_lines if stream == "stdout" else self.stderr_lines):
+                    waiter.match = waiter.pattern.search(line)
+                    if waiter.match:
+                        break
+                if waiter.match:
+                    break
+            if not waiter.match:
+                with self.pattern_lock:
+                    if self.pattern_waiters_closed:
+                        waiter.event.set()
+                    else:
+                        self.pattern_waiters.append(waiter)
+
+        if not waiter.match and not waiter.event.wait(timeout) and not waiter.match:
+            with self.pattern_lock:
+                if waiter in self.pattern_waiters:
+                    self.pattern_waiters.remove(waiter)
+            return None
+        if not waiter.match:
+            raise Exception("The shell command exited with code {0} before its output matched '{1}'.".format(self.ExitCode, waiter.pattern.pattern))
+        if not retain_output:
+            self.stop_output_retention()
+        return waiter.match
+
+    def stop_output_retention(self, streams=["stdout", "stderr"]):
+        # Stop adding the lines read from the streams to the buffers. The output which has already
+        # been retained is kept. Callbacks, line iteration and wait_for() are not affected, and output
+        # which is redirected to a file is still written to it.
+        for stream in streams:
+            with (self.stdout_lock if stream == "stdout" else self.stderr_lock):
+                self.retained_streams.discard(stream)
+
+    def _handle_stdout_line(self, line):
+        self._handle_stdout_lines([line])
+
+    def _handle_stderr_line(self, line):
+        self._handle_stderr_lines([line])
+
+    def _handle_output_complete(self):
+        # This is called (on the reader thread or the reactor thread) once the process has exited and
+        # all of its output has been read. Anybody waiting for the command is notified straight away.
+
+        # Make sure we have cleaned up and dont see any warnings like:
+        # ResourceWarning: unclosed file <_io.BufferedReader name=4>
+        for file in [self.process.stdout, self.process.stderr]:
+            if file is not None:
+                file.close()
+        with self.stdout_lock:
+            if isinstance(self.stdout_buffer, FileShellOutputBuffer):
+                self.stdout_buffer.finish()
+        with self.stderr_lock:
+            if isinstance(self.stderr_buffer, FileShellOutputBuffer):
+                self.stderr_buffer.finish()
+
+        # The command is not complete until the dispatcher has delivered all of the lines to the callbacks
+        if self.callback_dispatcher:
+            self.callback_dispatcher.close(self._notify_output_complete)
+        else:
+            self._notify_output_complete()
+
+    def _notify_output_complete(self):
+        self.ExitCode = self.process.returncode
+        # Anybody still waiting for a pattern will not get a match
+        with self.pattern_lock:
+            pattern_waiters = self.pattern_waiters
+            self.pattern_waiters = []
+            self.pattern_waiters_closed = True
+        for waiter in pattern_waiters:
+            waiter.event.set()
+        # The metrics are published before anybody waiting is woken up, as they are for blocking commands
+        if self.Metrics:
+            self.Metrics.record_completion(self.ExitCode)
+            publish_metrics(self.Metrics)
+
+        with self.line_condition:
+            self.output_complete.set()
+            self.line_condition.notify_all()
+            done_callbacks = self.done_callbacks
+            self.done_callbacks = []
+        for func in done_callbacks:
+            self._invoke_done_callback(func)
+
+    def _invoke_done_callback(self, func):
+        try:
+            func(self)
+        except Exception:
+            logger.exception("An error occurred in a shell command done callback.")
+
+    def add_done_callback(self, func):
+        # The function will be called with the results once the command has completed. It runs on the
+        # thread which handled the output of the command, or immediately if it has already completed.
+        with self.line_condition:
+            if not self.output_complete.is_set():
+                self.done_callbacks.append(func)
+                return
+        self._invoke_done_callback(func)
+
+    def remove_done_callback(self, func):
+        with self.line_condition:
+            if func in self.done_callbacks:
+                self.done_callbacks.remove(func)
+
+    def _stream_fileno(self, stream):
+        return self.stream_filenos[stream]
+
+    def _enqueue_lines(self, stream, lines):
+        with self.line_condition:
+            # The consumer is only iterating over the other stream
+            if stream not in self.line_queues:
+                return
+            line_queue = self.line_queues[stream]
+            if self.reactor:
+                # The reactor thread must never block. Instead the pipe is paused once the queue is
+                # full; the queue may overshoot by the remainder of the chunk which was just read.
+                line_queue.extend([(next(self.line_sequence), line) for line in lines])
+                if len(line_queue) >= self.line_queue_size and stream not in self.paused_streams:
+                    self.paused_streams.add(stream)
+                    self.reactor.pause(self.reactor_registration, self._stream_fileno(stream))
+            else:
+                for line in lines:
+                    while len(line_queue) >= self.line_queue_size and stream in self.line_queues:
+                        self.line_condition.notify_all()
+                        self.line_condition.wait()
+                    line_queue.append((next(self.line_sequence), line))
+            self.line_condition.notify_all()
+
+    def _iter_queued_lines(self, streams):
+        if not self.line_queue_size:
+            raise Exception("Line iteration must be enabled by passing line_queue_size when executing the command.")
+
+        # Stop queueing the streams which are not being iterated over so they cannot block the reader
+        with self.line_condition:
+            for stream in ["stdout", "stderr"]:
+                if stream not in streams and stream in self.line_queues:
+                    del self.line_queues[stream]
+                    self._resume_stream(stream)
+            self.line_condition.notify_all()
+
+        try:
+            while True:
+                with self.line_condition:
+                    while True:
+                        available_streams = [stream for stream in streams if self.line_queues.get(stream)]
+                        if available_streams or self.output_complete.is_set():
+                            break
+                        self.line_condition.wait()
+                    if not available_streams:
+                        return
+                    # Hand the lines out in the order they were read
+                    stream = min(available_streams, key=lambda stream: self.line_queues[stream][0][0])
+                    sequence, line = self.line_queues[stream].popleft()
+                    if len(self.line_queues[stream]) < self.line_queue_size:
+                        self._resume_stream(stream)
+                    self.line_condition.notify_all()
+                yield stream, line
+        finally:
+            # Once the consumer stops iterating (e.g. breaks out of the loop) nobody will empty the
+            # queues, so the streams stop being queued rather than blocking the reader forever
+            with self.line_condition:
+                for stream in streams:
+                    if stream in self.line_queues:
+                        del self.line_queues[stream]
+                        self._resume_stream(stream)
+                self.line_condition.notify_all()
+
+    def _pause_stream(self, stream):
+        # The registration is only known once the reactor has been registered with
+        with self.line_condition:
+            self.reactor.pause(self.reactor_registration, self._stream_fileno(stream))
+
+    def _resume_callback_stream(self, stream):
+        # The consumer of the line queue may still want the stream to be paused
+        with self.line_condition:
+            if stream not in self.paused_streams:
+                self.reactor.resume(self.reactor_registration, self._stream_fileno(stream))
+
+    def callback_stats(self):
+        # The number of lines which have been dispatched to the async_buffer_funcs, dropped, or delayed
+        # by a full callback queue, along with the number which are queued and of batches delivered
+        if not self.callback_dispatcher:
+            raise Exception("Callback dispatch must be enabled by passing callback_queue_size when executing the command.")
+        return self.callback_dispatcher.stats()
+
+    def _resume_stream(self, stream):
+        if stream in self.paused_streams:
+            self.paused_streams.remove(stream)
+            self.reactor.resume(self.reactor_registration, self._stream_fileno(stream))
+
+    def iter_lines(self):
+        # Yields a (stream, line) tuple for each line written to the stdout or stderr of the process
+        # as it arrives. The command must have been executed with a line_queue_size. If the consumer
+        # falls behind, the output stops being read and the process will block once the pipe is full.
+        yield from self._iter_queued_lines(["stdout", "stderr"])
+
+    def iter_stdout(self):
+        for stream, line in self._iter_queued_lines(["stdout"]):
+            yield line
+
+    def iter_stderr(self):
+        for stream, line in self._iter_queued_lines(["stderr"]):
+            yield line
         
     def handle_asynchronous_output(self, process):
 
@@ -101,44 +523,105 @@ class AsynchronousShellCommandResults(ShellCommandResults):
         #   https://stackoverflow.com/questions/375427/a-non-blocking-read-on-a-subprocess-pipe-in-python
         #
 
-        def handle_output_line(buffer, buffer_handler_func):
-            process_running = True
-            while process_running:
-                for line in iter(buffer.readline, b''):
-                    if line != b'':
-                        line = line.decode()
-                        line = line.rstrip("\n")
-                        buffer_handler_func(line)
-                process_running = process.poll() == None
-
-        self.stdout_thread = threading.Thread(target=handle_output_line, args=(process.stdout, self._handle_stdout_line))
-        self.stderr_thread = threading.Thread(target=handle_output_line, args=(process.stderr, self._handle_stderr_line))
-        self.stdout_thread.start()
-        self.stderr_thread.start()
+        # Rather than reading a line at a time with readline(), the threads read large chunks from the
+        # unbuffered pipe into a reusable buffer and split them into batches of lines.
+        # Streams which are redirected to files are not read; if neither of them is piped a single
+        # thread just waits for the process to exit.
+        pipes = [(file, handler, stream) for file, handler, stream in [(process.stdout, self._handle_stdout_lines, "stdout"), (process.stderr, self._handle_stderr_lines, "stderr")] if file is not None]
+        running_threads = [max(1, len(pipes))]
+        running_threads_lock = threading.Lock()
 
-    def command_running(self):
-        poll = self.process.poll()
-        if poll == None:
-            return True
-        return self.stdout_thread.is_alive() or self.stderr_thread.is_alive()
+        def handle_output_line(buffer, buffer_handler_func, stream):
+            try:
+                if buffer is not None:
+                    splitter = ShellOutputLineSplitter(buffer_handler_func, self.binary, self.encoding, self.errors)
+                    read_until_eof(buffer.raw, splitter, self.Metrics, stream)
+            except Exception:
+                logger.exception("An error occurred while reading the {0} of the shell command.".format(stream))
+            finally:
+                # The output is complete once both of the threads have finished and the process has
+                # exited, even if one of them failed
+                with running_threads_lock:
+                    running_threads[0] -= 1
+                    last_thread = running_threads[0] == 0
+                if last_thread:
+                    reap_process(process, self.Metrics)
+                    self._handle_output_complete()
+
+        if self.reactor:
+            # Hold the condition so that the reactor cannot try to pause a stream before we know the registration
+            with self.line_condition:
+                self.reactor_registration = self.reactor.register(process, self._handle_stdout_lines, self._handle_stderr_lines, self._handle_output_complete, self.binary, self.encoding, self.errors, self.Metrics)
+            return
 
-    def wait(self, raise_on_error=True):
+        threads = {stream: threading.Thread(target=handle_output_line, args=(file, handler, stream)) for file, handler, stream in pipes or [(None, None, None)]}
+        self.stdout_thread = threads.get("stdout")
+        self.stderr_thread = threads.get("stderr")
+        for thread in threads.values():
+            thread.start()
 
-        # This is a blocking function which will safely wait for the shell process and handling threads to complete
+    def command_running(self):
+        return not self.output_complete.is_set()
 
-        # Wait for the process to exit
-        self.process.wait()
+    def close(self):
+        # The output is still being written to the buffers until the command completes
+        self.wait(raise_on_error=False)
+        with self.stdout_lock, self.stderr_lock:
+            _close_buffers(self.stdout_buffer, self.stderr_buffer)
 
-        # Wait for the enqueing threads to complete
-        while self.stdout_thread.is_alive() or self.stderr_thread.is_alive():
-            time.sleep(0.01)
+    def wait(self, raise_on_error=True, timeout=None):
 
-        # Make sure we have cleaned up and dont see any warnings like:
-        # ResourceWarning: unclosed file <_io.BufferedReader name=4>
-        self.process.stdout.close()
-        self.process.stderr.close()
+        # This is a blocking function which will safely wait for the shell process and handling threads to
+        # complete. Rather than polling, it waits to be notified by whichever thread handles the output.
+        # Returns False if the timeout (in seconds) expires before the command completes.
+        if not self.output_complete.wait(timeout):
+            return False
 
-        self.ExitCode = self.process.returncode
-        
         if raise_on_error and self.ExitCode != 0:
             raise AsynchronousShellCommandException(self)
+        if raise_on_error and self.input_writer and self.input_writer.exception:
+            raise Exception("An error occurred while writing the input of the shell command.") from self.input_writer.exception
+        return True
+
+
+def wait_any(shell_command_results, timeout=None):
+
+    # Waits until any one of the non-blocking commands has completed and returns its results. Returns
+    # None if the timeout (in seconds) expires first.
+
+    completed = threading.Event()
+
+    def done_callback(results):
+        completed.set()
+
+    for results in shell_command_results:
+        results.add_done_callback(done_callback)
+    try:
+        completed.wait(timeout)
+    finally:
+        for results in shell_command_results:
+            results.remove_done_callback(done_callback)
+
+    for results in shell_command_results:
+        if results.output_complete.is_set():
+            return results
+    return None
+
+
+def wait_all(shell_command_results, timeout=None, raise_on_error=True):
+
+    # Waits until all of the non-blocking commands have completed. Returns False if the timeout (in
+    # seconds) expires first. If any of the commands failed a ShellCommandBatchException containing
+    # an AsynchronousShellCommandException for each of them is raised.
+
+    deadline = None if timeout is None else time.monotonic() + timeout
+    for results in shell_command_results:
+        remaining = None if deadline is None else max(0, deadline - time.monotonic())
+        if not results.wait(raise_on_error=False, timeout=remaining):
+            return False
+
+    if raise_on_error:
+        exceptions = [AsynchronousShellCommandException(results) for results in shell_command_results if results.ExitCode != 0]
+        if exceptions:
+            raise ShellCommandBatchException(exceptions)
+    return True
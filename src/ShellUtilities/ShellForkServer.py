@@ -0,0 +1,290 @@
+import subprocess
+import selectors
+import threading
+import socket
+import select
+import struct
+import types
+import json
+import time
+import sys
+import os
+
+
+# This module only imports from the standard library as it is also run as the script of the fork
+# server process (see ShellForkServer below) where the ShellUtilities package may not be importable.
+
+
+# The messages exchanged with the fork server are JSON prefixed with their length
+_HEADER = struct.Struct("!I")
+# The fds passed back for each process: stdout, stderr and a pipe the exit code is reported on
+_MAX_FDS = 3
+
+
+def _send_message(connection, message, fds=()):
+    data = json.dumps(message).encode()
+    data = _HEADER.pack(len(data)) + data
+    # The fds are attached to the first chunk which is sent
+    sent = socket.send_fds(connection, [data], list(fds))
+    if sent < len(data):
+        connection.sendall(data[sent:])
+
+
+def _receive_exactly(connection, size, data=b""):
+    while len(data) < size:
+        chunk = connection.recv(size - len(data))
+        if not chunk:
+            return None
+        data += chunk
+    return data
+
+
+def _receive_message(connection):
+    # Returns the message and any fds which were passed with it, or (None, []) once the other end of
+    # the connection has been closed
+    data, fds, flags, address = socket.recv_fds(connection, _HEADER.size, _MAX_FDS)
+    if not data:
+        return None, []
+    data = _receive_exactly(connection, _HEADER.size, data)
+    if data is not None:
+        (size,) = _HEADER.unpack(data)
+        data = _receive_exactly(connection, size)
+    if data is None:
+        for fd in fds:
+            os.close(fd)
+        return None, []
+    return json.loads(data), fds
+
+
+class ShellForkServerProcess():
+
+    # Stands in for the subprocess.Popen object of a process created by the fork server. The process is
+    # a child of the fork server rather than of this process, so it can not be waited for directly.
+    # Instead the fork server reaps it and writes its exit code to a pipe which is read by poll() and
+    # wait().
+
+    def __init__(self, args, pid, stdout_fd, stderr_fd, status_fd):
+        self.args = args
+        self.pid = pid
+        self.stdin = None
+        self.stdout = open(stdout_fd, "rb")
+        self.stderr = open(stderr_fd, "rb")
+        self.status_fd = status_fd
+        self.returncode = None
+        # The resources used by the process (as reported by wait4() in the fork server)
+        self.rusage = None
+        self.status_lock = threading.Lock()
+        # The output read by communicate() so far; it is kept if it times out
+        self.communicate_outputs = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.stdout.close()
+        self.stderr.close()
+        self.wait()
+
+    def _read_status(self, timeout):
+        # Another thread may already be waiting for the process, in which case poll() gives up
+        # straight away like subprocess.Popen.poll() does
+        if not self.status_lock.acquire(timeout is None or timeout > 0):
+            return None
+        try:
+            if self.returncode is not None:
+                return self.returncode
+            readable, _, _ = select.select([self.status_fd], [], [], timeout)
+            if not readable:
+                return None
+            status = b""
+            while True:
+                data = os.read(self.status_fd, 64)
+                if not data:
+                    break
+                status += data
+            os.close(self.status_fd)
+            if not status:
+                raise Exception("The fork server exited before reporting the exit code of process {0}.".format(self.pid))
+            returncode, user_time, system_time, max_rss = json.loads(status)
+            self.rusage = types.SimpleNamespace(ru_utime=user_time, ru_stime=system_time, ru_maxrss=max_rss)
+            self.returncode = returncode
+            return self.returncode
+        finally:
+            self.status_lock.release()
+
+    def poll(self):
+        return self._read_status(0)
+
+    def wait(self, timeout=None):
+        if self._read_status(timeout) is None:
+            raise subprocess.TimeoutExpired(self.args, timeout)
+        return self.returncode
+
+    def communicate(self, timeout=None):
+        # Read all of the output and wait for the process to exit. Like subprocess.Popen.communicate(),
+        # if the timeout expires the output read so far is kept and it may be called again.
+        if self.communicate_outputs is None:
+            self.communicate_outputs = {self.stdout: [], self.stderr: []}
+        outputs = self.communicate_outputs
+        end_time = time.monotonic() + timeout if timeout is not None else None
+        with selectors.DefaultSelector() as selector:
+            for file in outputs.keys():
+                if not file.closed:
+                    selector.register(file.raw, selectors.EVENT_READ, file)
+            while selector.get_map():
+                select_timeout = None
+                if end_time is not None:
+                    select_timeout = end_time - time.monotonic()
+                    if select_timeout <= 0:
+                        raise subprocess.TimeoutExpired(self.args, timeout)
+                for key, mask in selector.select(select_timeout):
+                    data = key.fileobj.read(65536)
+                    if data:
+                        outputs[key.data].append(data)
+                    else:
+                        selector.unregister(key.fileobj)
+                        key.data.close()
+        self.wait(max(0, end_time - time.monotonic()) if end_time is not None else None)
+        return b"".join(outputs[self.stdout]), b"".join(outputs[self.stderr])
+
+    def send_signal(self, sig):
+        # Once the exit code has been reported the pid may have been reused
+        if self.poll() is None:
+            os.kill(self.pid, sig)
+
+    def terminate(self):
+        self.send_signal(15)
+
+    def kill(self):
+        self.send_signal(9)
+
+
+class ShellForkServer():
+
+    # Creating a process from a parent which uses a lot of memory can be slow, as (depending on how the
+    # child is created) the page tables of the parent may have to be copied. The fork server is a small
+    # helper process, started before the parent has grown, which creates processes on its behalf.
+    #
+    # Requests are sent to it over a unix socket. It creates the process with its stdout and stderr
+    # connected to pipes and passes the read ends of the pipes back over the socket, so the caller gets
+    # an object which can be used in place of subprocess.Popen (see ShellForkServerProcess).
+    #
+    # The fork server runs a fresh interpreter (without site packages) rather than being forked from
+    # this process, so it stays small regardless of when it is started. It exits once the connection is
+    # closed and all of the processes it created have exited.
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        server_socket, self.connection = socket.socketpair(socket.AF_UNIX, socket.SOCK_STREAM)
+        with server_socket:
+            self.process = subprocess.Popen(
+                [sys.executable, "-I", "-S", os.path.abspath(__file__), str(server_socket.fileno())],
+                pass_fds=[server_socket.fileno()]
+            )
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def close(self):
+        with self.lock:
+            if self.connection.fileno() == -1:
+                return
+            self.connection.close()
+        self.process.wait()
+
+    def is_alive(self):
+        return self.process.poll() is None
+
+    def popen(self, args, shell=False, executable=None, env=None, cwd=None, stdout=subprocess.PIPE, stderr=subprocess.PIPE, close_fds=True, start_new_session=False):
+
+        # Takes the same arguments as subprocess.Popen (other than stdout and stderr, which are always
+        # pipes) and returns a ShellForkServerProcess.
+
+        if stdout != subprocess.PIPE or stderr != subprocess.PIPE:
+            raise Exception("The fork server only supports piping the stdout and stderr of processes.")
+
+        # The fork server has its own environment and working directory which may no longer match ours
+        request = {
+            "args": args,
+            "shell": shell,
+            "executable": executable,
+            "env": dict(os.environ) if env is None else env,
+            "cwd": os.getcwd() if cwd is None else cwd,
+            "start_new_session": start_new_session
+        }
+
+        with self.lock:
+            if self.connection.fileno() == -1:
+                raise Exception("The fork server has been closed.")
+            try:
+                _send_message(self.connection, request)
+                response, fds = _receive_message(self.connection)
+            except OSError as ex:
+                raise Exception("The fork server is no longer running.") from ex
+            if response is None:
+                raise Exception("The fork server is no longer running.")
+
+        if "error" in response:
+            if response.get("errno") is not None:
+                raise OSError(response["errno"], response["error"], response.get("filename"))
+            raise Exception(response["error"])
+
+        for fd in fds:
+            os.set_inheritable(fd, False)
+        return ShellForkServerProcess(args, response["pid"], *fds)
+
+
+def _report_exit(process, status_fd):
+    # Reap the process and report its exit code and resource usage
+    pid, status, rusage = os.wait4(process.pid, 0)
+    process.returncode = os.waitstatus_to_exitcode(status)
+    status = [process.returncode, rusage.ru_utime, rusage.ru_stime, rusage.ru_maxrss]
+    os.write(status_fd, json.dumps(status).encode())
+    os.close(status_fd)
+
+
+def _serve(fd):
+    # The main loop of the fork server process
+    connection = socket.socket(fileno=fd)
+    while True:
+        request, fds = _receive_message(connection)
+        if request is None:
+            break
+
+        try:
+            process = subprocess.Popen(
+                request["args"],
+                shell=request["shell"],
+                executable=request["executable"],
+                env=request["env"],
+                cwd=request["cwd"],
+                start_new_session=request["start_new_session"],
+                stdout=subprocess.PIPE,
+                stderr=subprocess.PIPE,
+                close_fds=True
+            )
+        except OSError as ex:
+            _send_message(connection, {"error": ex.strerror, "errno": ex.errno, "filename": ex.filename})
+            continue
+        except Exception as ex:
+            _send_message(connection, {"error": str(ex)})
+            continue
+
+        status_read_fd, status_write_fd = os.pipe()
+        _send_message(connection, {"pid": process.pid}, [process.stdout.fileno(), process.stderr.fileno(), status_read_fd])
+        process.stdout.close()
+        process.stderr.close()
+        os.close(status_read_fd)
+
+        # The interpreter will not exit until these threads have reported the exit codes of the
+        # processes which are still running
+        threading.Thread(target=_report_exit, args=(process, status_write_fd)).start()
+
+    connection.close()
+
+
+if __name__ == "__main__":
+    _serve(int(sys.argv[1]))
@@ -0,0 +1,170 @@
+import threading
+import asyncio
+import logging
+import errno
+import stat
+import io
+import os
+from ShellUtilities.ShellOutputReader import READ_SIZE
+
+
+logger = logging.getLogger(__name__)
+
+
+class ShellInputWriter():
+
+    # Writes the input of a command to its stdin while its output is being read, so that a large
+    # input can not deadlock with the output filling up the other pipes. The input may be:
+    #   - a string (encoded with the encoding) or bytes-like object, e.g. bytes, a memoryview or an mmap
+    #   - a file (or anything else with a read() function) which is read in chunks. A regular file
+    #     opened in binary mode is sent with sendfile() so it does not pass through python.
+    #   - an iterator or async iterator of string or bytes-like chunks, which are written as they are
+    #     produced rather than being collected first
+    #
+    # The stdin is closed once all of the input has been written. If the process exits (or closes its
+    # stdin) without reading all of the input, the rest of it is discarded, like subprocess does.
+
+    def __init__(self, input, encoding="utf-8"):
+        self.input = input
+        self.encoding = encoding
+        if isinstance(input, str):
+            self.kind = "text"
+        elif hasattr(input, "__aiter__"):
+            self.kind = "async_iterator"
+        else:
+            try:
+                memoryview(input)
+                self.kind = "buffer"
+            except TypeError:
+                if hasattr(input, "read"):
+                    self.kind = "file"
+                elif hasattr(input, "__iter__"):
+                    self.kind = "iterator"
+                else:
+                    raise Exception("The input of a shell command must be a string, a bytes-like object, a file or an iterator of chunks.")
+        self.thread = None
+        self.exception = None
+
+    def start(self, file):
+        # Write the input to the stdin (the file object of the pipe) of the process on a new thread
+        self.thread = threading.Thread(target=self._run, args=(file,), daemon=True)
+        self.thread.start()
+
+    def join(self):
+        # Raises the exception which stopped the input from being written, if there was one
+        self.thread.join()
+        if self.exception:
+            raise self.exception
+
+    def _to_bytes(self, chunk):
+        if isinstance(chunk, str):
+            return chunk.encode(self.encoding)
+        return chunk
+
+    def _iter_chunks(self):
+        if self.kind == "text":
+            yield self.input.encode(self.encoding)
+        elif self.kind == "buffer":
+            yield self.input
+        elif self.kind == "file":
+            while True:
+                chunk = self.input.read(READ_SIZE)
+                if not chunk:
+                    return
+                yield self._to_bytes(chunk)
+        else:
+            for chunk in self.input:
+                yield self._to_bytes(chunk)
+
+    def _run(self, file):
+        fd = file.fileno()
+        try:
+            if self.kind == "async_iterator":
+                asyncio.run(self._write_async_iterator(fd))
+            elif self.kind == "file" and self._send_file(fd):
+                pass
+            else:
+                for chunk in self._iter_chunks():
+                    self._write(fd, chunk)
+        except BrokenPipeError:
+            pass
+        except Exception as ex:
+            logger.debug("An error occurred while writing the input of the shell command.", exc_info=True)
+            self.exception = ex
+        finally:
+            # This delivers EOF to the process
+            file.close()
+
+    async def _write_async_iterator(self, fd):
+        # The iterator gets an event loop of its own on this thread
+        async for chunk in self.input:
+            self._write(fd, self._to_bytes(chunk))
+
+    def _write(self, fd, chunk):
+        view = memoryview(chunk).cast("B")
+        while view:
+            view = view[os.write(fd, view):]
+
+    def _send_file(self, fd):
+        # Send a regular file opened in binary mode with sendfile(), starting from its current position.
+        # Returns False if that is not possible so that it is read and written instead.
+        if not hasattr(os, "sendfile") or isinstance(self.input, io.TextIOBase):
+            return False
+        try:
+            input_fd = self.input.fileno()
+            offset = self.input.tell()
+        except (AttributeError, OSError, ValueError):
+            return False
+        if not stat.S_ISREG(os.fstat(input_fd).st_mode):
+            return False
+        size = os.fstat(input_fd).st_size
+        sent = 0
+        try:
+            while offset < size:
+                count = os.sendfile(fd, input_fd, offset, size - offset)
+                if count == 0:
+                    break
+                offset += count
+                sent += count
+        except OSError as ex:
+            # Older kernels can only send to sockets
+            if ex.errno not in (errno.EINVAL, errno.ENOSYS) or sent:
+                raise
+            return False
+        finally:
+            self.input.seek(offset)
+        return True
+
+    async def _write_async(self, stream_writer, chunk):
+        # The transport only accepts bytes, bytearrays and memoryviews, and copies whatever it can not
+        # write straight away, so the chunk is written a slice at a time
+        view = memoryview(chunk).cast("B")
+        for offset in range(0, len(view), READ_SIZE):
+            stream_writer.write(view[offset:offset + READ_SIZE])
+            await stream_writer.drain()
+
+    async def write_async(self, stream_writer):
+        # The asyncio equivalent of start() and join(); writes the input to the asyncio StreamWriter of
+        # the stdin. Like _run(), an exception is only recorded so that the output is still read. Files
+        # are read on the default executor so that the event loop is not blocked.
+        loop = asyncio.get_running_loop()
+        try:
+            if self.kind == "async_iterator":
+                async for chunk in self.input:
+                    await self._write_async(stream_writer, self._to_bytes(chunk))
+            elif self.kind == "file":
+                while True:
+                    chunk = await loop.run_in_executor(None, self.input.read, READ_SIZE)
+                    if not chunk:
+                        break
+                    await self._write_async(stream_writer, self._to_bytes(chunk))
+            else:
+                for chunk in self._iter_chunks():
+                    await self._write_async(stream_writer, chunk)
+        except (BrokenPipeError, ConnectionResetError):
+            pass
+        except Exception as ex:
+            logger.debug("An error occurred while writing the input of the shell command.", exc_info=True)
+            self.exception = ex
+        finally:
+            stream_writer.close()
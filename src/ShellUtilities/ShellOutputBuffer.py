@@ -0,0 +1,505 @@
+import os
+import collections
+import array
+import mmap
+import tempfile
+import codecs
+import fcntl
+import stat
+
+
+class ShellOutputBuffer():
+
+    # Stores the lines written by a process to one of its output streams. The lines are only kept
+    # once; the string form of the output is built the first time it is requested and cached. Later
+    # requests only need to append the lines which have arrived since, so accumulating the output
+    # is linear in its size rather than quadratic.
+
+    def __init__(self):
+        self.lines = []
+        self.text_cache = ""
+        self.text_cache_line_count = 0
+
+    def append(self, line):
+        self.lines.append(line)
+
+    def extend(self, lines):
+        self.lines.extend(lines)
+
+    def text(self):
+        if self.text_cache_line_count != len(self.lines):
+            new_lines = self.lines[self.text_cache_line_count:]
+            self.text_cache_line_count += len(new_lines)
+            self.text_cache += os.linesep.join(new_lines) + os.linesep
+        return self.text_cache
+
+    def __len__(self):
+        return len(self.lines)
+
+    def diagnostic_text(self):
+        # The output to attach to exceptions raised for the command
+        return self.text()
+
+
+class BinaryShellOutputBuffer():
+
+    # Retains the raw chunks read from the stream without decoding them. The chunks are joined into a
+    # single bytes object the first time the raw output is requested. The text is only decoded when
+    # it is requested, and an incremental decoder is used so that later requests only decode the
+    # bytes which have arrived since.
+
+    def __init__(self, encoding="utf-8", errors="strict", diagnostic_byte_count=65536):
+        self.encoding = encoding
+        self.errors = errors
+        self.diagnostic_byte_count = diagnostic_byte_count
+        self.chunks = []
+        self.lines = []
+        self.size = 0
+        self.decoder = codecs.getincrementaldecoder(encoding)(errors)
+        self.decoded_size = 0
+        self.decoder_finalized = False
+        self.text_cache = ""
+
+    def append(self, chunk):
+        self.chunks.append(chunk)
+        self.size += len(chunk)
+
+    def bytes(self):
+        if len(self.chunks) > 1:
+            self.chunks = [b"".join(self.chunks)]
+        return self.chunks[0] if self.chunks else b""
+
+    def extend(self, lines):
+        for line in lines:
+            self.append(line)
+
+    def text(self, final=False):
+        # Once the stream has ended (final), any incomplete character left in the decoder is flushed
+        if self.decoded_size != self.size or (final and not self.decoder_finalized):
+            new_bytes = memoryview(self.bytes())[self.decoded_size:]
+            self.text_cache += self.decoder.decode(new_bytes, final=final)
+            self.decoded_size = self.size
+            self.decoder_finalized = final
+        return self.text_cache
+
+    def diagnostic_text(self):
+        # Binary output may not be valid text so the tail is decoded leniently
+        return bytes(memoryview(self.bytes())[-self.diagnostic_byte_count:]).decode(self.encoding, "replace")
+
+    def __len__(self):
+        return self.size
+
+
+class NullShellOutputBuffer():
+
+    # Does not retain any of the output. This is useful when the output is being consumed as it
+    # arrives through callbacks or iterators.
+
+    def __init__(self):
+        self.lines = []
+
+    def append(self, line):
+        pass
+
+    def extend(self, lines):
+        pass
+
+    def text(self, final=False):
+        return ""
+
+    def diagnostic_text(self):
+        return ""
+
+    def __len__(self):
+        return 0
+
+
+class RingShellOutputBuffer():
+
+    # Only retains the most recent lines written to the stream. The buffer can be bounded by the
+    # number of lines and/or by its size in bytes (of the lines once encoded with the encoding, and
+    # their line separators). If a single line exceeds the size bound, only its tail is kept.
+
+    def __init__(self, max_lines=None, max_bytes=None, encoding="utf-8", errors="strict"):
+        self.max_lines = max_lines
+        self.max_bytes = max_bytes
+        self.encoding = encoding
+        self.errors = errors
+        # The length of ascii text is its size in utf-8, so it does not have to be encoded
+        self.ascii_compatible = codecs.lookup(encoding).name == "utf-8"
+        self.lines = collections.deque(maxlen=max_lines)
+        # The size of each of the lines, including its line separator
+        self.line_sizes = collections.deque(maxlen=max_lines)
+        self.size = 0
+        self.appended_line_count = 0
+        self.text_cache = ""
+        self.text_cache_line_count = 0
+
+    def _line_size(self, line):
+        if self.max_bytes is None or (self.ascii_compatible and line.isascii()):
+            return len(line) + len(os.linesep)
+        return len(line.encode(self.encoding, self.errors)) + len(os.linesep)
+
+    def _tail(self, line):
+        # The last max_bytes bytes of the line, which may start part way through a character
+        data = line.encode(self.encoding, self.errors)[-self.max_bytes:]
+        for start in range(4):
+            try:
+                return data[start:].decode(self.encoding, self.errors)
+            except UnicodeDecodeError:
+                pass
+        return data.decode(self.encoding, "replace")
+
+    def append(self, line):
+        if self.max_lines is not None and len(self.lines) == self.max_lines:
+            self.size -= self.line_sizes[0]
+        line_size = self._line_size(line)
+        self.lines.append(line)
+        self.line_sizes.append(line_size)
+        self.size += line_size
+        self.appended_line_count += 1
+
+        if self.max_bytes is not None:
+            while self.size > self.max_bytes and len(self.lines) > 1:
+                self.lines.popleft()
+                self.size -= self.line_sizes.popleft()
+            if self.size > self.max_bytes:
+                self.lines[0] = self._tail(self.lines[0])
+                self.line_sizes[0] = self._line_size(self.lines[0])
+                self.size = self.line_sizes[0]
+
+    def extend(self, lines):
+        for line in lines:
+            self.append(line)
+
+    def text(self):
+        # The lines are dropped from the front of the buffer so the cache has to be rebuilt whenever
+        # new lines arrive. This is bounded by the size of the buffer.
+        if self.text_cache_line_count != self.appended_line_count:
+            self.text_cache = "".join([line + os.linesep for line in self.lines])
+            self.text_cache_line_count = self.appended_line_count
+        return self.text_cache
+
+    def diagnostic_text(self):
+        return self.text()
+
+    def __len__(self):
+        return len(self.lines)
+
+
+class SpillingShellOutputBuffer():
+
+    # Retains the lines in memory until their size (in bytes once encoded with the encoding) exceeds
+    # the threshold. At
+    # that point they are written to an anonymous temporary file and all subsequent lines are
+    # appended to that file. The spilled output can be accessed through mmap() without reading it
+    # back into memory. The buffer acts as the sequence of lines itself; an index of the offset of
+    # each line in the file is kept so that individual lines can be looked up.
+
+    def __init__(self, threshold, diagnostic_line_count=100, encoding="utf-8", errors="strict"):
+        self.threshold = threshold
+        self.encoding = encoding
+        self.errors = errors
+        self.diagnostic_line_count = diagnostic_line_count
+        self.lines = self
+        self.memory_lines = []
+        self.size = 0
+        self.file = None
+        self.line_offsets = array.array("q")
+
+    def append(self, line):
+        data = (line + "\n").encode(self.encoding, self.errors)
+        if self.file is None:
+            self.memory_lines.append(line)
+            self.size += len(data)
+            if self.size > self.threshold:
+                self._spill()
+            return
+        self.line_offsets.append(self.size)
+        self.file.write(data)
+        self.size += len(data)
+
+    def _spill(self):
+        self.file = tempfile.TemporaryFile()
+        offset = 0
+        for line in self.memory_lines:
+            data = (line + "\n").encode(self.encoding, self.errors)
+            self.line_offsets.append(offset)
+            self.file.write(data)
+            offset += len(data)
+        self.memory_lines = []
+
+    def spilled(self):
+        return self.file is not None
+
+    def mmap(self):
+        # Returns a read only memory map of the spilled output or None if nothing has been spilled
+        if self.file is None or self.size == 0:
+            return None
+        self.file.flush()
+        return mmap.mmap(self.file.fileno(), 0, access=mmap.ACCESS_READ)
+
+    def extend(self, lines):
+        for line in lines:
+            self.append(line)
+
+    def text(self):
+        # Note: accessing the whole of the spilled output will read it back into memory
+        if self.file is None:
+            return "".join([line + os.linesep for line in self.memory_lines])
+        with self.mmap() as memory_map:
+            return memory_map[:].decode(self.encoding, self.errors).replace("\n", os.linesep)
+
+    def diagnostic_text(self):
+        line_count = len(self)
+        start = max(0, line_count - self.diagnostic_line_count)
+        return "".join([self[i] + os.linesep for i in range(start, line_count)])
+
+    def close(self):
+        if self.file is not None:
+            self.file.close()
+
+    def __len__(self):
+        if self.file is None:
+            return len(self.memory_lines)
+        return len(self.line_offsets)
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return [self[i] for i in range(*index.indices(len(self)))]
+        if self.file is None:
+            return self.memory_lines[index]
+        offsets = self.line_offsets
+        index = range(len(offsets))[index]
+        end = offsets[index + 1] if index + 1 < len(offsets) else self.size
+        self.file.flush()
+        return os.pread(self.file.fileno(), end - offsets[index] - 1, offsets[index]).decode(self.encoding, self.errors)
+
+    def __iter__(self):
+        if self.file is None:
+            yield from list(self.memory_lines)
+            return
+        memory_map = self.mmap()
+        try:
+            end = self.size
+            start = 0
+            while start < end:
+                newline = memory_map.find(b"\n", start, end)
+                yield memory_map[start:newline].decode(self.encoding, self.errors)
+                start = newline + 1
+        finally:
+            memory_map.close()
+
+
+class FileShellOutputBuffer():
+
+    # The output of a stream which is redirected to a file (given as a path, an open file or a file
+    # descriptor). Normally the process writes to the file directly so the output never passes through
+    # python. Otherwise (direct is False) the lines are handed to the buffer as they are read and it
+    # writes them to the file; in text mode this is the decoded lines, each followed by a newline.
+    #
+    # The output is read back from the file lazily through a memory map. Only what was written to the
+    # file while the command ran is part of the output; a file which is not a regular file (e.g. a
+    # terminal or a pipe) can not be read back, so the output appears to be empty. The buffer acts as
+    # the sequence of lines itself; the offset of each line is indexed the first time they are accessed.
+
+    def __init__(self, target, direct=True, encoding="utf-8", errors="strict", diagnostic_byte_count=65536):
+        self.direct = direct
+        self.encoding = encoding
+        self.errors = errors
+        self.diagnostic_byte_count = diagnostic_byte_count
+        self.lines = self
+        self.file = None
+        if isinstance(target, int):
+            self.fd = target
+        elif hasattr(target, "fileno"):
+            target.flush()
+            self.fd = target.fileno()
+        else:
+            self.file = open(target, "wb")
+            self.fd = self.file.fileno()
+        self.read_file = self._open_for_reading(target)
+        self.start = 0
+        if self.read_file is not None:
+            # Anything written to a file opened for appending goes to the end of it
+            if fcntl.fcntl(self.fd, fcntl.F_GETFL) & os.O_APPEND:
+                self.start = os.fstat(self.fd).st_size
+            else:
+                self.start = os.lseek(self.fd, 0, os.SEEK_CUR)
+        # The end of the output is fixed once the command has completed (see finish())
+        self.end = None
+        self.memory_map = None
+        self.decoder = codecs.getincrementaldecoder(encoding)(errors)
+        self.decoded_end = self.start
+        self.decoder_finalized = False
+        self.text_cache = ""
+        # The offset of the start of each complete line and the end of the last one
+        self.line_offsets = array.array("q")
+        self.indexed_end = self.start
+        self.memory_map_end = self.start
+
+    def _open_for_reading(self, target):
+        if not stat.S_ISREG(os.fstat(self.fd).st_mode):
+            return None
+        if self.file is not None:
+            return open(target, "rb")
+        # The file may only have been opened for writing so it is opened again to read it
+        try:
+            return open("/proc/self/fd/{0}".format(self.fd), "rb")
+        except OSError:
+            pass
+        name = getattr(target, "name", None)
+        if isinstance(name, (str, bytes)):
+            try:
+                return open(name, "rb")
+            except OSError:
+                pass
+        return None
+
+    def _map(self):
+        # Returns the memory map of the file (or None if there is no output) and the range of the output
+        if self.read_file is None:
+            return None, 0, 0
+        end = self.end
+        if end is None:
+            end = os.fstat(self.read_file.fileno()).st_size
+        end = max(self.start, end)
+        if end == self.start:
+            return None, self.start, end
+        # The file grows while the command is running so it is mapped again to see the new output. The
+        # old map is left to be closed once nothing refers to it.
+        if self.memory_map is None or len(self.memory_map) < end:
+            self.memory_map = mmap.mmap(self.read_file.fileno(), 0, access=mmap.ACCESS_READ)
+        return self.memory_map, self.start, end
+
+    def append(self, line):
+        if self.direct:
+            return
+        data = line if isinstance(line, (bytes, bytearray)) else (line + "\n").encode(self.encoding, self.errors)
+        view = memoryview(data)
+        while view:
+            view = view[os.write(self.fd, view):]
+
+    def extend(self, lines):
+        for line in lines:
+            self.append(line)
+
+    def finish(self):
+        # Called once the command has completed; the output no longer includes anything written to the
+        # file after this
+        if self.file is not None:
+            self.file.close()
+        if self.read_file is not None and self.end is None:
+            self.end = max(self.start, os.fstat(self.read_file.fileno()).st_size)
+
+    def mmap(self):
+        # Returns a read only view of the output backed by a memory map of the file
+        memory_map, start, end = self._map()
+        if memory_map is None:
+            return memoryview(b"")
+        return memoryview(memory_map)[start:end]
+
+    def bytes(self):
+        # Note: this reads the whole of the output into memory
+        return bytes(self.mmap())
+
+    def text(self, final=False):
+        memory_map, start, end = self._map()
+        final = final or self.end is not None
+        if self.decoded_end != end or (final and not self.decoder_finalized):
+            new_bytes = memory_map[self.decoded_end:end] if memory_map is not None else b""
+            self.text_cache += self.decoder.decode(new_bytes, final=final)
+            self.decoded_end = end
+            self.decoder_finalized = final
+        return self.text_cache
+
+    def diagnostic_text(self):
+        # Only the tail of the file is read and it is decoded leniently as it may start part way
+        # through a character
+        memory_map, start, end = self._map()
+        if memory_map is None:
+            return ""
+        return memory_map[max(start, end - self.diagnostic_byte_count):end].decode(self.encoding, "replace")
+
+    def close(self):
+        # Release the file descriptors; the output can not be read back afterwards
+        if self.file is not None:
+            self.file.close()
+        if self.memory_map is not None:
+            try:
+                self.memory_map.close()
+            except BufferError:
+                # A view returned by mmap() is still in use; the map is closed once it is released
+                pass
+            self.memory_map = None
+        if self.read_file is not None:
+            self.read_file.close()
+            self.read_file = None
+
+    def _index_lines(self):
+        memory_map, start, end = self._map()
+        position = self.indexed_end
+        while position < end:
+            newline = memory_map.find(b"\n", position, end)
+            if newline == -1:
+                break
+            self.line_offsets.append(position)
+            position = newline + 1
+        self.indexed_end = position
+        self.memory_map_end = end
+
+    def __len__(self):
+        self._index_lines()
+        # A final line which is not terminated by a newline still counts
+        return len(self.line_offsets) + (1 if self.indexed_end < self.memory_map_end else 0)
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return [self[i] for i in range(*index.indices(len(self)))]
+        index = range(len(self))[index]
+        return self._get_line(index)
+
+    def _get_line(self, index):
+        # The lines must have been indexed
+        if index == len(self.line_offsets):
+            # The final line which is not terminated by a newline
+            line_start, line_end = self.indexed_end, self.memory_map_end
+        else:
+            line_start = self.line_offsets[index]
+            line_end = (self.line_offsets[index + 1] if index + 1 < len(self.line_offsets) else self.indexed_end) - 1
+        return self.memory_map[line_start:line_end].decode(self.encoding, self.errors)
+
+    def __iter__(self):
+        for index in range(len(self)):
+            yield self._get_line(index)
+
+
+def create_shell_output_buffer(retention="all", limit=None, binary=False, encoding="utf-8", errors="strict"):
+    # Creates the buffer used to retain the output of a stream according to the retention policy:
+    #   all   - keep all of the output in memory (the default)
+    #   none  - do not keep any of the output
+    #   lines - keep the last <limit> lines in memory
+    #   bytes - keep the last <limit> bytes in memory
+    #   spill - keep the output in memory until it exceeds <limit> bytes and then spill it to a file
+    #
+    # In binary mode the raw output is retained rather than lines; only the all and none policies
+    # are supported.
+    if retention == "none":
+        return NullShellOutputBuffer()
+    if binary:
+        if retention != "all":
+            raise Exception("The '{0}' output retention policy is not supported in binary mode.".format(retention))
+        return BinaryShellOutputBuffer(encoding, errors)
+    if retention == "all":
+        return ShellOutputBuffer()
+    if retention not in ["lines", "bytes", "spill"]:
+        raise Exception("Unknown output retention policy '{0}'.".format(retention))
+    if limit is None:
+        raise Exception("A limit must be specified for the '{0}' output retention policy.".format(retention))
+    if not isinstance(limit, int) or limit < 1:
+        raise Exception("The limit of the '{0}' output retention policy must be a positive integer.".format(retention))
+    if retention == "lines":
+        return RingShellOutputBuffer(max_lines=limit, encoding=encoding, errors=errors)
+    if retention == "bytes":
+        return RingShellOutputBuffer(max_bytes=limit, encoding=encoding, errors=errors)
+    return SpillingShellOutputBuffer(limit, encoding=encoding, errors=errors)
@@ -0,0 +1,214 @@
+import os
+import selectors
+import threading
+import logging
+import time
+from ShellUtilities.ShellOutputReader import ShellOutputLineSplitter, read_chunk, READ_SIZE
+from ShellUtilities.ShellCommandMetrics import reap_process
+
+
+logger = logging.getLogger(__name__)
+
+
+# How long (in seconds) the rest of the output of a process which timed out is read for after it has
+# been killed
+KILL_GRACE_PERIOD = 0.5
+
+
+class _ReactorRegistration():
+
+    # Book keeping for a single process whose pipes are being serviced by the reactor
+
+    def __init__(self, process, stdout_handler, stderr_handler, completion_callback, binary=False, encoding="utf-8", errors="strict", metrics=None):
+        self.process = process
+        self.metrics = metrics
+        # The pipes are read through their unbuffered file objects. A stream which was redirected to a
+        # file has no pipe.
+        self.files = {}
+        self.splitters = {}
+        self.streams = {}
+        for file, handler, stream in [(process.stdout, stdout_handler, "stdout"), (process.stderr, stderr_handler, "stderr")]:
+            if file is None:
+                continue
+            self.files[file.fileno()] = file.raw
+            self.splitters[file.fileno()] = ShellOutputLineSplitter(handler, binary, encoding, errors)
+            self.streams[file.fileno()] = stream
+        self.completion_callback = completion_callback
+        self.pidfd = None
+        self.exited = False
+        self.paused_fds = set()
+
+    def read(self, fd, view):
+        # Read a chunk from one of the pipes. Returns False once the write end of the pipe has been closed.
+        if read_chunk(self.files[fd], view, self.splitters[fd], self.metrics, self.streams[fd]):
+            return True
+        del self.splitters[fd]
+        return False
+
+
+class ShellOutputReactor():
+
+    # The reactor multiplexes the stdout and stderr pipes of any number of processes onto a single
+    # thread using the selectors module (epoll on linux). The lines read from a pipe are dispatched in
+    # batches to the handler which was registered for it. On platforms which support it, a pidfd is also
+    # registered for every process so that the reactor is notified when the child exits rather than
+    # having to poll it.
+    #
+    # The selector is only ever touched from the reactor thread. Other threads hand work over to it
+    # through a list of pending calls and wake the reactor up by writing to a pipe.
+
+    def __init__(self):
+        self.selector = selectors.DefaultSelector()
+        self.lock = threading.Lock()
+        self.pending_calls = []
+        self.wakeup_read_fd, self.wakeup_write_fd = os.pipe()
+        self.selector.register(self.wakeup_read_fd, selectors.EVENT_READ, self._handle_wakeup)
+        self.thread = None
+        # All reads happen on the reactor thread so they can share a single buffer
+        self.read_view = memoryview(bytearray(READ_SIZE))
+
+    def register(self, process, stdout_handler, stderr_handler, completion_callback, binary=False, encoding="utf-8", errors="strict", metrics=None):
+        registration = _ReactorRegistration(process, stdout_handler, stderr_handler, completion_callback, binary, encoding, errors, metrics)
+        self._call_soon(lambda: self._add_registration(registration))
+        return registration
+
+    def pause(self, registration, fd):
+        # Stop reading from one of the pipes of a registered process. The pipe will fill up and the
+        # process will block when writing to it, applying backpressure until resume() is called.
+        self._call_soon(lambda: self._set_paused(registration, fd, True))
+
+    def resume(self, registration, fd):
+        self._call_soon(lambda: self._set_paused(registration, fd, False))
+
+    def _call_soon(self, func):
+        # Run the function on the reactor thread. If we are already on it, just run it now.
+        if threading.current_thread() is self.thread:
+            func()
+            return
+        with self.lock:
+            self.pending_calls.append(func)
+            if self.thread is None:
+                self.thread = threading.Thread(target=self._run, name="ShellOutputReactor", daemon=True)
+                self.thread.start()
+        os.write(self.wakeup_write_fd, b"\0")
+
+    def _run(self):
+        while True:
+            for key, mask in self.selector.select():
+                try:
+                    key.data(key.fd)
+                except Exception:
+                    logger.exception("An error occurred in the shell output reactor.")
+
+    def _handle_wakeup(self, fd):
+        os.read(fd, 4096)
+        with self.lock:
+            pending_calls = self.pending_calls
+            self.pending_calls = []
+        for func in pending_calls:
+            func()
+
+    def _add_registration(self, registration):
+        for fd in registration.splitters.keys():
+            self.selector.register(fd, selectors.EVENT_READ, lambda fd, registration=registration: self._handle_output(registration, fd))
+
+        # Ask the kernel to tell us when the process exits. If pidfds are not available we fall
+        # back to treating EOF on both pipes as the end of the command.
+        if hasattr(os, "pidfd_open"):
+            try:
+                registration.pidfd = os.pidfd_open(registration.process.pid)
+            except OSError:
+                registration.pidfd = None
+        if registration.pidfd is not None:
+            self.selector.register(registration.pidfd, selectors.EVENT_READ, lambda fd, registration=registration: self._handle_exit(registration))
+        else:
+            registration.exited = True
+            # There may not be any pipes whose EOF would complete it
+            self._check_complete(registration)
+
+    def _set_paused(self, registration, fd, paused):
+        # The pipe may have been closed (and its fd reused) in the meantime
+        if fd not in registration.splitters or (fd in registration.paused_fds) == paused:
+            return
+        if paused:
+            self.selector.unregister(fd)
+            registration.paused_fds.add(fd)
+        else:
+            self.selector.register(fd, selectors.EVENT_READ, lambda fd, registration=registration: self._handle_output(registration, fd))
+            registration.paused_fds.remove(fd)
+
+    def _handle_output(self, registration, fd):
+        if not registration.read(fd, self.read_view):
+            self.selector.unregister(fd)
+            self._check_complete(registration)
+
+    def _handle_exit(self, registration):
+        self.selector.unregister(registration.pidfd)
+        os.close(registration.pidfd)
+        registration.pidfd = None
+        registration.exited = True
+        # Reap the child; this will not block as the kernel has told us it has exited
+        reap_process(registration.process, registration.metrics, block=False)
+        self._check_complete(registration)
+
+    def _check_complete(self, registration):
+        if not registration.exited or registration.splitters:
+            return
+        # Without a pidfd the pipes may be closed before the process has exited. In that case the
+        # process is waited for on a separate thread so that the reactor is not blocked.
+        if reap_process(registration.process, registration.metrics, block=False) is None:
+            def wait_for_exit():
+                reap_process(registration.process, registration.metrics)
+                registration.completion_callback()
+            threading.Thread(target=wait_for_exit, daemon=True).start()
+            return
+        registration.completion_callback()
+
+
+_default_reactor = None
+_default_reactor_lock = threading.Lock()
+
+
+def get_default_reactor():
+    # The reactor shared by all non-blocking commands which opt in to it
+    global _default_reactor
+    with _default_reactor_lock:
+        if _default_reactor is None:
+            _default_reactor = ShellOutputReactor()
+        return _default_reactor
+
+
+def pump_process_output(process, stdout_handler, stderr_handler, binary=False, encoding="utf-8", errors="strict", timeout=None, on_timeout=None, metrics=None):
+    # Service the pipes of a single process on the calling thread until both of them are closed.
+    # This is used by blocking commands which need to see the output line by line rather than
+    # collecting all of it with process.communicate().
+    #
+    # If the pipes are still open after timeout seconds, on_timeout is called to kill the process. The
+    # rest of the output is then read for up to KILL_GRACE_PERIOD seconds; a process which escaped the
+    # kill (e.g. by starting a new session) may hold the pipes open for much longer, so after that they
+    # are abandoned. Returns True if the timeout expired.
+    registration = _ReactorRegistration(process, stdout_handler, stderr_handler, None, binary, encoding, errors, metrics)
+    read_view = memoryview(bytearray(READ_SIZE))
+    end_time = time.monotonic() + timeout if timeout is not None else None
+    timed_out = False
+    with selectors.DefaultSelector() as selector:
+        for fd in registration.splitters.keys():
+            selector.register(fd, selectors.EVENT_READ)
+        while registration.splitters:
+            select_timeout = None
+            if end_time is not None:
+                select_timeout = end_time - time.monotonic()
+                if select_timeout <= 0 and timed_out:
+                    # Keep whatever partial lines were read
+                    for splitter in registration.splitters.values():
+                        splitter.close()
+                    break
+                if select_timeout <= 0:
+                    on_timeout()
+                    end_time = time.monotonic() + KILL_GRACE_PERIOD
+                    timed_out = True
+                    continue
+            for key, mask in selector.select(select_timeout):
+                if not registration.read(key.fd, read_view):
+                    selector.unregister(key.fd)
+    return timed_out
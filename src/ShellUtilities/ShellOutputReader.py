@@ -0,0 +1,74 @@
+import codecs
+
+
+# The size of the chunks read from the pipes
+READ_SIZE = 65536
+
+
+class ShellOutputLineSplitter():
+
+    # Turns the chunks read from one of the output streams of a process into batches of lines. The
+    # chunks are decoded incrementally, so multibyte characters may span chunks, and then split in a
+    # single pass. The last line of a chunk may be incomplete so it is held back until the rest of it
+    # is read. Each batch of complete lines is passed to the handler as a list.
+    #
+    # In binary mode the chunks are passed to the handler as they are (in a list of one) rather than
+    # being decoded and split.
+
+    def __init__(self, handler, binary=False, encoding="utf-8", errors="strict"):
+        self.handler = handler
+        self.binary = binary
+        self.decoder = None
+        if not binary:
+            self.decoder = codecs.getincrementaldecoder(encoding)(errors)
+        self.partial_line = []
+
+    def feed(self, data):
+        # The data may be a view of a buffer which is reused for the next read so it must not be kept
+        if self.binary:
+            self.handler([bytes(data)])
+            return
+        self._split(self.decoder.decode(data))
+
+    def close(self):
+        # Flush anything left once the stream has ended
+        if self.binary:
+            return
+        self._split(self.decoder.decode(b"", final=True))
+        if self.partial_line:
+            line = "".join(self.partial_line)
+            self.partial_line = []
+            self.handler([line])
+
+    def _split(self, text):
+        if "\n" not in text:
+            if text:
+                self.partial_line.append(text)
+            return
+        lines = text.split("\n")
+        remainder = lines.pop()
+        if self.partial_line:
+            self.partial_line.append(lines[0])
+            lines[0] = "".join(self.partial_line)
+        self.partial_line = [remainder] if remainder else []
+        self.handler(lines)
+
+
+def read_chunk(file, view, splitter, metrics=None, stream=None):
+    # Read whatever is available from the (unbuffered) file into the reusable buffer behind the view
+    # and pass it to the splitter. Returns False once the end of the stream has been reached. If
+    # metrics are given, the output is counted against the stream ("stdout" or "stderr").
+    byte_count = file.readinto(view)
+    if not byte_count:
+        splitter.close()
+        return False
+    if metrics:
+        metrics.record_output(stream, view.obj, byte_count)
+    splitter.feed(view[:byte_count])
+    return True
+
+
+def read_until_eof(file, splitter, metrics=None, stream=None):
+    view = memoryview(bytearray(READ_SIZE))
+    while read_chunk(file, view, splitter, metrics, stream):
+        pass
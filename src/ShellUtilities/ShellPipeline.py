@@ -0,0 +1,330 @@
+import subprocess
+import selectors
+import threading
+import logging
+import ctypes
+import shlex
+import signal
+import errno
+import sys
+import os
+from ShellUtilities.ShellCommandException import ShellPipelineException
+from ShellUtilities.ShellCommandResults import ShellCommandResults
+from ShellUtilities.ShellOutputReader import READ_SIZE
+
+
+logger = logging.getLogger(__name__)
+
+
+def _load_tee():
+    # The tee() system call duplicates the contents of one pipe into another without copying it into
+    # user space. It is not exposed by the os module so it is called through ctypes where available.
+    if not sys.platform.startswith("linux") or not hasattr(os, "splice"):
+        return None
+    try:
+        tee = ctypes.CDLL(None, use_errno=True).tee
+    except (OSError, AttributeError):
+        return None
+    tee.argtypes = [ctypes.c_int, ctypes.c_int, ctypes.c_size_t, ctypes.c_uint]
+    tee.restype = ctypes.c_ssize_t
+    return tee
+
+
+_tee = _load_tee()
+
+# The most that is moved between pipes by a single call
+_TEE_SIZE = 1024 * 1024
+
+
+class _ShellPipelineTee():
+
+    # Copies the stdout of one stage to the stdin of the next while also sending it to a file or a
+    # callback. With the tee() and splice() system calls the data only passes through the kernel
+    # (unless it is given to a callback); otherwise it is copied through a buffer.
+
+    def __init__(self, target):
+        self.target = target
+        self.file = None
+        self.fd = None
+        if callable(target):
+            pass
+        elif isinstance(target, int):
+            self.fd = target
+        elif hasattr(target, "fileno"):
+            target.flush()
+            self.fd = target.fileno()
+        else:
+            # splice() does not support files opened for appending
+            self.file = open(target, "wb")
+            self.fd = self.file.fileno()
+        # splice() only works with some kinds of files (not terminals for example)
+        self.splice_supported = self.fd is not None and _tee is not None
+        self.thread = None
+        self.exception = None
+
+    def start(self, read_fd, write_fd):
+        self.thread = threading.Thread(target=self._run, args=(read_fd, write_fd), daemon=True)
+        self.thread.start()
+
+    def join(self):
+        self.thread.join()
+        if self.file:
+            self.file.close()
+        if self.exception:
+            raise self.exception
+
+    def _output(self, read_fd, byte_count):
+        # Consume the given number of bytes from the pipe into the target
+        while byte_count:
+            if self.splice_supported:
+                try:
+                    moved = os.splice(read_fd, self.fd, byte_count)
+                except OSError as ex:
+                    if ex.errno != errno.EINVAL:
+                        raise
+                    self.splice_supported = False
+                    continue
+            else:
+                data = os.read(read_fd, byte_count)
+                moved = len(data)
+                self._write(data)
+            byte_count -= moved
+
+    def _write(self, data):
+        if self.fd is None:
+            self.target(data)
+            return
+        view = memoryview(data)
+        while view:
+            view = view[os.write(self.fd, view):]
+
+    def _run(self, read_fd, write_fd):
+        try:
+            if _tee:
+                self._run_tee(read_fd, write_fd)
+            else:
+                self._run_copy(read_fd, write_fd)
+        except Exception as ex:
+            self.exception = ex
+        finally:
+            # Closing the pipes delivers EOF to the next stage (and SIGPIPE to this one if the next
+            # stage has gone away)
+            os.close(read_fd)
+            os.close(write_fd)
+
+    def _run_tee(self, read_fd, write_fd):
+        while True:
+            byte_count = _tee(read_fd, write_fd, _TEE_SIZE, 0)
+            if byte_count < 0:
+                error = ctypes.get_errno()
+                if error == errno.EINTR:
+                    continue
+                if error == errno.EPIPE:
+                    return
+                raise OSError(error, os.strerror(error))
+            if byte_count == 0:
+                return
+            # tee() left the data in the pipe so that it can be moved to the target
+            self._output(read_fd, byte_count)
+
+    def _run_copy(self, read_fd, write_fd):
+        while True:
+            data = os.read(read_fd, READ_SIZE)
+            if not data:
+                return
+            try:
+                view = memoryview(data)
+                while view:
+                    view = view[os.write(write_fd, view):]
+            except BrokenPipeError:
+                return
+            self._write(data)
+
+
+class ShellPipelineResults(ShellCommandResults):
+
+    # The results of a pipeline. The Stdout is the output of the last stage and the Stderr is that of
+    # all of the stages. The ExitCode is that of the last stage which failed (like bash's pipefail) or
+    # 0 if none of them did. The results of each stage (with an empty Stdout for all but the last) are
+    # available in Stages.
+
+    def __init__(self, command, stdout, stderr, exitcode, stages):
+        super().__init__(command, stdout, stderr, exitcode)
+        self.Stages = stages
+
+
+class ShellPipeline():
+
+    # Chains several commands together like a shell pipeline (a | b | c), but with each stage created
+    # directly and connected to the next through an OS pipe, so the data flowing through the pipeline
+    # never passes through python. Only the stdout of the last stage, and the stderr of every stage,
+    # is read. The stdout of the last stage may also be redirected to a file.
+    #
+    # Each stage may be an argv list (executed directly), a string (run by the shell) or a dict
+    # containing a "command" along with an "env" and/or "cwd" for that stage.
+    #
+    # The stdout of any stage may also be teed to a file or a callback with tee(). On linux this uses
+    # the tee() and splice() system calls so that the data going to a file stays in the kernel.
+    #
+    # A stage which was killed by SIGPIPE (because a later stage exited without reading all of its
+    # input, e.g. head) is not treated as a failure. For a string stage the shell reports this as an
+    # exit code of 128 + SIGPIPE.
+
+    def __init__(self, stages, env=None, cwd=None, executable=None):
+        if not stages:
+            raise Exception("A pipeline must have at least one stage.")
+        self.stages = list(stages)
+        self.env = env
+        self.cwd = cwd
+        self.executable = executable
+        self.tees = {}
+
+    def tee(self, stage, target):
+        # Send a copy of the stdout of the stage (its index in the pipeline) to a file path, an open
+        # file, a file descriptor or a callback which is passed each chunk as bytes
+        if not 0 <= stage < len(self.stages) - 1:
+            raise Exception("Only the stdout of a stage which is followed by another stage can be teed.")
+        self.tees[stage] = target
+        return self
+
+    def _get_stage_arguments(self, stage):
+        env = self.env
+        cwd = self.cwd
+        if isinstance(stage, dict):
+            env = stage.get("env", env)
+            cwd = stage.get("cwd", cwd)
+            stage = stage["command"]
+        kwargs = {"env": env, "cwd": cwd, "close_fds": True}
+        if isinstance(stage, (list, tuple)):
+            return list(stage), kwargs
+        # The executable is the shell which runs the stages given as strings
+        return stage, dict(kwargs, shell=True, executable=self.executable)
+
+    def _get_command_string(self, stage):
+        if isinstance(stage, dict):
+            stage = stage["command"]
+        if isinstance(stage, (list, tuple)):
+            return shlex.join(stage)
+        return stage
+
+    def _killed_by_sigpipe(self, stage, exitcode):
+        # The shell reports a command it ran which was killed by a signal as 128 + the signal
+        if exitcode == -signal.SIGPIPE:
+            return True
+        return isinstance(self._get_stage_arguments(stage)[0], str) and exitcode == 128 + signal.SIGPIPE
+
+    def execute(self, stdout=None, encoding="utf-8", errors="strict"):
+
+        # Run the pipeline and wait for all of the stages to exit. If stdout is given (a file path,
+        # open file or file descriptor) the output of the last stage is written to it rather than
+        # being read into the results. A ShellPipelineException is raised if any of the stages fail.
+
+        command = " | ".join(self._get_command_string(stage) for stage in self.stages)
+        logger.debug("Running shell pipeline: %s", command)
+
+        stdout_file = None
+        if isinstance(stdout, (str, bytes, os.PathLike)):
+            stdout_file = stdout = open(stdout, "wb")
+
+        processes = []
+        tees = []
+        stdin_fd = None
+        try:
+            for index, stage in enumerate(self.stages):
+                args, kwargs = self._get_stage_arguments(stage)
+                last_stage = index == len(self.stages) - 1
+                next_stdin_fd = None
+                tee = None
+                if last_stage:
+                    stage_stdout = subprocess.PIPE if stdout is None else stdout
+                else:
+                    next_stdin_fd, stage_stdout = os.pipe()
+                    if index in self.tees:
+                        tee = _ShellPipelineTee(self.tees[index])
+                        tee_read_fd = next_stdin_fd
+                        next_stdin_fd, tee_write_fd = os.pipe()
+                try:
+                    processes.append(subprocess.Popen(args, stdin=stdin_fd, stdout=stage_stdout, stderr=subprocess.PIPE, **kwargs))
+                except Exception:
+                    if tee:
+                        os.close(tee_read_fd)
+                        os.close(tee_write_fd)
+                    raise
+                finally:
+                    # The stages hold their own copies of the pipes
+                    if stdin_fd is not None:
+                        os.close(stdin_fd)
+                    if not last_stage:
+                        os.close(stage_stdout)
+                    stdin_fd = next_stdin_fd
+                if tee:
+                    tee.start(tee_read_fd, tee_write_fd)
+                    tees.append(tee)
+        except Exception:
+            if stdin_fd is not None:
+                os.close(stdin_fd)
+            for process in processes:
+                process.kill()
+                process.communicate()
+            raise
+        finally:
+            if stdout_file:
+                stdout_file.close()
+
+        # Read the stderr of every stage and the stdout of the last one until they are all closed
+        outputs = {}
+        with selectors.DefaultSelector() as selector:
+            for process in processes:
+                outputs[process.stderr] = []
+                selector.register(process.stderr, selectors.EVENT_READ)
+            if processes[-1].stdout:
+                outputs[processes[-1].stdout] = []
+                selector.register(processes[-1].stdout, selectors.EVENT_READ)
+            while selector.get_map():
+                for key, mask in selector.select():
+                    data = key.fileobj.raw.read(READ_SIZE)
+                    if data:
+                        outputs[key.fileobj].append(data)
+                    else:
+                        selector.unregister(key.fileobj)
+                        key.fileobj.close()
+
+        for process in processes:
+            process.wait()
+        for tee in tees:
+            tee.join()
+
+        def decode(chunks):
+            return b"".join(chunks).decode(encoding, errors).rstrip("\n")
+
+        stage_results = []
+        for index, process in enumerate(processes):
+            stage_stdout = decode(outputs[process.stdout]) if process.stdout else ""
+            stage_results.append(ShellCommandResults(self._get_command_string(self.stages[index]), stage_stdout, decode(outputs[process.stderr]), process.returncode))
+
+        exitcode = 0
+        for index, shell_command_results in enumerate(stage_results):
+            killed_by_sigpipe = self._killed_by_sigpipe(self.stages[index], shell_command_results.ExitCode) and index < len(stage_results) - 1
+            if shell_command_results.ExitCode != 0 and not killed_by_sigpipe:
+                exitcode = shell_command_results.ExitCode
+
+        stdout_string = stage_results[-1].Stdout
+        stderr_string = "\n".join(shell_command_results.Stderr for shell_command_results in stage_results if shell_command_results.Stderr)
+        if exitcode != 0:
+            raise ShellPipelineException(command, stdout_string, stderr_string, exitcode, stage_results)
+        return ShellPipelineResults(command, stdout_string, stderr_string, exitcode, stage_results)
+
+
+def execute_pipeline(stages, env=None, cwd=None, executable=None, tees={}, stdout=None, encoding="utf-8", errors="strict"):
+
+    # Run the stages as a ShellPipeline (see above). The tees map the index of a stage to the target
+    # its stdout is teed to. Like Shell.execute_shell_command(), the results are returned if all of the
+    # stages succeed and an exception is raised if any of them fail.
+
+    try:
+        pipeline = ShellPipeline(stages, env, cwd, executable)
+        for stage, target in tees.items():
+            pipeline.tee(stage, target)
+        return pipeline.execute(stdout, encoding, errors)
+    except Exception as ex:
+        raise Exception("An error occurred while executing the shell command.") from ex
@@ -0,0 +1,255 @@
+import subprocess
+import selectors
+import threading
+import queue
+import logging
+import shlex
+import uuid
+import re
+import os
+from ShellUtilities.ShellCommandException import ShellCommandException
+from ShellUtilities.ShellCommandResults import ShellCommandResults
+from ShellUtilities.ShellOutputReader import READ_SIZE
+
+
+logger = logging.getLogger(__name__)
+
+
+class ShellSession():
+
+    # A long lived shell process which commands are sent to over its stdin. This avoids having to
+    # create a new shell for every command, which for small commands (test -f, stat, etc.) costs far
+    # more than the command itself.
+    #
+    # Each command is run in a subshell so that any changes it makes to the environment or working
+    # directory (including the per-command env and cwd overrides) do not leak into later commands.
+    # Its stdin is redirected from /dev/null so that it cannot consume the commands meant for the
+    # session. Once the command has finished, a marker containing a unique sentinel is written to
+    # both stdout and stderr (along with the exit code on stdout); the output is read up until the
+    # markers and split out into ShellCommandResults.
+
+    def __init__(self, executable="/bin/sh", env=None, cwd=None):
+        self.executable = executable
+        self.lock = threading.Lock()
+        self.command_count = 0
+        # Set if the session can no longer be trusted to produce clean output
+        self.polluted = False
+        self.process = subprocess.Popen(
+            [executable],
+            stdin=subprocess.PIPE,
+            stdout=subprocess.PIPE,
+            stderr=subprocess.PIPE,
+            env=env,
+            cwd=cwd
+        )
+        logger.debug("Shell session opened with pid %s.", self.process.pid)
+
+    def is_alive(self):
+        return self.process.poll() is None
+
+    def has_stray_output(self):
+        # Output written while no command is running must have come from something a previous command
+        # left running in the background. It would end up in the output of the next command.
+        with selectors.DefaultSelector() as selector:
+            selector.register(self.process.stdout.fileno(), selectors.EVENT_READ)
+            selector.register(self.process.stderr.fileno(), selectors.EVENT_READ)
+            return len(selector.select(timeout=0)) > 0
+
+    def close(self):
+        if self.process.stdin.closed:
+            return
+        try:
+            self.process.stdin.close()
+        except BrokenPipeError:
+            pass
+        try:
+            self.process.wait(timeout=5)
+        except subprocess.TimeoutExpired:
+            self.process.kill()
+            self.process.wait()
+        self.process.stdout.close()
+        self.process.stderr.close()
+
+    def _build_script(self, command, sentinel, env, cwd):
+        script = ""
+        if cwd:
+            script += "cd {0} || exit 1; ".format(shlex.quote(cwd))
+        for key, value in (env or {}).items():
+            # The key is inserted into the script as it is, so it must not be able to inject code
+            if not isinstance(key, str) or not re.fullmatch(r"[A-Za-z_][A-Za-z0-9_]*", key):
+                raise Exception("The environment variable name {0!r} is not a valid shell identifier.".format(key))
+            if not isinstance(value, str):
+                raise Exception("The value of the environment variable '{0}' must be a string.".format(key))
+            script += "export {0}={1}; ".format(key, shlex.quote(value))
+        script += "eval {0}".format(shlex.quote(command))
+        return "( {0}\n) </dev/null; printf '\\n%s %d\\n' {1} $?; printf '\\n%s\\n' {1} >&2\n".format(script, sentinel)
+
+    def run(self, command, env=None, cwd=None):
+
+        # Runs the command in the session and returns its exit code along with the raw stdout and
+        # stderr. An exception is raised if the session dies before the command completes; the
+        # session can not be used after that.
+
+        with self.lock:
+            if not self.is_alive():
+                raise Exception("The shell session is no longer running.")
+
+            sentinel = "__ShellSession_{0}__".format(uuid.uuid4().hex)
+            self.process.stdin.write(self._build_script(command, sentinel, env, cwd).encode())
+            self.process.stdin.flush()
+            self.command_count += 1
+
+            stdout_marker = "\n{0} ".format(sentinel).encode()
+            stderr_marker = "\n{0}\n".format(sentinel).encode()
+            outputs = {
+                self.process.stdout.fileno(): bytearray(),
+                self.process.stderr.fileno(): bytearray()
+            }
+            markers = {
+                self.process.stdout.fileno(): stdout_marker,
+                self.process.stderr.fileno(): stderr_marker
+            }
+            marker_positions = {}
+
+            # Read both pipes until the markers have been seen on each of them
+            with selectors.DefaultSelector() as selector:
+                for fd in outputs.keys():
+                    selector.register(fd, selectors.EVENT_READ)
+                while len(marker_positions) < len(outputs):
+                    for key, mask in selector.select():
+                        data = os.read(key.fd, READ_SIZE)
+                        if not data:
+                            raise Exception("The shell session exited while executing the command.")
+                        output = outputs[key.fd]
+                        search_start = max(0, len(output) - len(markers[key.fd]))
+                        output += data
+                        position = output.find(markers[key.fd], search_start)
+                        if position != -1:
+                            marker_positions[key.fd] = position
+                            selector.unregister(key.fd)
+
+            # The stdout marker is followed by the exit code and a newline so wait for that too
+            stdout = outputs[self.process.stdout.fileno()]
+            stdout_position = marker_positions[self.process.stdout.fileno()]
+            exitcode_position = stdout_position + len(stdout_marker)
+            while stdout.find(b"\n", exitcode_position) == -1:
+                data = os.read(self.process.stdout.fileno(), READ_SIZE)
+                if not data:
+                    raise Exception("The shell session exited while executing the command.")
+                stdout += data
+            exitcode_end = stdout.find(b"\n", exitcode_position)
+            exitcode = int(stdout[exitcode_position:exitcode_end])
+
+            stderr = outputs[self.process.stderr.fileno()]
+            stderr_position = marker_positions[self.process.stderr.fileno()]
+
+            # Anything after the markers must have been written by something the command left running
+            # in the background
+            if len(stdout) > exitcode_end + 1 or len(stderr) > stderr_position + len(stderr_marker):
+                self.polluted = True
+
+            return exitcode, bytes(stdout[:stdout_position]), bytes(stderr[:stderr_position])
+
+
+class ShellPool():
+
+    # A pool of warm ShellSessions. Up to <size> commands can be run concurrently; each one borrows an
+    # idle session (starting one if fewer than <size> exist) and returns it once the command is done.
+    # A session is replaced if it dies, if something left running by a command writes to its output
+    # or, when max_session_commands is given, once it has run that many commands.
+
+    def __init__(self, size=1, executable="/bin/sh", env=None, cwd=None, max_session_commands=None):
+        self.size = size
+        self.executable = executable
+        self.env = env
+        self.cwd = cwd
+        self.max_session_commands = max_session_commands
+        self.idle_sessions = queue.LifoQueue()
+        self.available = threading.Semaphore(size)
+        self.sessions = []
+        self.lock = threading.Lock()
+        self.closed = False
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def close(self):
+        with self.lock:
+            self.closed = True
+            sessions = self.sessions
+            self.sessions = []
+        for session in sessions:
+            session.close()
+
+    def _acquire_session(self):
+        self.available.acquire()
+        while True:
+            try:
+                session = self.idle_sessions.get_nowait()
+            except queue.Empty:
+                try:
+                    session = ShellSession(self.executable, self.env, self.cwd)
+                except BaseException:
+                    # The slot would otherwise be lost (and the pool would hang once all of them were)
+                    self.available.release()
+                    raise
+                with self.lock:
+                    self.sessions.append(session)
+                return session
+            # The session may have been polluted or died while it was idle
+            if session.is_alive() and not session.has_stray_output():
+                return session
+            self._recycle_session(session)
+
+    def _release_session(self, session):
+        recycle = self.closed or session.polluted or not session.is_alive()
+        if self.max_session_commands and session.command_count >= self.max_session_commands:
+            recycle = True
+        if recycle:
+            self._recycle_session(session)
+        else:
+            self.idle_sessions.put(session)
+        self.available.release()
+
+    def _recycle_session(self, session):
+        logger.debug("Recycling shell session with pid %s.", session.process.pid)
+        session.close()
+        with self.lock:
+            if session in self.sessions:
+                self.sessions.remove(session)
+
+    def execute_shell_command(self, command, env=None, cwd=None, encoding="utf-8", errors="strict"):
+
+        # Runs the command in one of the sessions of the pool. The env is merged into the environment
+        # of the session for this command only. Like Shell.execute_shell_command(), the results are
+        # returned if the command succeeds and an exception is raised if it fails.
+
+        try:
+
+            if self.closed:
+                raise Exception("The shell pool has been closed.")
+
+            if cwd and not os.path.isdir(cwd):
+                raise Exception("The working directory '{0}' does not exist.".format(cwd))
+
+            logger.debug("Running shell command in session:")
+            logger.debug("%s", command)
+
+            session = self._acquire_session()
+            try:
+                exitcode, stdout, stderr = session.run(command, env, cwd)
+            finally:
+                self._release_session(session)
+
+            stdout = stdout.decode(encoding, errors).rstrip("\n")
+            stderr = stderr.decode(encoding, errors).rstrip("\n")
+
+            if exitcode != 0:
+                raise ShellCommandException(command, stdout, stderr, exitcode)
+            return ShellCommandResults(command, stdout, stderr, exitcode)
+
+        except Exception as ex:
+            raise Exception("An error occurred while executing the shell command.") from ex
@@ -1,6 +1,7 @@
 from unittest import TestCase
 from ShellUtilities import Shell
 from ShellUtilities.ShellCommandResults import ShellCommandResults
+from ShellUtilities.ShellCommandException import ShellCommandException, ShellCommandTimeoutException, ShellCommandBatchException
 import platform
 import os
 import time
@@ -10,6 +11,10 @@ import tracemalloc
 import logging
 import io
 import sys
+import asyncio
+import tempfile
+import mmap
+import signal
 
 logging.basicConfig(level=logging.DEBUG)
 
@@ -214,4 +219,482 @@ class Test_Shell(TestCase):
             self.assertEqual(0, shell_command_results.ExitCode)
             self.assertTrue(shell_command_results.pid > 0)
             self.assertEqual(4, len(shell_command_results.stdout_lines))
-            self.assertEqual(0, len(shell_command_results.stderr_lines))
\ No newline at end of file
+            self.assertEqual(0, len(shell_command_results.stderr_lines))
+
+    def test__execute_shell_command_async__success__print_env_var(self):
+        shell_command_string = "echo $MYVAR"
+        shell_command_result = asyncio.run(Shell.execute_shell_command_async(shell_command_string, env={"MYVAR": "Hello, World!"}))
+        self.assertEqual(0, shell_command_result.ExitCode)
+        self.assertEqual("", shell_command_result.Stderr)
+        self.assertEqual("Hello, World!", shell_command_result.Stdout)
+
+    def test__execute_shell_command_async__failure__cancelled(self):
+        def assert_killed(pid_file):
+            with open(pid_file) as file:
+                pid = int(file.read())
+            # An orphaned process is only a zombie until init gets around to reaping it
+            try:
+                with open("/proc/{0}/stat".format(pid)) as file:
+                    self.assertEqual("Z", file.read().rsplit(")", 1)[1].split()[0])
+            except FileNotFoundError:
+                pass
+
+        def failing_callback(line):
+            raise ValueError("The callback failed.")
+
+        with tempfile.TemporaryDirectory() as temp_dir:
+            pid_file = os.path.join(temp_dir, "pid")
+            command = "echo $$ > {0}; echo 'a'; exec sleep 30".format(pid_file)
+            with self.assertRaises(asyncio.TimeoutError):
+                asyncio.run(asyncio.wait_for(Shell.execute_shell_command_async(command), 0.5))
+            assert_killed(pid_file)
+
+            with self.assertRaises(Exception):
+                asyncio.run(Shell.execute_shell_command_async(command, async_buffer_funcs={"stdout": [failing_callback]}))
+            assert_killed(pid_file)
+
+            # The processes started by the shell, which hold the pipes open, are killed along with it
+            command = "sleep 30 & echo $! > {0}; echo 'a'; wait".format(pid_file)
+            start_time = time.monotonic()
+            with self.assertRaises(asyncio.TimeoutError):
+                asyncio.run(asyncio.wait_for(Shell.execute_shell_command_async(command), 0.5))
+            self.assertLess(time.monotonic() - start_time, 5)
+            assert_killed(pid_file)
+
+    def test__execute_shell_command_async__success__concurrent_commands(self):
+        stdout_lines = []
+
+        async def stdout_func(stdout_line):
+            stdout_lines.append(stdout_line)
+
+        async def run_commands():
+            return await asyncio.gather(*[
+                Shell.execute_shell_command_async(f"sleep 1; echo {i}", async_buffer_funcs={"stdout": [stdout_func]})
+                for i in range(50)
+            ])
+
+        start = time.time()
+        shell_command_results = asyncio.run(run_commands())
+        self.assertLess(time.time() - start, 10)
+        self.assertEqual([str(i) for i in range(50)], [result.Stdout for result in shell_command_results])
+        self.assertEqual(sorted(str(i) for i in range(50)), sorted(stdout_lines))
+
+    def test__execute_shell_command_async__failure__python_script_raise_exception(self):
+        current_directory = os.path.dirname(os.path.abspath(__file__))
+        script_path = os.path.join(current_directory, "scripts", "fail.py")
+        shell_command_string = f"python3 '{script_path}'"
+        with self.assertRaises(Exception) as context:
+            asyncio.run(Shell.execute_shell_command_async(shell_command_string, max_retries=2, retry_delay=0))
+        shell_command_exception = context.exception.__cause__
+        self.assertIsInstance(shell_command_exception, ShellCommandException)
+        self.assertEqual(1, shell_command_exception.ExitCode)
+        self.assertIn("Hello, World!", shell_command_exception.Stderr)
+
+    def test__execute_shell_commands__success__completion_order(self):
+        shell_commands = [
+            {"command": "sleep 2; echo $MYVAR", "env": {"MYVAR": "slow"}},
+            {"command": "echo $MYVAR", "env": {"MYVAR": "fast"}},
+            {"command": "pwd", "cwd": os.path.dirname(os.path.abspath(__file__))},
+        ]
+        shell_command_results = list(Shell.execute_shell_commands(shell_commands, max_workers=3))
+        self.assertEqual(3, len(shell_command_results))
+        self.assertEqual("slow", shell_command_results[-1].Stdout)
+        self.assertIn("fast", [result.Stdout for result in shell_command_results])
+        self.assertIn(os.path.dirname(os.path.abspath(__file__)), [result.Stdout for result in shell_command_results])
+
+    def test__execute_shell_commands__success__bounded_concurrency(self):
+        start = time.time()
+        shell_command_results = list(Shell.execute_shell_commands(["sleep 1"] * 4, max_workers=2))
+        self.assertEqual(4, len(shell_command_results))
+        self.assertGreaterEqual(time.time() - start, 2)
+
+    def test__execute_shell_commands__failure__aggregated_exceptions(self):
+        shell_commands = ["echo a", "exit 2", "echo b", "exit 3"]
+        shell_command_results = []
+        with self.assertRaises(ShellCommandBatchException) as context:
+            for shell_command_result in Shell.execute_shell_commands(shell_commands, max_workers=2):
+                shell_command_results.append(shell_command_result)
+        self.assertEqual(["a", "b"], sorted(result.Stdout for result in shell_command_results))
+        exit_codes = sorted(exception.ExitCode for exception in context.exception.Exceptions)
+        self.assertEqual([2, 3], exit_codes)
+        for exception in context.exception.Exceptions:
+            self.assertIsInstance(exception, ShellCommandException)
+
+    def test__execute_shell_commands__failure__fail_fast(self):
+        shell_commands = ["exit 1"] + ["sleep 1"] * 10
+        start = time.time()
+        with self.assertRaises(ShellCommandBatchException) as context:
+            list(Shell.execute_shell_commands(shell_commands, max_workers=1, fail_fast=True))
+        self.assertLess(time.time() - start, 5)
+        self.assertEqual(1, len(context.exception.Exceptions))
+
+    def test__iter_lines__success__backpressure(self):
+        shell_command_string = r"echo 'a'; echo 'b' 1>&2; seq 1 100000; echo 'c'"
+        shell_command_results = Shell.execute_shell_command(shell_command_string, blocking=False, output_retention="none", line_queue_size=10)
+        time.sleep(0.5)
+        # The reader is blocked on the full queue so the command cannot have completed
+        self.assertTrue(shell_command_results.command_running())
+        self.assertEqual(10, len(shell_command_results.line_queues["stdout"]))
+        lines = list(shell_command_results.iter_lines())
+        shell_command_results.wait()
+        self.assertEqual(100003, len(lines))
+        # The order of the lines across the two streams depends on when they were read
+        stdout_lines = [line for stream, line in lines if stream == "stdout"]
+        self.assertEqual(["a"] + [str(i) for i in range(1, 100001)] + ["c"], stdout_lines)
+        self.assertIn(("stderr", "b"), lines)
+        self.assertEqual(0, len(shell_command_results.stdout_lines))
+
+    def test__iter_stdout__success__ignores_stderr(self):
+        shell_command_string = r"seq 1 100000 1>&2; echo 'a'; echo 'b'"
+        shell_command_results = Shell.execute_shell_command(shell_command_string, blocking=False, line_queue_size=10)
+        self.assertEqual(["a", "b"], list(shell_command_results.iter_stdout()))
+        shell_command_results.wait()
+        self.assertEqual(100000, len(shell_command_results.stderr_lines))
+
+    def test__iter_lines__success__stop_iterating(self):
+        # Once the consumer stops iterating, the rest of the output is read without being queued
+        for use_reactor in [False, True]:
+            shell_command_results = Shell.execute_shell_command("seq 1 100000", blocking=False, use_reactor=use_reactor, line_queue_size=10)
+            for line in shell_command_results.iter_stdout():
+                break
+            self.assertEqual("1", line)
+            self.assertTrue(shell_command_results.wait(timeout=10))
+            self.assertEqual("100000", shell_command_results.stdout_lines[-1])
+
+            shell_command_results = Shell.execute_shell_command("seq 1 100000", blocking=False, use_reactor=use_reactor, line_queue_size=10)
+            lines = shell_command_results.iter_lines()
+            self.assertEqual(("stdout", "1"), next(lines))
+            lines.close()
+            self.assertTrue(shell_command_results.wait(timeout=10))
+
+    def test__iter_lines__failure__not_enabled(self):
+        shell_command_results = Shell.execute_shell_command("echo 'a'", blocking=False)
+        with self.assertRaises(Exception):
+            list(shell_command_results.iter_lines())
+        shell_command_results.wait()
+
+    def test__execute_shell_command__success__binary(self):
+        shell_command_string = r"printf '\000\377\376'; printf 'caf\303\251\n'"
+        shell_command_result = Shell.execute_shell_command(shell_command_string, binary=True, errors="replace")
+        self.assertEqual(0, shell_command_result.ExitCode)
+        self.assertEqual(b"\x00\xff\xfecaf\xc3\xa9\n", shell_command_result.StdoutBytes)
+        self.assertEqual(b"caf", memoryview(shell_command_result.StdoutBytes)[3:6])
+        self.assertEqual("\x00\ufffd\ufffdcafé", shell_command_result.Stdout)
+        self.assertEqual(b"", shell_command_result.StderrBytes)
+
+        shell_command_result = asyncio.run(Shell.execute_shell_command_async(shell_command_string, binary=True, errors="replace"))
+        self.assertEqual(b"\x00\xff\xfecaf\xc3\xa9\n", shell_command_result.StdoutBytes)
+        self.assertEqual("\x00\ufffd\ufffdcafé", shell_command_result.Stdout)
+
+    def test__execute_shell_command__success__binary_non_blocking(self):
+        chunks = []
+        shell_command_string = r"printf 'caf\303'; sleep 1; printf '\251'"
+        shell_command_results = Shell.execute_shell_command(shell_command_string, blocking=False, binary=True, async_buffer_funcs={"stdout": [chunks.append]})
+        time.sleep(0.5)
+        # The multibyte character has been split across reads
+        self.assertEqual("caf", shell_command_results.Stdout)
+        shell_command_results.wait()
+        self.assertEqual([b"caf\xc3", b"\xa9"], chunks)
+        self.assertEqual(b"caf\xc3\xa9", shell_command_results.StdoutBytes)
+        self.assertEqual("café", shell_command_results.Stdout)
+
+    def test__execute_shell_command__success__encoding_errors(self):
+        shell_command_string = r"printf 'a\377b\n'"
+        shell_command_result = Shell.execute_shell_command(shell_command_string, errors="replace")
+        self.assertEqual("a\ufffdb", shell_command_result.Stdout)
+        shell_command_result = Shell.execute_shell_command(shell_command_string, encoding="latin-1")
+        self.assertEqual("a\xffb", shell_command_result.Stdout)
+        shell_command_results = Shell.execute_shell_command(shell_command_string, blocking=False, use_reactor=True, errors="replace")
+        shell_command_results.wait()
+        self.assertEqual(["a\ufffdb"], shell_command_results.stdout_lines)
+        with self.assertRaises(Exception):
+            Shell.execute_shell_command(shell_command_string)
+
+    def test__wait__success__timeout_and_done_callback(self):
+        done_results = []
+        shell_command_results = Shell.execute_shell_command("sleep 1", blocking=False)
+        shell_command_results.add_done_callback(done_results.append)
+        self.assertFalse(shell_command_results.wait(timeout=0.1))
+        self.assertTrue(shell_command_results.command_running())
+        self.assertEqual([], done_results)
+        self.assertTrue(shell_command_results.wait(timeout=5))
+        self.assertEqual([shell_command_results], done_results)
+        # Callbacks added after completion are invoked immediately
+        shell_command_results.add_done_callback(done_results.append)
+        self.assertEqual(2, len(done_results))
+
+    def test__wait_any__success__first_completed(self):
+        slow_results = Shell.execute_shell_command("sleep 2", blocking=False)
+        fast_results = Shell.execute_shell_command("sleep 0.2", blocking=False, use_reactor=True)
+        start = time.time()
+        self.assertIs(fast_results, Shell.wait_any([slow_results, fast_results]))
+        self.assertLess(time.time() - start, 1.5)
+        self.assertIsNone(Shell.wait_any([slow_results], timeout=0.1))
+        self.assertTrue(Shell.wait_all([slow_results, fast_results]))
+
+    def test__wait_all__failure__aggregated_exceptions(self):
+        shell_command_results = [Shell.execute_shell_command(f"exit {i}", blocking=False) for i in range(3)]
+        with self.assertRaises(ShellCommandBatchException) as context:
+            Shell.wait_all(shell_command_results)
+        self.assertEqual([1, 2], [exception.ExitCode for exception in context.exception.Exceptions])
+        self.assertFalse(Shell.wait_all([Shell.execute_shell_command("sleep 1", blocking=False)], timeout=0.1))
+
+    def test__execute_shell_command__success__argv(self):
+        shell_command_result = Shell.execute_shell_command(["echo", "$MYVAR", "a  b;c"], env={"MYVAR": "Hello, World!"})
+        self.assertEqual(0, shell_command_result.ExitCode)
+        self.assertEqual("$MYVAR a  b;c", shell_command_result.Stdout)
+
+        shell_command_result = Shell.execute_shell_command("printf '%s|' 'a b' c", shell=False)
+        self.assertEqual("a b|c|", shell_command_result.Stdout)
+
+        current_dir = os.path.dirname(os.path.abspath(__file__))
+        shell_command_results = Shell.execute_shell_command(["pwd"], cwd=current_dir, blocking=False)
+        shell_command_results.wait()
+        self.assertEqual([current_dir], shell_command_results.stdout_lines)
+
+        shell_command_result = asyncio.run(Shell.execute_shell_command_async(["echo", "a  b"]))
+        self.assertEqual("a  b", shell_command_result.Stdout)
+
+    def test__execute_shell_command__failure__argv(self):
+        with self.assertRaises(Exception) as context:
+            Shell.execute_shell_command(["false"])
+        self.assertEqual(1, context.exception.__cause__.ExitCode)
+        with self.assertRaises(Exception) as context:
+            Shell.execute_shell_command(["a-program-which-does-not-exist"])
+        self.assertIsInstance(context.exception.__cause__, FileNotFoundError)
+
+    def test__execute_shell_command__failure__timeout(self):
+        # The background sleep would keep the pipes open if only the shell was killed
+        for output_retention in ["all", "lines"]:
+            start_time = time.monotonic()
+            with self.assertRaises(Exception) as context:
+                Shell.execute_shell_command("echo 'partial'; sleep 30 & sleep 30", timeout=0.5, output_retention=output_retention, output_retention_limit=10)
+            self.assertLess(time.monotonic() - start_time, 5)
+            shell_command_exception = context.exception.__cause__
+            self.assertIsInstance(shell_command_exception, ShellCommandTimeoutException)
+            self.assertEqual("partial", shell_command_exception.Stdout)
+            self.assertEqual(-9, shell_command_exception.ExitCode)
+
+        # A process which left the process group escapes the kill, so its pipes are only read for a
+        # short while afterwards
+        for output_retention in ["all", "lines"]:
+            with tempfile.TemporaryDirectory() as temp_dir:
+                start_time = time.monotonic()
+                with self.assertRaises(Exception) as context:
+                    Shell.execute_shell_command("echo 'partial'; setsid sleep 30 & echo $! > pid; sleep 30", cwd=temp_dir, timeout=0.5, output_retention=output_retention, output_retention_limit=10)
+                self.assertLess(time.monotonic() - start_time, 5)
+                self.assertIsInstance(context.exception.__cause__, ShellCommandTimeoutException)
+                self.assertEqual("partial", context.exception.__cause__.Stdout)
+                with open(os.path.join(temp_dir, "pid")) as file:
+                    os.kill(int(file.read()), signal.SIGKILL)
+
+        # The deadline covers all of the attempts
+        start_time = time.monotonic()
+        with self.assertRaises(Exception) as context:
+            Shell.execute_shell_command("sleep 30", max_retries=10, retry_delay=0.1, timeout=0.4, deadline=1)
+        self.assertLess(time.monotonic() - start_time, 2)
+        self.assertIsInstance(context.exception.__cause__, ShellCommandTimeoutException)
+
+    def test__execute_shell_command__success__backoff_and_retry_predicate(self):
+        with tempfile.TemporaryDirectory() as temp_dir:
+            with self.assertRaises(Exception):
+                Shell.execute_shell_command("echo x >> attempts; false", max_retries=4, retry_delay=0.05, retry_backoff=2, max_retry_delay=0.1, retry_jitter=0.5, cwd=temp_dir)
+            with open(os.path.join(temp_dir, "attempts")) as file:
+                self.assertEqual(4, len(file.readlines()))
+
+        # Only retry when the failure looks transient
+        attempts = []
+        def retry_predicate(shell_command_exception):
+            attempts.append(shell_command_exception)
+            return "transient" in shell_command_exception.Stderr
+        with self.assertRaises(Exception) as context:
+            Shell.execute_shell_command("echo 'fatal' 1>&2; exit 2", max_retries=5, retry_delay=0, retry_predicate=retry_predicate)
+        self.assertEqual(1, len(attempts))
+        self.assertEqual(2, context.exception.__cause__.ExitCode)
+
+    def test__execute_shell_command__failure__retry_options(self):
+        # A jitter outside of 0 to 1 would make the delay negative (or longer) and a backoff below 1
+        # would shrink it, so they are rejected before the command is run
+        for kwargs in [{"retry_jitter": 2}, {"retry_jitter": -0.5}, {"retry_backoff": 0.5}]:
+            with tempfile.TemporaryDirectory() as temp_dir:
+                with self.assertRaises(Exception) as context:
+                    Shell.execute_shell_command("touch ran", max_retries=2, retry_delay=0, cwd=temp_dir, **kwargs)
+                self.assertNotIsInstance(context.exception.__cause__, ShellCommandException)
+                self.assertFalse(os.path.exists(os.path.join(temp_dir, "ran")))
+
+    def test__execute_shell_command__success__output_echo(self):
+        # The output is logged through the logger of the package rather than the root logger
+        with self.assertLogs("ShellUtilities", level=logging.DEBUG) as context:
+            Shell.execute_shell_command("seq 1 10", output_echo="tail", output_echo_limit=2)
+        messages = [record.getMessage() for record in context.records]
+        self.assertIn("9", messages)
+        self.assertIn("10", messages)
+        self.assertNotIn("8", messages)
+
+        with self.assertLogs("ShellUtilities", level=logging.DEBUG) as context:
+            Shell.execute_shell_command("seq 1 10", output_echo="head", output_echo_limit=1)
+        messages = [record.getMessage() for record in context.records]
+        self.assertIn("1", messages)
+        self.assertNotIn("2", messages)
+
+        with self.assertLogs("ShellUtilities", level=logging.DEBUG) as context:
+            Shell.execute_shell_command("seq 1 10; echo 'oops' 1>&2", output_echo="none")
+        messages = [record.getMessage() for record in context.records]
+        self.assertNotIn("1", messages)
+        self.assertNotIn("oops", messages)
+
+        with self.assertRaises(Exception):
+            Shell.execute_shell_command("seq 1 10", output_echo="tail")
+
+    def test__execute_shell_command__success__callback_dispatch(self):
+        for use_reactor in [False, True]:
+            # A slow callback does not hold up the command but still sees every line
+            lines = []
+            def slow_callback(line):
+                time.sleep(0.001)
+                lines.append(line)
+            shell_command_results = Shell.execute_shell_command("seq 1 200", blocking=False, use_reactor=use_reactor, async_buffer_funcs={"stdout": [slow_callback]}, callback_queue_size=10)
+            shell_command_results.wait()
+            self.assertEqual([str(i) for i in range(1, 201)], lines)
+            stats = shell_command_results.callback_stats()
+            self.assertEqual(200, stats["dispatched"])
+            self.assertEqual(0, stats["dropped"])
+
+            # The lines which do not fit in the queue are dropped
+            for callback_overflow in ["drop_oldest", "drop_newest"]:
+                lines = []
+                shell_command_results = Shell.execute_shell_command("seq 1 200", blocking=False, use_reactor=use_reactor, async_buffer_funcs={"stdout": [slow_callback]}, callback_queue_size=10, callback_overflow=callback_overflow)
+                shell_command_results.wait()
+                stats = shell_command_results.callback_stats()
+                self.assertEqual(200, stats["dispatched"] + stats["dropped"])
+                self.assertEqual(stats["dispatched"], len(lines))
+                self.assertGreater(stats["dropped"], 0)
+                self.assertEqual(callback_overflow == "drop_oldest", "200" in lines)
+
+            # Batches are delivered when they are full or once the interval has passed
+            batches = []
+            shell_command_results = Shell.execute_shell_command("seq 1 25", blocking=False, use_reactor=use_reactor, async_buffer_funcs={"stdout": [batches.append]}, callback_queue_size=100, callback_batch_size=10)
+            shell_command_results.wait()
+            self.assertEqual([10, 10, 5], [len(batch) for batch in batches])
+            self.assertEqual(3, shell_command_results.callback_stats()["batches"])
+
+            batches = []
+            shell_command_results = Shell.execute_shell_command("echo 'a'; sleep 0.5; echo 'b'", blocking=False, use_reactor=use_reactor, async_buffer_funcs={"stdout": [batches.append]}, callback_queue_size=100, callback_batch_interval=0.1)
+            shell_command_results.wait()
+            self.assertEqual([["a"], ["b"]], batches)
+
+    def test__execute_shell_command__failure__callback_dispatch(self):
+        with self.assertRaises(Exception):
+            Shell.execute_shell_command("echo 'a'", callback_queue_size=10)
+        with self.assertRaises(Exception):
+            Shell.execute_shell_command("echo 'a'", blocking=False, callback_queue_size=10, callback_overflow="wait")
+        with self.assertRaises(Exception):
+            Shell.execute_shell_command("echo 'a'", blocking=False, callback_batch_size=10)
+        shell_command_results = Shell.execute_shell_command("echo 'a'", blocking=False)
+        shell_command_results.wait()
+        with self.assertRaises(Exception):
+            shell_command_results.callback_stats()
+
+    def test__execute_shell_command__success__failing_callback(self):
+        # A callback which raises is logged and the output is still read, so the command completes
+        def callback(line):
+            lines.append(line)
+            raise Exception("Broken callback")
+        for use_reactor in [False, True]:
+            lines = []
+            with self.assertLogs("ShellUtilities", level=logging.ERROR):
+                shell_command_results = Shell.execute_shell_command("seq 1 3", blocking=False, use_reactor=use_reactor, async_buffer_funcs={"stdout": [callback]})
+                self.assertTrue(shell_command_results.wait(timeout=10))
+            self.assertEqual(0, shell_command_results.ExitCode)
+            self.assertEqual(["1", "2", "3"], lines)
+            self.assertEqual(["1", "2", "3"], shell_command_results.stdout_lines)
+
+    def test__execute_shell_command__success__input(self):
+        # More input than fits in a pipe is written while the output is read
+        data = b"x" * (4 * 1024 * 1024) + b"\n"
+        self.assertEqual(data[:-1], Shell.execute_shell_command("cat", input=data, binary=True).StdoutBytes[:-1])
+        self.assertEqual("h\u00e9llo", Shell.execute_shell_command("cat", input="h\u00e9llo").Stdout)
+        self.assertEqual("100000", Shell.execute_shell_command("wc -l", input=("{0}\n".format(i) for i in range(100000))).Stdout)
+
+        async def async_chunks():
+            for chunk in ["a\n", b"b\n"]:
+                await asyncio.sleep(0.01)
+                yield chunk
+        self.assertEqual("a\nb", Shell.execute_shell_command("cat", input=async_chunks()).Stdout)
+
+        with tempfile.TemporaryFile() as file:
+            file.write(data)
+            # Files are read from their current position
+            file.seek(1024)
+            self.assertEqual(str(len(data) - 1024), Shell.execute_shell_command("wc -c", input=file).Stdout)
+            self.assertEqual(len(data), file.tell())
+            with mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ) as memory_map:
+                self.assertEqual(str(len(data)), Shell.execute_shell_command("wc -c", input=memory_map).Stdout)
+        self.assertEqual("a\nb", Shell.execute_shell_command("cat", input=io.StringIO("a\nb")).Stdout)
+
+        # The rest of the input is discarded if the process does not read it
+        self.assertEqual("xxxx", Shell.execute_shell_command("head -c 4", input=data).Stdout)
+
+        for use_reactor in [False, True]:
+            shell_command_results = Shell.execute_shell_command("wc -c", input=data, blocking=False, use_reactor=use_reactor)
+            shell_command_results.wait()
+            self.assertEqual(str(len(data)), shell_command_results.Stdout.strip())
+
+        shell_command_results = asyncio.run(Shell.execute_shell_command_async("wc -c", input=data))
+        self.assertEqual(str(len(data)), shell_command_results.Stdout)
+        shell_command_results = asyncio.run(Shell.execute_shell_command_async("cat", input=async_chunks()))
+        self.assertEqual("a\nb", shell_command_results.Stdout)
+        with tempfile.TemporaryFile() as file:
+            file.write(data)
+            file.flush()
+            with mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ) as memory_map:
+                shell_command_results = asyncio.run(Shell.execute_shell_command_async("wc -c", input=memory_map))
+                self.assertEqual(str(len(data)), shell_command_results.Stdout)
+            file.seek(0)
+            shell_command_results = asyncio.run(Shell.execute_shell_command_async("wc -c", input=file))
+            self.assertEqual(str(len(data)), shell_command_results.Stdout)
+
+    def test__execute_shell_command__failure__input(self):
+        def failing_chunks():
+            yield "a\n"
+            raise ValueError("The input is not available.")
+        with self.assertRaises(Exception) as context:
+            Shell.execute_shell_command("cat", input=failing_chunks())
+        self.assertIsInstance(context.exception.__cause__, ValueError)
+
+        shell_command_results = Shell.execute_shell_command("cat", input=failing_chunks(), blocking=False)
+        with self.assertRaises(Exception) as context:
+            shell_command_results.wait()
+        self.assertIsInstance(context.exception.__cause__, ValueError)
+
+        with self.assertRaises(Exception):
+            Shell.execute_shell_command("cat", input=5)
+
+    def test__wait_for__success__readiness(self):
+        for use_reactor in [False, True]:
+            shell_command_results = Shell.execute_shell_command("echo 'starting'; sleep 0.2; echo 'listening on port 8080' 1>&2; sleep 0.2; seq 1 1000", blocking=False, use_reactor=use_reactor)
+            match = shell_command_results.wait_for(r"listening on port (\d+)", stream="any", retain_output=False)
+            self.assertEqual("8080", match.group(1))
+            self.assertTrue(shell_command_results.command_running())
+            shell_command_results.wait()
+            # The output after the match was not retained
+            self.assertEqual("starting\n", shell_command_results.Stdout)
+
+            # The lines which have already been retained are searched
+            self.assertEqual("starting", shell_command_results.wait_for("start.*").group(0))
+
+            shell_command_results = Shell.execute_shell_command("sleep 1", blocking=False, use_reactor=use_reactor)
+            self.assertIsNone(shell_command_results.wait_for("never", timeout=0.1))
+            shell_command_results.wait()
+
+    def test__wait_for__failure__exited_without_match(self):
+        shell_command_results = Shell.execute_shell_command("echo 'a'; sleep 0.2; exit 3", blocking=False)
+        start_time = time.monotonic()
+        with self.assertRaises(Exception):
+            shell_command_results.wait_for("listening", timeout=10)
+        self.assertLess(time.monotonic() - start_time, 5)
+        self.assertEqual(3, shell_command_results.ExitCode)
+
+        with self.assertRaises(Exception):
+            shell_command_results.wait_for("a", stream="stdin")
+
@@ -0,0 +1,82 @@
+from unittest import TestCase
+from ShellUtilities.ShellCommandCache import ShellCommandCache
+from ShellUtilities.ShellCommandException import ShellCommandException
+import concurrent.futures
+import tempfile
+import time
+
+
+class Test_ShellCommandCache(TestCase):
+
+    def test__execute_shell_command__success__hits_and_misses(self):
+        shell_command_cache = ShellCommandCache()
+        first_results = shell_command_cache.execute_shell_command("date +%s%N")
+        second_results = shell_command_cache.execute_shell_command("date +%s%N")
+        self.assertIs(first_results, second_results)
+
+        # The env and cwd are part of the key
+        shell_command_results = shell_command_cache.execute_shell_command("echo $A; pwd", env={"A": "a"}, cwd="/")
+        self.assertEqual("a\n/", shell_command_results.Stdout)
+        shell_command_results = shell_command_cache.execute_shell_command("echo $A; pwd", env={"A": "b"}, cwd="/")
+        self.assertEqual("b\n/", shell_command_results.Stdout)
+
+        stats = shell_command_cache.stats()
+        self.assertEqual(1, stats["hits"])
+        self.assertEqual(3, stats["misses"])
+        self.assertEqual(3, stats["entries"])
+
+        shell_command_cache.invalidate("date +%s%N")
+        self.assertIsNot(first_results, shell_command_cache.execute_shell_command("date +%s%N"))
+
+    def test__execute_shell_command__success__failures_not_cached(self):
+        shell_command_cache = ShellCommandCache()
+        for i in range(2):
+            with self.assertRaises(Exception) as context:
+                shell_command_cache.execute_shell_command("exit 3")
+            self.assertIsInstance(context.exception.__cause__, ShellCommandException)
+        self.assertEqual(2, shell_command_cache.stats()["misses"])
+
+    def test__execute_shell_command__success__eviction(self):
+        shell_command_cache = ShellCommandCache(max_entries=2)
+        for i in range(3):
+            shell_command_cache.execute_shell_command("echo {0}".format(i))
+        shell_command_cache.execute_shell_command("echo 1")
+        shell_command_cache.execute_shell_command("echo 0")
+        # echo 0 was the least recently used so it was evicted
+        stats = shell_command_cache.stats()
+        self.assertEqual(1, stats["hits"])
+        self.assertEqual(4, stats["misses"])
+        self.assertEqual(2, stats["evictions"])
+
+        shell_command_cache = ShellCommandCache(max_bytes=8)
+        shell_command_cache.execute_shell_command("echo 12345")
+        shell_command_cache.execute_shell_command("echo 67890")
+        self.assertEqual(1, shell_command_cache.stats()["entries"])
+
+        shell_command_cache = ShellCommandCache(ttl=0.1)
+        shell_command_cache.execute_shell_command("echo a")
+        time.sleep(0.2)
+        shell_command_cache.execute_shell_command("echo a")
+        self.assertEqual(2, shell_command_cache.stats()["misses"])
+
+    def test__execute_shell_command__success__single_flight(self):
+        shell_command_cache = ShellCommandCache()
+        with concurrent.futures.ThreadPoolExecutor(max_workers=8) as executor:
+            results = list(executor.map(lambda i: shell_command_cache.execute_shell_command("sleep 0.5; date +%s%N"), range(8)))
+        self.assertEqual(1, len(set(id(shell_command_results) for shell_command_results in results)))
+        stats = shell_command_cache.stats()
+        self.assertEqual(1, stats["misses"])
+        self.assertEqual(8, stats["misses"] + stats["hits"] + stats["coalesced"])
+
+    def test__execute_shell_command__success__disk(self):
+        with tempfile.TemporaryDirectory() as path:
+            first_results = ShellCommandCache(path=path).execute_shell_command("date +%s%N")
+            shell_command_cache = ShellCommandCache(path=path)
+            second_results = shell_command_cache.execute_shell_command("date +%s%N")
+            self.assertEqual(first_results.Stdout, second_results.Stdout)
+            self.assertEqual(1, shell_command_cache.stats()["disk_hits"])
+
+            shell_command_cache.clear()
+            shell_command_cache = ShellCommandCache(path=path)
+            shell_command_cache.execute_shell_command("date +%s%N")
+            self.assertEqual(1, shell_command_cache.stats()["misses"])
@@ -0,0 +1,82 @@
+from unittest import TestCase
+from ShellUtilities import Shell
+from ShellUtilities.ShellCommandMetrics import add_metrics_sink, remove_metrics_sink
+from ShellUtilities.ShellForkServer import ShellForkServer
+import asyncio
+import sys
+
+
+class Test_ShellCommandMetrics(TestCase):
+
+    def assertOutputCounted(self, metrics):
+        self.assertEqual(8, metrics.StdoutByteCount)
+        self.assertEqual(3, metrics.StdoutLineCount)
+        self.assertEqual(2, metrics.StderrByteCount)
+        self.assertEqual(1, metrics.StderrLineCount)
+        self.assertGreater(metrics.SpawnLatency, 0)
+        self.assertLessEqual(metrics.SpawnLatency, metrics.TimeToFirstOutput)
+        self.assertLessEqual(metrics.TimeToFirstOutput, metrics.WallTime)
+
+    def test__execute_shell_command__success__output_counts(self):
+        command = "printf 'a\\nbb\\nccc'; echo 'x' 1>&2"
+        for kwargs in [{}, {"output_retention": "lines", "output_retention_limit": 1}]:
+            shell_command_results = Shell.execute_shell_command(command, **kwargs)
+            self.assertOutputCounted(shell_command_results.Metrics)
+            self.assertEqual(0, shell_command_results.Metrics.ExitCode)
+
+        for use_reactor in [False, True]:
+            shell_command_results = Shell.execute_shell_command(command, blocking=False, use_reactor=use_reactor)
+            shell_command_results.wait()
+            self.assertOutputCounted(shell_command_results.Metrics)
+
+        shell_command_results = asyncio.run(Shell.execute_shell_command_async(command))
+        self.assertOutputCounted(shell_command_results.Metrics)
+        self.assertIsNone(shell_command_results.Metrics.UserTime)
+
+    def test__execute_shell_command__success__rusage(self):
+        # Burn some CPU and allocate 64MB
+        command = [sys.executable, "-c", "b = bytearray(64 * 1024 * 1024); sum(range(3000000))"]
+        shell_command_results = Shell.execute_shell_command(command)
+        self.assertGreater(shell_command_results.Metrics.UserTime + shell_command_results.Metrics.SystemTime, 0)
+        self.assertGreater(shell_command_results.Metrics.MaxRss, 64 * 1024 * 1024)
+
+        shell_command_results = Shell.execute_shell_command(command, blocking=False, use_reactor=True)
+        shell_command_results.wait()
+        self.assertGreater(shell_command_results.Metrics.MaxRss, 64 * 1024 * 1024)
+
+        with ShellForkServer() as fork_server:
+            shell_command_results = Shell.execute_shell_command(command, spawner=fork_server)
+            self.assertGreater(shell_command_results.Metrics.MaxRss, 64 * 1024 * 1024)
+
+    def test__add_metrics_sink__success__receives_every_attempt(self):
+        received_metrics = []
+        def broken_sink(metrics):
+            raise Exception("broken")
+        add_metrics_sink(received_metrics.append)
+        add_metrics_sink(broken_sink)
+        try:
+            with self.assertRaises(Exception) as context:
+                Shell.execute_shell_command("echo 'a'; exit 2", max_retries=2, retry_delay=0)
+            self.assertIs(received_metrics[-1], context.exception.__cause__.Metrics)
+
+            shell_command_results = Shell.execute_shell_command("echo 'b'", blocking=False)
+            shell_command_results.wait()
+        finally:
+            remove_metrics_sink(received_metrics.append)
+            remove_metrics_sink(broken_sink)
+
+        self.assertEqual(3, len(received_metrics))
+        self.assertEqual([2, 2, 0], [metrics.ExitCode for metrics in received_metrics])
+        self.assertIs(shell_command_results.Metrics, received_metrics[-1])
+
+    def test__execute_shell_command__success__poll_while_exiting(self):
+        # Polling the process while it is being reaped must not lose its exit code
+        for use_reactor in [False, True]:
+            for i in range(100):
+                shell_command_results = Shell.execute_shell_command(["sh", "-c", "exit 3"], blocking=False, use_reactor=use_reactor)
+                returncode = None
+                while returncode is None:
+                    returncode = shell_command_results.process.poll()
+                self.assertEqual(3, returncode)
+                shell_command_results.wait(raise_on_error=False)
+                self.assertEqual(3, shell_command_results.ExitCode)
@@ -0,0 +1,98 @@
+from unittest import TestCase
+from ShellUtilities import Shell
+from ShellUtilities.ShellForkServer import ShellForkServer
+from ShellUtilities.ShellCommandException import ShellCommandException, ShellCommandTimeoutException
+import subprocess
+import tempfile
+import os
+
+
+class Test_ShellForkServer(TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        cls.fork_server = ShellForkServer()
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.fork_server.close()
+
+    def test__execute_shell_command__success__blocking(self):
+        shell_command_result = Shell.execute_shell_command("echo 'a'; echo 'b' 1>&2", spawner=self.fork_server)
+        self.assertEqual("a", shell_command_result.Stdout)
+        self.assertEqual("b", shell_command_result.Stderr)
+        self.assertEqual(0, shell_command_result.ExitCode)
+
+        shell_command_result = Shell.execute_shell_command("seq 1 10", output_retention="lines", output_retention_limit=2, spawner=self.fork_server)
+        self.assertEqual("9" + os.linesep + "10", shell_command_result.Stdout)
+
+        with self.assertRaises(Exception) as context:
+            Shell.execute_shell_command("exit 7", spawner=self.fork_server)
+        self.assertIsInstance(context.exception.__cause__, ShellCommandException)
+        self.assertEqual(7, context.exception.__cause__.ExitCode)
+
+    def test__execute_shell_command__success__nonblocking(self):
+        for use_reactor in [False, True]:
+            lines = []
+            shell_command_result = Shell.execute_shell_command(
+                "for i in 1 2 3; do echo $i; done",
+                blocking=False,
+                use_reactor=use_reactor,
+                async_buffer_funcs={"stdout": [lines.append]},
+                spawner=self.fork_server
+            )
+            shell_command_result.wait()
+            self.assertEqual(["1", "2", "3"], lines)
+            self.assertEqual(0, shell_command_result.ExitCode)
+
+    def test__execute_shell_command__success__env_and_cwd(self):
+        # The fork server was started before the change to the environment of this process
+        os.environ["SHELL_FORK_SERVER_TEST"] = "a"
+        try:
+            shell_command_result = Shell.execute_shell_command("echo $SHELL_FORK_SERVER_TEST; pwd", spawner=self.fork_server)
+            self.assertEqual("a" + os.linesep + os.getcwd(), shell_command_result.Stdout)
+        finally:
+            del os.environ["SHELL_FORK_SERVER_TEST"]
+
+        shell_command_result = Shell.execute_shell_command(["pwd"], cwd="/", env={"A": "b"}, spawner=self.fork_server)
+        self.assertEqual("/", shell_command_result.Stdout)
+
+    def test__popen__success__wait_and_kill(self):
+        process = self.fork_server.popen(["sleep", "10"])
+        self.assertIsNone(process.poll())
+        with self.assertRaises(subprocess.TimeoutExpired):
+            process.wait(timeout=0.1)
+        process.kill()
+        self.assertEqual(-9, process.wait())
+        process.stdout.close()
+        process.stderr.close()
+
+    def test__popen__failure__program_not_found(self):
+        with self.assertRaises(FileNotFoundError):
+            self.fork_server.popen(["/nonexistent/program"])
+        # The fork server is still usable afterwards
+        self.assertEqual("a", Shell.execute_shell_command(["echo", "a"], spawner=self.fork_server).Stdout)
+
+    def test__execute_shell_command__failure__input(self):
+        with self.assertRaises(Exception) as context:
+            Shell.execute_shell_command("cat", input=b"x", spawner=self.fork_server)
+        self.assertIn("spawner", str(context.exception.__cause__))
+
+    def test__execute_shell_command__failure__redirect(self):
+        # The file is left as it was rather than being truncated
+        with tempfile.TemporaryDirectory() as temp_dir:
+            path = os.path.join(temp_dir, "stdout")
+            with open(path, "w") as file:
+                file.write("precious\n")
+            for kwargs in [{"stdout": path}, {"stderr": path}]:
+                with self.assertRaises(Exception) as context:
+                    Shell.execute_shell_command("echo 'a'", spawner=self.fork_server, **kwargs)
+                self.assertIn("spawner", str(context.exception.__cause__))
+                with open(path) as file:
+                    self.assertEqual("precious\n", file.read())
+
+    def test__execute_shell_command__failure__timeout(self):
+        with self.assertRaises(Exception) as context:
+            Shell.execute_shell_command("echo 'partial'; sleep 30 & sleep 30", timeout=0.5, spawner=self.fork_server)
+        self.assertIsInstance(context.exception.__cause__, ShellCommandTimeoutException)
+        self.assertEqual("partial", context.exception.__cause__.Stdout)
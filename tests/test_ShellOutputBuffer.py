@@ -0,0 +1,206 @@
+from unittest import TestCase
+from ShellUtilities import Shell
+from ShellUtilities.ShellOutputReactor import get_default_reactor
+from ShellUtilities.ShellOutputBuffer import ShellOutputBuffer, RingShellOutputBuffer, SpillingShellOutputBuffer, FileShellOutputBuffer, create_shell_output_buffer
+import tempfile
+import os
+
+
+class Test_ShellOutputBuffer(TestCase):
+
+    def test__text__success__cached_and_extended(self):
+        shell_output_buffer = ShellOutputBuffer()
+        self.assertEqual("", shell_output_buffer.text())
+        shell_output_buffer.append("a")
+        shell_output_buffer.append("b")
+        text = shell_output_buffer.text()
+        self.assertEqual("a" + os.linesep + "b" + os.linesep, text)
+        self.assertIs(text, shell_output_buffer.text())
+        shell_output_buffer.append("c")
+        self.assertEqual("a" + os.linesep + "b" + os.linesep + "c" + os.linesep, shell_output_buffer.text())
+        self.assertEqual(3, len(shell_output_buffer))
+
+    def test__execute_shell_command__success__large_non_blocking_output(self):
+        shell_command_results = Shell.execute_shell_command("seq 1 200000", blocking=False)
+        shell_command_results.wait()
+        self.assertEqual(200000, len(shell_command_results.stdout_lines))
+        self.assertEqual(os.linesep.join(str(i) for i in range(1, 200001)) + os.linesep, shell_command_results.Stdout)
+
+    def test__append__success__ring_buffer_bounds(self):
+        shell_output_buffer = RingShellOutputBuffer(max_lines=2)
+        for line in ["a", "b", "c"]:
+            shell_output_buffer.append(line)
+        self.assertEqual(["b", "c"], list(shell_output_buffer.lines))
+        self.assertEqual("b" + os.linesep + "c" + os.linesep, shell_output_buffer.text())
+
+        shell_output_buffer = RingShellOutputBuffer(max_bytes=10)
+        for line in ["aaaa", "bbbb", "cccc"]:
+            shell_output_buffer.append(line)
+        self.assertEqual(["bbbb", "cccc"], list(shell_output_buffer.lines))
+        shell_output_buffer.append("x" * 20)
+        self.assertEqual(["x" * 10], list(shell_output_buffer.lines))
+
+        # The size is measured in bytes once encoded, and the tail of a line never splits a character
+        shell_output_buffer = RingShellOutputBuffer(max_bytes=10)
+        for line in ["aaa", "\u00e9\u00e9\u00e9"]:
+            shell_output_buffer.append(line)
+        self.assertEqual(["\u00e9\u00e9\u00e9"], list(shell_output_buffer.lines))
+        shell_output_buffer.append("a" + "\u00e9" * 5)
+        self.assertEqual(["\u00e9" * 5], list(shell_output_buffer.lines))
+        shell_output_buffer.append("\u00e9" * 6)
+        self.assertEqual(["\u00e9" * 5], list(shell_output_buffer.lines))
+
+    def test__create_shell_output_buffer__failure__invalid_limit(self):
+        # A limit of 0 would fail on the first line ("lines") or keep every line whole ("bytes")
+        for output_retention in ["lines", "bytes", "spill"]:
+            for limit in [0, -1, 1.5, "10"]:
+                with self.assertRaises(Exception):
+                    create_shell_output_buffer(output_retention, limit)
+                with self.assertRaises(Exception):
+                    Shell.execute_shell_command("echo 'a'", output_retention=output_retention, output_retention_limit=limit)
+
+    def test__append__success__spill_to_file(self):
+        shell_output_buffer = SpillingShellOutputBuffer(10, diagnostic_line_count=2)
+        shell_output_buffer.append("abc")
+        self.assertFalse(shell_output_buffer.spilled())
+        for line in ["def", "ghi", "jkl"]:
+            shell_output_buffer.append(line)
+        self.assertTrue(shell_output_buffer.spilled())
+        self.assertEqual(["abc", "def", "ghi", "jkl"], list(shell_output_buffer))
+        self.assertEqual("def", shell_output_buffer[1])
+        self.assertEqual("jkl", shell_output_buffer[-1])
+        self.assertEqual(b"abc\ndef\nghi\njkl\n", shell_output_buffer.mmap()[:])
+        self.assertEqual("ghi" + os.linesep + "jkl" + os.linesep, shell_output_buffer.diagnostic_text())
+        shell_output_buffer.close()
+
+    def test__execute_shell_command__success__spill_encoding(self):
+        # Undecodable bytes survive being spilled to the file and read back
+        shell_command_string = r"printf 'caf\351\n'; seq 1 100"
+        shell_command_results = Shell.execute_shell_command(shell_command_string, output_retention="spill", output_retention_limit=10, errors="surrogateescape")
+        self.assertTrue(shell_command_results.stdout_buffer.spilled())
+        self.assertEqual("caf\udce9", shell_command_results.stdout_lines[0])
+        self.assertEqual("caf\udce9", next(iter(shell_command_results.stdout_lines)))
+        self.assertTrue(shell_command_results.Stdout.startswith("caf\udce9" + os.linesep + "1"))
+        shell_command_results.close()
+
+        shell_command_results = Shell.execute_shell_command(shell_command_string, output_retention="spill", output_retention_limit=10, encoding="latin-1")
+        self.assertEqual("caf\u00e9", shell_command_results.stdout_lines[0])
+        shell_command_results.close()
+
+    def test__execute_shell_command__success__blocking_output_retention(self):
+        shell_command_results = Shell.execute_shell_command("seq 1 1000", output_retention="lines", output_retention_limit=3)
+        self.assertEqual(0, shell_command_results.ExitCode)
+        self.assertEqual(os.linesep.join(["998", "999", "1000"]), shell_command_results.Stdout)
+
+        shell_command_results = Shell.execute_shell_command("seq 1 100000", output_retention="spill", output_retention_limit=1024)
+        self.assertTrue(shell_command_results.stdout_buffer.spilled())
+        self.assertEqual(100000, len(shell_command_results.stdout_lines))
+        self.assertEqual("100000", shell_command_results.stdout_lines[-1])
+        self.assertTrue(shell_command_results.stdout_buffer.mmap()[:].endswith(b"99999\n100000\n"))
+
+    def test__execute_shell_command__failure__output_retention_tail_on_exception(self):
+        shell_command_string = "seq 1 100000 1>&2; exit 3"
+        with self.assertRaises(Exception) as context:
+            Shell.execute_shell_command(shell_command_string, output_retention="spill", output_retention_limit=1024)
+        shell_command_exception = context.exception.__cause__
+        self.assertEqual(3, shell_command_exception.ExitCode)
+        self.assertEqual(100, len(shell_command_exception.Stderr.split(os.linesep)))
+        self.assertTrue(shell_command_exception.Stderr.endswith("100000"))
+
+        shell_command_results = Shell.execute_shell_command(shell_command_string, blocking=False, output_retention="bytes", output_retention_limit=14)
+        with self.assertRaises(Exception) as context:
+            shell_command_results.wait()
+        self.assertEqual(["99999", "100000"], list(shell_command_results.stderr_lines))
+        self.assertEqual("99999" + os.linesep + "100000" + os.linesep, context.exception.Stderr)
+
+    def test__execute_shell_command__success__redirect_to_file(self):
+        with tempfile.TemporaryDirectory() as temp_dir:
+            path = os.path.join(temp_dir, "stdout")
+            shell_command_results = Shell.execute_shell_command("seq 1 5; echo 'err' 1>&2; printf 'last'", stdout=path)
+            self.assertEqual("1\n2\n3\n4\n5\nlast", shell_command_results.Stdout)
+            self.assertEqual("err", shell_command_results.Stderr)
+            self.assertEqual(6, len(shell_command_results.stdout_lines))
+            self.assertEqual("last", shell_command_results.stdout_lines[-1])
+            self.assertEqual(["4", "5"], shell_command_results.stdout_lines[3:5])
+            self.assertEqual(b"1\n2", bytes(shell_command_results.stdout_buffer.mmap()[:3]))
+            shell_command_results.stdout_buffer.close()
+
+            # Only the output of the command is part of the results when writing to an open file
+            with open(path, "ab") as file:
+                shell_command_results = Shell.execute_shell_command(["echo", "appended"], stdout=file)
+                self.assertEqual("appended", shell_command_results.Stdout)
+                self.assertEqual(["appended"], list(shell_command_results.stdout_lines))
+            with open(path) as file:
+                self.assertEqual("1\n2\n3\n4\n5\nlastappended\n", file.read())
+
+            # The exception only contains the tail of the output
+            with self.assertRaises(Exception) as context:
+                Shell.execute_shell_command("seq 1 100000; exit 3", stdout=path)
+            self.assertEqual(3, context.exception.__cause__.ExitCode)
+            self.assertTrue(context.exception.__cause__.Stdout.endswith("99999\n100000"))
+            self.assertLess(len(context.exception.__cause__.Stdout), 100000)
+
+            # Output which can not be read back is empty
+            with open(os.devnull, "wb") as file:
+                self.assertEqual("", Shell.execute_shell_command("echo 'a'", stdout=file).Stdout)
+
+    def test__close__success__redirect_releases_fds(self):
+        def open_fd_count():
+            return len(os.listdir("/proc/self/fd"))
+
+        # The reactor holds fds of its own
+        get_default_reactor()
+        with tempfile.TemporaryDirectory() as temp_dir:
+            path = os.path.join(temp_dir, "stdout")
+            fd_count = open_fd_count()
+            with Shell.execute_shell_command("seq 1 3", stdout=path) as shell_command_results:
+                self.assertEqual(["1", "2", "3"], list(shell_command_results.stdout_lines))
+            self.assertEqual(fd_count, open_fd_count())
+
+            for use_reactor in [False, True]:
+                with Shell.execute_shell_command("seq 1 3", blocking=False, use_reactor=use_reactor, stdout=path) as shell_command_results:
+                    pass
+                self.assertEqual(0, shell_command_results.ExitCode)
+                self.assertEqual(fd_count, open_fd_count())
+
+            # The buffers of the failed attempts are closed once the exception has been built
+            with self.assertRaises(Exception):
+                Shell.execute_shell_command("seq 1 3; exit 1", stdout=path, max_retries=3, retry_delay=0)
+            self.assertEqual(fd_count, open_fd_count())
+
+    def test__execute_shell_command__success__redirect_non_blocking(self):
+        with tempfile.TemporaryDirectory() as temp_dir:
+            stdout_path = os.path.join(temp_dir, "stdout")
+            stderr_path = os.path.join(temp_dir, "stderr")
+            for use_reactor in [False, True]:
+                shell_command_results = Shell.execute_shell_command("seq 1 3; echo 'err' 1>&2", blocking=False, use_reactor=use_reactor, stdout=stdout_path, stderr=stderr_path)
+                shell_command_results.wait()
+                self.assertEqual("1\n2\n3\n", shell_command_results.Stdout)
+                self.assertEqual("err\n", shell_command_results.Stderr)
+
+                # The lines are still handed to the callbacks and written to the file
+                lines = []
+                shell_command_results = Shell.execute_shell_command("seq 1 3", blocking=False, use_reactor=use_reactor, stdout=stdout_path, async_buffer_funcs={"stdout": [lines.append]})
+                shell_command_results.wait()
+                self.assertEqual(["1", "2", "3"], lines)
+                self.assertEqual(["1", "2", "3"], list(shell_command_results.stdout_lines))
+                with open(stdout_path) as file:
+                    self.assertEqual("1\n2\n3\n", file.read())
+
+    def test__text__success__file_grows(self):
+        with tempfile.TemporaryFile() as file:
+            file.write(b"before\n")
+            file_shell_output_buffer = FileShellOutputBuffer(file)
+            self.assertEqual("", file_shell_output_buffer.text())
+            self.assertEqual(0, len(file_shell_output_buffer))
+            os.write(file.fileno(), "caf\u00e9".encode()[:-1])
+            # An incomplete character is not decoded until the output is complete
+            self.assertEqual("caf", file_shell_output_buffer.text())
+            os.write(file.fileno(), "\u00e9\nx".encode()[1:])
+            self.assertEqual(2, len(file_shell_output_buffer))
+            file_shell_output_buffer.finish()
+            os.write(file.fileno(), b"after")
+            self.assertEqual("caf\u00e9\nx", file_shell_output_buffer.text())
+            self.assertEqual(["caf\u00e9", "x"], list(file_shell_output_buffer))
+            self.assertEqual("x", file_shell_output_buffer.diagnostic_text()[-1:])
+            file_shell_output_buffer.close()
@@ -0,0 +1,57 @@
+from unittest import TestCase
+from ShellUtilities import Shell
+import os
+import threading
+import time
+
+
+class Test_ShellOutputReactor(TestCase):
+
+    def test__execute_shell_command__success__reactor_many_commands(self):
+        thread_count = threading.active_count()
+        shell_command_results = [
+            Shell.execute_shell_command(f"echo {i}; sleep 1; echo {i} 1>&2", blocking=False, use_reactor=True)
+            for i in range(100)
+        ]
+        # Only the single shared reactor thread may have been started
+        self.assertLessEqual(threading.active_count(), thread_count + 1)
+        for i, shell_command_result in enumerate(shell_command_results):
+            shell_command_result.wait()
+            self.assertFalse(shell_command_result.command_running())
+            self.assertEqual(0, shell_command_result.ExitCode)
+            self.assertEqual([str(i)], shell_command_result.stdout_lines)
+            self.assertEqual([str(i)], shell_command_result.stderr_lines)
+            self.assertEqual(str(i) + os.linesep, shell_command_result.Stdout)
+
+    def test__execute_shell_command__success__reactor_async_buffer_funcs(self):
+        stdout_lines = []
+        shell_command_string = r"printf 'a\nb\nc'"
+        shell_command_results = Shell.execute_shell_command(shell_command_string, blocking=False, use_reactor=True, async_buffer_funcs={"stdout": [stdout_lines.append]})
+        shell_command_results.wait()
+        self.assertEqual(["a", "b", "c"], stdout_lines)
+        self.assertEqual(["a", "b", "c"], shell_command_results.stdout_lines)
+
+    def test__execute_shell_command__failure__reactor_python_script_raise_exception(self):
+        current_directory = os.path.dirname(os.path.abspath(__file__))
+        script_path = os.path.join(current_directory, "scripts", "fail.py")
+        shell_command_results = Shell.execute_shell_command(f"python3 '{script_path}'", blocking=False, use_reactor=True)
+        with self.assertRaises(Exception) as context:
+            shell_command_results.wait()
+        self.assertEqual(1, context.exception.ExitCode)
+        self.assertEqual(0, len(context.exception.stdout_lines))
+        self.assertEqual(4, len(context.exception.stderr_lines))
+
+    def test__iter_lines__success__reactor_backpressure(self):
+        # The command writes far more than the pipe can hold; it can only complete if the reactor
+        # resumes reading as the lines are consumed
+        shell_command_string = "seq 1 100000; echo done 1>&2"
+        shell_command_results = Shell.execute_shell_command(shell_command_string, blocking=False, use_reactor=True, output_retention="none", line_queue_size=100)
+        time.sleep(0.5)
+        self.assertTrue(shell_command_results.command_running())
+        self.assertLess(len(shell_command_results.line_queues["stdout"]), 100 + 65536)
+        lines = list(shell_command_results.iter_lines())
+        shell_command_results.wait()
+        self.assertEqual([str(i) for i in range(1, 100001)], [line for stream, line in lines if stream == "stdout"])
+        self.assertEqual([("stderr", "done")], [(stream, line) for stream, line in lines if stream == "stderr"])
+        self.assertEqual(0, len(shell_command_results.stdout_lines))
+        self.assertEqual("", shell_command_results.Stdout)
@@ -0,0 +1,39 @@
+from unittest import TestCase
+from ShellUtilities.ShellOutputReader import ShellOutputLineSplitter, read_until_eof
+import io
+
+
+class Test_ShellOutputReader(TestCase):
+
+    def test__feed__success__lines_split_across_chunks(self):
+        batches = []
+        splitter = ShellOutputLineSplitter(batches.append)
+        splitter.feed(b"a\nb")
+        splitter.feed(b"c")
+        splitter.feed(b"d\ne\n\nf")
+        splitter.close()
+        self.assertEqual([["a"], ["bcd", "e", ""], ["f"]], batches)
+
+    def test__feed__success__multibyte_character_split_across_chunks(self):
+        batches = []
+        splitter = ShellOutputLineSplitter(batches.append)
+        data = "café\nnaïve\n".encode()
+        for i in range(len(data)):
+            splitter.feed(data[i:i + 1])
+        splitter.close()
+        self.assertEqual(["café", "naïve"], [line for batch in batches for line in batch])
+
+    def test__feed__success__binary(self):
+        batches = []
+        splitter = ShellOutputLineSplitter(batches.append, binary=True)
+        buffer = bytearray(b"\x00\xff\n")
+        splitter.feed(memoryview(buffer))
+        buffer[0] = 1
+        splitter.close()
+        self.assertEqual([[b"\x00\xff\n"]], batches)
+
+    def test__read_until_eof__success__large_input(self):
+        lines = []
+        data = "".join(f"{i}\n" for i in range(100000)).encode()
+        read_until_eof(io.BytesIO(data), ShellOutputLineSplitter(lines.extend))
+        self.assertEqual([str(i) for i in range(100000)], lines)
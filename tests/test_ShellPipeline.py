@@ -0,0 +1,81 @@
+from unittest import TestCase
+from ShellUtilities import ShellPipeline as ShellPipelineModule
+from ShellUtilities.ShellPipeline import ShellPipeline, execute_pipeline
+from ShellUtilities.ShellCommandException import ShellPipelineException
+import tempfile
+import unittest.mock
+import os
+
+
+class Test_ShellPipeline(TestCase):
+
+    def test__execute_pipeline__success__stages(self):
+        shell_pipeline_results = execute_pipeline([["seq", "1", "100000"], "grep 7; echo 'filtered' 1>&2", ["wc", "-l"]])
+        self.assertEqual("40951", shell_pipeline_results.Stdout.strip())
+        self.assertEqual("filtered", shell_pipeline_results.Stderr)
+        self.assertEqual(0, shell_pipeline_results.ExitCode)
+        self.assertEqual(3, len(shell_pipeline_results.Stages))
+        self.assertEqual("", shell_pipeline_results.Stages[0].Stdout)
+        self.assertEqual("filtered", shell_pipeline_results.Stages[1].Stderr)
+
+        # Per stage env and cwd
+        shell_pipeline_results = execute_pipeline([{"command": "echo $A; pwd", "env": {"A": "a"}, "cwd": "/"}, ["cat"]])
+        self.assertEqual("a" + os.linesep + "/", shell_pipeline_results.Stdout)
+
+    def test__execute_pipeline__success__sigpipe_ignored(self):
+        # yes is killed by SIGPIPE once head exits
+        shell_pipeline_results = execute_pipeline([["yes"], ["head", "-n", "3"]])
+        self.assertEqual("y\ny\ny", shell_pipeline_results.Stdout)
+        self.assertEqual(-13, shell_pipeline_results.Stages[0].ExitCode)
+        self.assertEqual(0, shell_pipeline_results.ExitCode)
+
+        # The shell running a string stage exits with 128 + SIGPIPE instead
+        shell_pipeline_results = execute_pipeline(["yes | tr y n", "head -n 1"])
+        self.assertEqual("n", shell_pipeline_results.Stdout)
+        self.assertEqual(141, shell_pipeline_results.Stages[0].ExitCode)
+        self.assertEqual(0, shell_pipeline_results.ExitCode)
+
+        # Only stages which were writing to another stage can be killed by SIGPIPE
+        with self.assertRaises(Exception) as context:
+            execute_pipeline([["echo", "a"], "cat; exit 141"])
+        self.assertEqual(141, context.exception.__cause__.ExitCode)
+
+    def test__execute_pipeline__failure__stage_failed(self):
+        with self.assertRaises(Exception) as context:
+            execute_pipeline(["echo 'a'; echo 'first' 1>&2; exit 3", ["cat"], "cat; exit 0"])
+        shell_pipeline_exception = context.exception.__cause__
+        self.assertIsInstance(shell_pipeline_exception, ShellPipelineException)
+        self.assertEqual(3, shell_pipeline_exception.ExitCode)
+        self.assertEqual("a", shell_pipeline_exception.Stdout)
+        self.assertEqual([3, 0, 0], [stage.ExitCode for stage in shell_pipeline_exception.Stages])
+
+    def test__tee__success__file_and_callback(self):
+        with tempfile.TemporaryDirectory() as temp_dir:
+            tee_path = os.path.join(temp_dir, "tee")
+            output_path = os.path.join(temp_dir, "output")
+            chunks = []
+            shell_pipeline = ShellPipeline([["seq", "1", "500000"], ["gzip", "-1"], ["gzip", "-dc"]])
+            shell_pipeline.tee(0, tee_path).tee(1, chunks.append)
+            shell_pipeline_results = shell_pipeline.execute(stdout=output_path)
+            self.assertEqual("", shell_pipeline_results.Stdout)
+
+            with open(tee_path, "rb") as file:
+                teed = file.read()
+            with open(output_path, "rb") as file:
+                output = file.read()
+            self.assertEqual(teed, output)
+            self.assertEqual(b"1\n2\n", output[:4])
+            self.assertEqual(500000, output.count(b"\n"))
+            # The gzipped stream was teed to the callback
+            self.assertEqual(b"\x1f\x8b", b"".join(chunks)[:2])
+
+        with self.assertRaises(Exception):
+            ShellPipeline([["seq", "1", "10"], ["cat"]]).tee(1, chunks.append)
+
+    def test__tee__success__without_kernel_tee(self):
+        # Where the tee() system call is not available the data is copied instead
+        with unittest.mock.patch.object(ShellPipelineModule, "_tee", None):
+            chunks = []
+            shell_pipeline_results = ShellPipeline([["seq", "1", "100000"], ["wc", "-l"]]).tee(0, chunks.append).execute()
+            self.assertEqual("100000", shell_pipeline_results.Stdout.strip())
+            self.assertEqual(100000, b"".join(chunks).count(b"\n"))
@@ -0,0 +1,94 @@
+from unittest import TestCase
+from ShellUtilities.ShellSession import ShellSession, ShellPool
+from ShellUtilities.ShellCommandException import ShellCommandException
+import os
+import threading
+import time
+import tempfile
+
+
+class Test_ShellSession(TestCase):
+
+    def test__execute_shell_command__success__output_and_exit_code(self):
+        with ShellPool(1) as shell_pool:
+            shell_command_result = shell_pool.execute_shell_command("echo 'a'; printf 'b'; echo 'c' 1>&2")
+            self.assertEqual(0, shell_command_result.ExitCode)
+            self.assertEqual("a" + os.linesep + "b", shell_command_result.Stdout)
+            self.assertEqual("c", shell_command_result.Stderr)
+
+            shell_command_result = shell_pool.execute_shell_command("seq 1 100000")
+            self.assertEqual(100000, len(shell_command_result.Stdout.split(os.linesep)))
+
+            with self.assertRaises(Exception) as context:
+                shell_pool.execute_shell_command("echo 'oops' 1>&2; exit 3")
+            shell_command_exception = context.exception.__cause__
+            self.assertIsInstance(shell_command_exception, ShellCommandException)
+            self.assertEqual(3, shell_command_exception.ExitCode)
+            self.assertEqual("oops", shell_command_exception.Stderr)
+
+            # The exit above only ended the subshell so the same session is still usable
+            self.assertEqual(1, len(shell_pool.sessions))
+            self.assertEqual(3, shell_pool.sessions[0].command_count)
+
+    def test__execute_shell_command__success__overrides_do_not_leak(self):
+        current_dir = os.path.dirname(os.path.abspath(__file__))
+        with ShellPool(1) as shell_pool:
+            shell_command_result = shell_pool.execute_shell_command("echo \"$MYVAR\"; pwd", env={"MYVAR": "it's here"}, cwd=current_dir)
+            self.assertEqual("it's here" + os.linesep + current_dir, shell_command_result.Stdout)
+            shell_command_result = shell_pool.execute_shell_command("MYOTHERVAR=1; cd /")
+            shell_command_result = shell_pool.execute_shell_command("echo \"$MYVAR$MYOTHERVAR\"; pwd")
+            self.assertEqual(os.linesep + os.getcwd(), shell_command_result.Stdout)
+
+    def test__execute_shell_command__success__recycle_dead_and_polluted_sessions(self):
+        with ShellPool(1) as shell_pool:
+            shell_pool.execute_shell_command("true")
+            first_session = shell_pool.sessions[0]
+            with self.assertRaises(Exception):
+                shell_pool.execute_shell_command("kill -9 $$")
+            self.assertEqual("a", shell_pool.execute_shell_command("echo a").Stdout)
+            self.assertIsNot(first_session, shell_pool.sessions[0])
+
+            second_session = shell_pool.sessions[0]
+            shell_pool.execute_shell_command("(sleep 0.2; echo late) &")
+            time.sleep(0.5)
+            self.assertEqual("b", shell_pool.execute_shell_command("echo b").Stdout)
+            self.assertIsNot(second_session, shell_pool.sessions[0])
+
+    def test__execute_shell_command__success__concurrent_commands(self):
+        results = {}
+        with ShellPool(4) as shell_pool:
+            def run(i):
+                results[i] = shell_pool.execute_shell_command(f"echo {i}").Stdout
+            threads = [threading.Thread(target=run, args=(i,)) for i in range(50)]
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+            self.assertLessEqual(len(shell_pool.sessions), 4)
+        self.assertEqual({i: str(i) for i in range(50)}, results)
+
+    def test__execute_shell_command__failure__invalid_env(self):
+        with tempfile.TemporaryDirectory() as temp_dir:
+            with ShellPool(1) as shell_pool:
+                for env in [{"A=1; touch injected; B": "x"}, {"1A": "x"}, {1: "x"}, {"A": 1}]:
+                    with self.assertRaises(Exception):
+                        shell_pool.execute_shell_command("true", env=env, cwd=temp_dir)
+                self.assertFalse(os.path.exists(os.path.join(temp_dir, "injected")))
+                # The session is still usable afterwards
+                self.assertEqual("x", shell_pool.execute_shell_command("echo \"$_A1\"", env={"_A1": "x"}).Stdout)
+
+    def test__execute_shell_command__failure__session_not_started(self):
+        # A session which could not be started must not use up a slot of the pool
+        errors = []
+        def execute_shell_commands():
+            for i in range(2):
+                try:
+                    shell_pool.execute_shell_command("echo 'a'")
+                except Exception as ex:
+                    errors.append(ex)
+        with ShellPool(1, executable="/nonexistent-shell") as shell_pool:
+            thread = threading.Thread(target=execute_shell_commands, daemon=True)
+            thread.start()
+            thread.join(10)
+            self.assertFalse(thread.is_alive())
+        self.assertEqual(2, len(errors))